@@ -2,21 +2,55 @@
 import os
 import sys
 import io
+import json
+import time
 from datetime import datetime
 from typing import Optional
 import streamlit as st
+import streamlit.components.v1 as components
 from PIL import Image
 
 # Add backend to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 from backend.config import config_manager
+from backend.aws_clients import prewarm
 from backend.s3_manager import S3Manager
+from backend.storage import StorageError
 from backend.db import DynamoDBManager
 from backend.caption_service import CaptionService
 from backend.auth import AuthManager
-from backend.rate_limiter import RateLimiter
+from backend.rate_limiter import create_rate_limiter
 from backend.models import RateLimitConfig, CaptionResult
+from backend.image_validation import decode_image, ImageValidationError
+from backend.erasure import erase_user_data
+from backend.cursor import InvalidCursorError
+from backend.idempotency import IdempotencyStore, RequestInProgressError, request_key
+
+# File extension per content type accepted for direct browser uploads
+DIRECT_UPLOAD_TYPES = {'image/jpeg': 'jpg', 'image/png': 'png'}
+
+# Browser form posting the chosen file straight to S3 with the policy for its type
+DIRECT_UPLOAD_FORM = """
+<input type="file" id="file" accept="image/jpeg,image/png">
+<button id="send">Upload</button>
+<div id="status" style="font-family: sans-serif; margin-top: 0.5rem;"></div>
+<script>
+const posts = __POSTS__;
+const status = document.getElementById('status');
+document.getElementById('send').onclick = async () => {
+    const file = document.getElementById('file').files[0];
+    const post = file && posts[file.type];
+    if (!post) { status.textContent = 'Choose a JPEG or PNG image.'; return; }
+    const form = new FormData();
+    Object.entries(post.fields).forEach(([name, value]) => form.append(name, value));
+    form.append('file', file);
+    status.textContent = 'Uploading...';
+    const response = await fetch(post.url, {method: 'POST', body: form});
+    status.textContent = response.ok ? 'Uploaded. Click "Generate Captions".' : 'Upload failed (' + response.status + ').';
+};
+</script>
+"""
 
 
 # Page config
@@ -31,13 +65,16 @@ st.set_page_config(
 @st.cache_resource
 def init_services():
     """Initialize backend services."""
+    if config_manager.config.prewarm_aws_clients:
+        prewarm(config_manager.config.aws_region)
     return {
         'config': config_manager.config,
         's3': S3Manager(),
         'db': DynamoDBManager(),
         'caption': CaptionService(),
         'auth': AuthManager(),
-        'rate_limiter': RateLimiter(RateLimitConfig())
+        'rate_limiter': create_rate_limiter(RateLimitConfig(), config_manager.config),
+        'idempotency': IdempotencyStore()
     }
 
 services = init_services()
@@ -192,21 +229,30 @@ def upload_tab():
     col1, col2 = st.columns([1, 1])
     
     with col1:
-        uploaded_file = st.file_uploader(
-            "Choose an image (JPEG/PNG, max 10 MB)",
-            type=['jpg', 'jpeg', 'png'],
-            help="Upload an image to generate captions"
-        )
-        
+        if services['config'].direct_uploads and direct_upload_form():
+            uploaded_file = None
+        else:
+            uploaded_file = st.file_uploader(
+                "Choose an image (JPEG/PNG, max 10 MB)",
+                type=['jpg', 'jpeg', 'png'],
+                help="Upload an image to generate captions"
+            )
+            
         if uploaded_file:
             # Validate file size
             file_size_mb = len(uploaded_file.getvalue()) / (1024 * 1024)
             if file_size_mb > services['config'].max_image_size_mb:
                 st.error(f"⚠️ Image too large ({file_size_mb:.1f} MB). Maximum size is {services['config'].max_image_size_mb} MB.")
                 return
-            
+                
+            # Check dimensions from the header before decoding any pixels
+            try:
+                image = decode_image(uploaded_file.getvalue(), max_dimension=2048)
+            except ImageValidationError as e:
+                st.error(f"⚠️ {e}")
+                return
+                
             # Display image
-            image = Image.open(uploaded_file)
             st.image(image, caption="Uploaded Image", use_container_width=True)
             
             # Generate caption button
@@ -218,8 +264,57 @@ def upload_tab():
             display_captions(st.session_state.current_result)
 
 
+def direct_upload_form() -> bool:
+    """
+    Let the browser upload straight to S3, then caption the stored object.
+    
+    Returns:
+        False if the storage backend has no POST uploads, so the app proxies them instead
+    """
+    user_id = st.session_state.user_id
+    upload = st.session_state.get('direct_upload')
+    # Renew the policies well before they expire
+    if not upload or time.time() - upload['created'] > services['config'].presigned_url_expiry / 2:
+        try:
+            upload = {
+                'created': time.time(),
+                'posts': {
+                    content_type: services['s3'].create_upload_post(user_id, f"upload.{extension}", content_type)
+                    for content_type, extension in DIRECT_UPLOAD_TYPES.items()
+                }
+            }
+        except StorageError as e:
+            print(f"Direct uploads unavailable: {e}")
+            return False
+        st.session_state.direct_upload = upload
+        
+    posts = {
+        content_type: {'url': post['url'], 'fields': post['fields']}
+        for content_type, post in upload['posts'].items()
+    }
+    components.html(DIRECT_UPLOAD_FORM.replace('__POSTS__', json.dumps(posts).replace('</', '<\\/')), height=110)
+    
+    if st.button("✨ Generate Captions", type="primary", use_container_width=True):
+        keys = [post['key'] for post in upload['posts'].values() if services['s3'].storage.exists(post['key'])]
+        if not keys:
+            st.error("⚠️ Upload an image first.")
+        else:
+            key = keys[0]
+            run_caption_request(key.encode(), lambda idempotency_key: process_direct_upload(key, idempotency_key))
+    return True
+
+
 def generate_captions(uploaded_file, image: Image.Image):
     """Generate captions for uploaded image."""
+    file_bytes = uploaded_file.getvalue()
+    run_caption_request(
+        file_bytes,
+        lambda idempotency_key: process_upload(uploaded_file, file_bytes, image, idempotency_key)
+    )
+
+
+def run_caption_request(content: bytes, work):
+    """Rate limit and deduplicate a caption request, then show its result; work gets the request key."""
     # Check rate limit
     if not services['rate_limiter'].is_allowed(st.session_state.user_id):
         st.error("⚠️ Rate limit exceeded. Please try again later.")
@@ -227,49 +322,90 @@ def generate_captions(uploaded_file, image: Image.Image):
     
     with st.spinner("🔄 Processing image..."):
         try:
-            # Upload to S3
-            file_bytes = uploaded_file.getvalue()
-            metadata = services['s3'].upload_image(
-                user_id=st.session_state.user_id,
-                file_data=file_bytes,
-                filename=uploaded_file.name,
-                content_type=uploaded_file.type
-            )
-            
-            # Preprocess image
-            processed_image = services['caption'].preprocess_image(image)
-            
-            # Generate captions
-            concise, creative, labels, provider = services['caption'].generate_caption(
-                processed_image,
-                file_bytes
+            # Reruns, double clicks and retries of the same image replay the stored result
+            config = services['config']
+            key = request_key(
+                st.session_state.user_id,
+                content,
+                provider=config.caption_provider.value,
+                model=config.bedrock_model_id,
+                use_rekognition=config.use_rekognition
             )
-            
-            # Save to database
-            result = CaptionResult(
-                image_id=metadata.image_id,
-                user_id=st.session_state.user_id,
-                concise_caption=concise,
-                creative_caption=creative,
-                labels=labels,
-                model=services['config'].bedrock_model_id or "default",
-                provider=provider,
-                s3_url=metadata.s3_url,
-                thumbnail_url=metadata.thumbnail_url
-            )
-            
-            services['db'].save_caption(result)
+            stored = services['idempotency'].run_once(st.session_state.user_id, key, lambda: work(key))
             
             # Store in session
-            st.session_state.current_result = result
+            st.session_state.current_result = CaptionResult(**stored)
             
             st.success("✅ Captions generated successfully!")
             st.rerun()
             
+        except RequestInProgressError:
+            st.info("⏳ This image is already being captioned. Please wait a moment.")
         except Exception as e:
+            services['db'].record_usage_error()
             st.error(f"❌ Error: {str(e)}")
 
 
+def process_upload(uploaded_file, file_bytes: bytes, image: Image.Image, idempotency_key: str) -> dict:
+    """Upload an image, caption it and save the caption; returns the result as JSON data."""
+    # Upload to S3
+    metadata = services['s3'].upload_image(
+        user_id=st.session_state.user_id,
+        file_data=file_bytes,
+        filename=uploaded_file.name,
+        content_type=uploaded_file.type
+    )
+    return caption_and_save(metadata, file_bytes, image, idempotency_key)
+
+
+def process_direct_upload(key: str, idempotency_key: str) -> dict:
+    """Caption an image the browser uploaded to S3; returns the result as JSON data."""
+    metadata, file_bytes = services['s3'].complete_upload(
+        user_id=st.session_state.user_id,
+        key=key,
+        filename=key.rsplit('/', 1)[-1]
+    )
+    image = decode_image(file_bytes, max_dimension=2048)
+    result = caption_and_save(metadata, file_bytes, image, idempotency_key)
+    # The next upload gets fresh keys
+    st.session_state.pop('direct_upload', None)
+    return result
+
+
+def caption_and_save(metadata, file_bytes: bytes, image: Image.Image, idempotency_key: str) -> dict:
+    """Caption a stored image and save the caption; returns the result as JSON data."""
+    # Preprocess image
+    started = time.monotonic()
+    processed_image = services['caption'].preprocess_image(image)
+    
+    # Generate captions
+    concise, creative, labels, provider = services['caption'].generate_caption(
+        processed_image,
+        file_bytes
+    )
+    processing_time = time.monotonic() - started
+    
+    # Save to database
+    result = CaptionResult(
+        image_id=metadata.image_id,
+        user_id=st.session_state.user_id,
+        concise_caption=concise,
+        creative_caption=creative,
+        labels=labels,
+        model=services['config'].bedrock_model_id or "default",
+        provider=provider,
+        s3_url=metadata.s3_url,
+        thumbnail_url=metadata.thumbnail_url,
+        content_hash=metadata.content_hash,
+        request_key=idempotency_key
+    )
+    
+    # A failed save must not be stored as the request's result and replayed
+    if not services['db'].save_caption(result, file_size=metadata.file_size, processing_time=processing_time):
+        raise RuntimeError("Failed to save caption")
+    return result.model_dump(mode='json')
+
+
 def display_captions(result: CaptionResult):
     """Display generated captions."""
     st.markdown("### Generated Captions")
@@ -309,39 +445,59 @@ def history_tab():
     """Display user's caption history."""
     st.markdown("### Your Caption History")
     
+    # Cursors of the pages visited so far; the last one is the current page
+    if 'history_cursors' not in st.session_state:
+        st.session_state.history_cursors = [None]
+    cursors = st.session_state.history_cursors
+    
     try:
-        history, next_key = services['db'].get_user_history(
-            st.session_state.user_id,
-            limit=20
-        )
+        try:
+            history, next_cursor = services['db'].get_history_page(
+                st.session_state.user_id,
+                page_size=20,
+                cursor=cursors[-1]
+            )
+        except InvalidCursorError:
+            # Issued to another user or process; start over from the first page
+            cursors[:] = [None]
+            history, next_cursor = services['db'].get_history_page(st.session_state.user_id, page_size=20)
+    except Exception as e:
+        st.error(f"Error loading history: {str(e)}")
+        return
+        
+    if not history:
+        st.info("No captions yet. Upload an image to get started!")
+        return
         
-        if not history:
-            st.info("No captions yet. Upload an image to get started!")
-            return
+    for item in history:
+        col1, col2 = st.columns([1, 3])
         
-        for item in history:
-            col1, col2 = st.columns([1, 3])
-            
-            with col1:
-                # Get presigned URL for thumbnail
-                thumbnail_url = services['s3'].get_presigned_url(item.thumbnail_url)
-                if thumbnail_url:
-                    st.image(thumbnail_url, use_container_width=True)
-            
-            with col2:
-                st.markdown(f"**📝 Concise:** {item.concise_caption}")
-                st.markdown(f"**🎨 Creative:** {item.creative_caption}")
-                st.caption(f"🕒 {item.timestamp.strftime('%Y-%m-%d %H:%M')}")
-                if item.labels:
-                    st.caption(f"🏷️ {', '.join(item.labels[:3])}")
-            
-            st.markdown("---")
+        with col1:
+            # Presigned thumbnail URL, or a resized original while it is pending
+            thumbnail = services['s3'].get_thumbnail_view(item.thumbnail_url)
+            if thumbnail:
+                st.image(thumbnail, use_container_width=True)
+                
+        with col2:
+            st.markdown(f"**📝 Concise:** {item.concise_caption}")
+            st.markdown(f"**🎨 Creative:** {item.creative_caption}")
+            st.caption(f"🕒 {item.timestamp.strftime('%Y-%m-%d %H:%M')}")
+            if item.labels:
+                st.caption(f"🏷️ {', '.join(item.labels[:3])}")
+                
+        st.markdown("---")
         
-        if next_key:
-            st.info("More items available. Pagination coming soon!")
-            
-    except Exception as e:
-        st.error(f"Error loading history: {str(e)}")
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if st.button("⬅️ Previous", disabled=len(cursors) == 1, key="history_prev"):
+            cursors.pop()
+            st.rerun()
+    with col2:
+        st.caption(f"Page {len(cursors)}")
+    with col3:
+        if st.button("Next ➡️", disabled=next_cursor is None, key="history_next"):
+            cursors.append(next_cursor)
+            st.rerun()
 
 
 def delete_tab():
@@ -365,17 +521,15 @@ def delete_tab():
     if st.button("🗑️ Delete All My Data", type="primary", disabled=(confirm != "DELETE")):
         with st.spinner("Deleting your data..."):
             try:
-                # Delete from S3
-                s3_count = services['s3'].delete_user_images(st.session_state.user_id)
-                
-                # Delete from DynamoDB
-                db_count = services['db'].delete_user_data(st.session_state.user_id)
+                # Delete from S3 and DynamoDB in parallel
+                counts = erase_user_data(st.session_state.user_id, services['s3'], services['db'])
                 
-                st.success(f"✅ Deleted {s3_count} images and {db_count} database records.")
+                st.success(f"✅ Deleted {counts['objects_deleted']} images and {counts['items_deleted']} database records.")
                 
                 # Clear session
                 if 'current_result' in st.session_state:
                     del st.session_state.current_result
+                st.session_state.history_cursors = [None]
                 
             except Exception as e:
                 st.error(f"Error deleting data: {str(e)}")
@@ -5,18 +5,22 @@ import io
 from datetime import datetime
 from typing import Optional
 import streamlit as st
-from PIL import Image
 
 # Add backend to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 from backend.config import config_manager
+from backend.aws_clients import prewarm
 from backend.s3_manager import S3Manager
 from backend.db import DynamoDBManager
 from backend.caption_service import CaptionService
-from backend.rate_limiter import RateLimiter
+from backend.rate_limiter import create_rate_limiter
 from backend.models import RateLimitConfig, CaptionResult
 from backend.auth_security import SimpleUserAuth
+from backend.image_validation import decode_image, ImageValidationError
+from backend.erasure import erase_user_data
+from backend.cursor import InvalidCursorError
+from backend.idempotency import IdempotencyStore, RequestInProgressError, request_key
 
 
 # Page config
@@ -31,13 +35,16 @@ st.set_page_config(
 @st.cache_resource
 def init_services():
     """Initialize backend services."""
+    if config_manager.config.prewarm_aws_clients:
+        prewarm(config_manager.config.aws_region)
     return {
         'config': config_manager.config,
         's3': S3Manager(),
         'db': DynamoDBManager(),
         'caption': CaptionService(),
         'user_auth': SimpleUserAuth(),
-        'rate_limiter': RateLimiter(RateLimitConfig())
+        'rate_limiter': create_rate_limiter(RateLimitConfig(), config_manager.config),
+        'idempotency': IdempotencyStore()
     }
 
 services = init_services()
@@ -240,8 +247,14 @@ def upload_tab():
     )
     
     if uploaded_file is not None:
+        # Check dimensions from the header before decoding any pixels
+        try:
+            image = decode_image(uploaded_file.getvalue())
+        except ImageValidationError as e:
+            st.error(f"⚠️ {e}")
+            return
+            
         # Display image
-        image = Image.open(uploaded_file)
         col1, col2 = st.columns([1, 1])
         
         with col1:
@@ -272,10 +285,19 @@ def upload_tab():
                     image.save(img_byte_arr, format=image.format or 'PNG')
                     img_bytes = img_byte_arr.getvalue()
                     
-                    # Generate caption
-                    concise, creative, labels, provider = services['caption'].generate_caption(
-                        image=image,
-                        image_bytes=img_bytes
+                    # Generate caption; reruns and double clicks replay the stored result
+                    config = services['config']
+                    key = request_key(
+                        user_id,
+                        img_bytes,
+                        provider=config.caption_provider.value,
+                        model=config.bedrock_model_id,
+                        use_rekognition=config.use_rekognition
+                    )
+                    concise, creative, labels, provider = services['idempotency'].run_once(
+                        user_id,
+                        key,
+                        lambda: list(services['caption'].generate_caption(image=image, image_bytes=img_bytes))
                     )
                     
                     # Display results
@@ -301,6 +323,8 @@ def upload_tab():
                     
                     st.balloons()
                     
+                except RequestInProgressError:
+                    st.info("⏳ This image is already being captioned. Please wait a moment.")
                 except Exception as e:
                     st.error(f"❌ Error generating caption: {str(e)}")
 
@@ -311,44 +335,61 @@ def history_tab():
     
     user_id = st.session_state.user_data['user_id']
     
+    # Cursors of the pages visited so far; the last one is the current page
+    if 'history_cursors' not in st.session_state:
+        st.session_state.history_cursors = [None]
+    cursors = st.session_state.history_cursors
+    
     try:
-        history = services['db'].get_user_history(user_id, limit=20)
-        
-        if not history:
-            st.info("📭 No captions yet. Upload an image to get started!")
-            return
+        try:
+            history, next_cursor = services['db'].get_history_page(user_id, page_size=20, cursor=cursors[-1])
+        except InvalidCursorError:
+            # Issued to another user or process; start over from the first page
+            cursors[:] = [None]
+            history, next_cursor = services['db'].get_history_page(user_id, page_size=20)
+    except Exception as e:
+        st.error(f"❌ Error loading history: {str(e)}")
+        return
         
-        st.success(f"✅ Found {len(history)} caption(s)")
+    if not history:
+        st.info("📭 No captions yet. Upload an image to get started!")
+        return
         
-        for idx, item in enumerate(history):
-            with st.expander(f"📷 {item.get('filename', 'Unknown')} - {item.get('generated_at', 'N/A')[:10]}"):
-                col1, col2 = st.columns([1, 2])
+    st.success(f"✅ Showing {len(history)} caption(s) on page {len(cursors)}")
+    
+    for item in history:
+        with st.expander(f"📷 {item.concise_caption[:60]} - {item.timestamp.strftime('%Y-%m-%d')}"):
+            col1, col2 = st.columns([1, 2])
+            
+            with col1:
+                thumbnail = services['s3'].get_thumbnail_view(item.thumbnail_url)
+                if thumbnail:
+                    st.image(thumbnail, use_container_width=True)
+                else:
+                    st.write("🖼️ Image not available")
+                    
+            with col2:
+                st.markdown("**Concise Caption:**")
+                st.write(item.concise_caption)
                 
-                with col1:
-                    # Try to load thumbnail
-                    if item.get('s3_key'):
-                        try:
-                            presigned_url = services['s3'].get_presigned_url(item['s3_key'])
-                            st.image(presigned_url, use_container_width=True)
-                        except:
-                            st.write("🖼️ Image not available")
+                st.markdown("**Creative Caption:**")
+                st.write(item.creative_caption)
                 
-                with col2:
-                    st.markdown("**Concise Caption:**")
-                    st.write(item.get('concise_caption', 'N/A'))
+                if item.labels:
+                    st.markdown("**Detected Labels:**")
+                    st.write(", ".join(item.labels[:5]))
                     
-                    st.markdown("**Creative Caption:**")
-                    st.write(item.get('creative_caption', 'N/A'))
-                    
-                    st.markdown("**Provider:**")
-                    st.write(item.get('provider', 'N/A'))
-                    
-                    if item.get('detected_labels'):
-                        st.markdown("**Detected Labels:**")
-                        st.write(", ".join(item['detected_labels'][:5]))
-    
-    except Exception as e:
-        st.error(f"❌ Error loading history: {str(e)}")
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if st.button("⬅️ Previous", disabled=len(cursors) == 1, key="history_prev"):
+            cursors.pop()
+            st.rerun()
+    with col2:
+        st.caption(f"Page {len(cursors)}")
+    with col3:
+        if st.button("Next ➡️", disabled=next_cursor is None, key="history_next"):
+            cursors.append(next_cursor)
+            st.rerun()
 
 
 def delete_tab():
@@ -378,11 +419,9 @@ def delete_tab():
         if st.button("🗑️ Delete Caption Data", type="secondary"):
             with st.spinner("Deleting your data..."):
                 try:
-                    # Delete from S3
-                    services['s3'].delete_user_images(user_id)
-                    
-                    # Delete from DynamoDB
-                    services['db'].delete_user_data(user_id)
+                    # Delete from S3 and DynamoDB in parallel
+                    erase_user_data(user_id, services['s3'], services['db'])
+                    st.session_state.history_cursors = [None]
                     
                     st.success("✅ All your caption data has been deleted successfully!")
                     st.balloons()
@@ -1,10 +1,12 @@
 import os
 import json
+import math
 from functools import wraps
-from flask import request, jsonify
+from flask import request, jsonify, g
 import firebase_admin
 from firebase_admin import auth
 import logging
+from backend.rate_limiter import SlidingWindowCounter
 
 class SecurityConfig:
     """Security configuration and utilities"""
@@ -198,6 +200,85 @@ class RateLimitConfig:
     def get_rate_limit(endpoint):
         """Get rate limit for specific endpoint"""
         return RateLimitConfig.RATE_LIMITS.get(endpoint, 60)  # Default 60/min
+        
+    # A client IP may carry this many users' traffic (NAT, offices) before it is limited
+    SHARED_IP_FACTOR = 4
+    
+    # Pixels per unit of caption cost; a thumbnail costs 1, a 12 MP photo 3
+    COST_UNIT_PIXELS = 4000000
+    
+    @staticmethod
+    def image_cost(width, height):
+        """Rate limit units of a caption request on an image of this size"""
+        return max(1, math.ceil(width * height / RateLimitConfig.COST_UNIT_PIXELS))
+
+class RateLimitMiddleware:
+    """Per-endpoint rate limits, counted per user and per client IP over a sliding minute"""
+    
+    def __init__(self, app=None, counter=None):
+        self.counter = counter or SlidingWindowCounter(window_seconds=60)
+        if app is not None:
+            self.init_app(app)
+    
+    def init_app(self, app):
+        """Add rate limit headers to responses of limited endpoints"""
+        app.after_request(self._add_headers)
+    
+    def limit(self, endpoint):
+        """Decorator enforcing RateLimitConfig.RATE_LIMITS[endpoint]; place it below the auth decorator"""
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                limits = self._limits(endpoint)
+                g.rate_limits = limits
+                allowed, retry_after = self.counter.hit(limits)
+                if not allowed:
+                    return self._rejected(retry_after)
+                    
+                return f(*args, **kwargs)
+                
+            return decorated_function
+        return decorator
+    
+    def charge(self, units):
+        """Charge further units once the request's cost is known; returns a 429 response if they do not fit, else None"""
+        limits = g.get('rate_limits')
+        if not limits or units <= 0:
+            return None
+        allowed, retry_after = self.counter.hit(limits, units)
+        if not allowed:
+            return self._rejected(retry_after)
+        return None
+    
+    def _rejected(self, retry_after):
+        """429 response telling the client when a request of the same cost would fit"""
+        response = jsonify(ERROR_RESPONSES['RATE_LIMIT_EXCEEDED'])
+        response.status_code = 429
+        response.headers['Retry-After'] = str(math.ceil(retry_after))
+        return response
+    
+    def _limits(self, endpoint):
+        """(key, limit) pairs a request to the endpoint counts against"""
+        limit = RateLimitConfig.get_rate_limit(endpoint)
+        # Behind a load balancer, wrap the app in werkzeug's ProxyFix so this is the client address
+        client_ip = request.remote_addr or 'unknown'
+        user = getattr(request, 'user', None)
+        if not user:
+            return [(f"{endpoint}:ip:{client_ip}", limit)]
+        return [
+            (f"{endpoint}:user:{user['uid']}", limit),
+            (f"{endpoint}:ip:{client_ip}", limit * RateLimitConfig.SHARED_IP_FACTOR)
+        ]
+    
+    def _add_headers(self, response):
+        """Set RateLimit-Limit, RateLimit-Remaining and RateLimit-Reset (until the full limit is back) of the tightest limit"""
+        limits = g.get('rate_limits')
+        if limits:
+            limit, remaining, reset = self.counter.status(limits)
+            response.headers['RateLimit-Limit'] = str(limit)
+            response.headers['RateLimit-Remaining'] = str(remaining)
+            response.headers['RateLimit-Reset'] = str(reset)
+        return response
 
 # Error response templates
 ERROR_RESPONSES = {
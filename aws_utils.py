@@ -1,9 +1,21 @@
 """Simple AWS utilities for S3 and DynamoDB integration."""
 import boto3
 import uuid
-from datetime import datetime
+import json
+import base64
+import re
+from datetime import datetime, timezone
+from boto3.dynamodb.conditions import Attr, Key
 from botocore.exceptions import ClientError
 
+# Recency index: captions are bucketed by month (sparse tables stay one query
+# per listing) and sorted by timestamp within the bucket
+RECENT_INDEX = 'recent-index'
+RECENT_BUCKET = 'month'
+
+# Month buckets of the tables read so far; captions are never older than their table
+_first_months = {}
+
 # Try to use Streamlit secrets if available (for Streamlit Cloud deployment)
 try:
     import streamlit as st
@@ -80,9 +92,11 @@ def save_caption_to_dynamodb(image_id, caption, image_url, table_name='image_cap
         table = dynamodb.Table(table_name)
         
         # Create item
+        timestamp = datetime.utcnow().isoformat()
         item = {
             'image_id': image_id,
-            'timestamp': datetime.utcnow().isoformat(),
+            'timestamp': timestamp,
+            RECENT_BUCKET: recent_bucket(timestamp),
             'caption_text': caption,
             'image_url': image_url
         }
@@ -98,27 +112,192 @@ def save_caption_to_dynamodb(image_id, caption, image_url, table_name='image_cap
 
 def get_all_captions(table_name='image_captions', limit=50):
     """
-    Retrieve all captions from DynamoDB.
+    Retrieve the most recent captions from DynamoDB.
     
     Args:
         table_name: DynamoDB table name
         limit: Maximum number of items to retrieve
     
     Returns:
-        list: List of caption items
+        list: List of caption items, newest first
+    """
+    items, _ = get_latest_captions(limit, table_name=table_name)
+    return items
+
+
+def get_latest_captions(n=10, cursor=None, table_name='image_captions'):
     """
+    Retrieve the newest captions with a query on the recency index.
+    
+    Month buckets are read newest first, so a page usually costs one query.
+    Reading stops at the month the table was created in.
+    
+    Args:
+        n: Maximum number of items to retrieve
+        cursor: Cursor returned with the previous page (None for the newest)
+        table_name: DynamoDB table name
+        
+    Returns:
+        tuple: (list of caption items newest first, cursor for the next page or None)
+        
+    Raises:
+        ValueError: If the cursor was not returned by this function
+    """
+    if cursor:
+        month, start_key = _decode_cursor(cursor)
+    else:
+        month, start_key = recent_bucket(datetime.utcnow().isoformat()), None
+        
     try:
         table = dynamodb.Table(table_name)
-        response = table.scan(Limit=limit)
+        first_month = _first_month(table)
+        items = []
+        while len(items) < n and month >= first_month:
+            query_params = {
+                'IndexName': RECENT_INDEX,
+                'KeyConditionExpression': Key(RECENT_BUCKET).eq(month),
+                'ScanIndexForward': False,
+                'Limit': n - len(items)
+            }
+            if start_key:
+                query_params['ExclusiveStartKey'] = start_key
+                
+            response = table.query(**query_params)
+            page = response.get('Items', [])
+            items.extend(page)
+            
+            start_key = response.get('LastEvaluatedKey')
+            if not start_key:
+                month = _previous_month(month)
+                
+        if month < first_month:
+            return items, None
+        next_cursor = base64.urlsafe_b64encode(json.dumps({'month': month, 'key': start_key}).encode()).decode()
+        return items, next_cursor
         
-        # Sort by timestamp (newest first)
-        items = response.get('Items', [])
-        items.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
+    except ClientError as e:
+        raise Exception(f"Failed to retrieve from DynamoDB: {str(e)}")
+
+
+def _decode_cursor(cursor):
+    """Month bucket and start key of a get_latest_captions cursor."""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        month, start_key = position['month'], position['key']
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise ValueError("invalid cursor")
+    if not isinstance(month, str) or not re.fullmatch(r'\d{4}-\d{2}', month):
+        raise ValueError("invalid cursor")
+    if start_key is not None and not isinstance(start_key, dict):
+        raise ValueError("invalid cursor")
+    return month, start_key
+
+
+def _first_month(table):
+    """Bucket of the month a table was created in, looked up once per table."""
+    if table.name not in _first_months:
+        _first_months[table.name] = recent_bucket(table.creation_date_time.astimezone(timezone.utc).isoformat())
+    return _first_months[table.name]
+
+
+def recent_bucket(timestamp):
+    """
+    Recency index bucket for an ISO timestamp.
+    
+    Args:
+        timestamp: ISO 8601 timestamp
         
-        return items
+    Returns:
+        str: Bucket value, e.g. '2024-05'
+    """
+    return timestamp[:7]
+
+
+def _previous_month(month):
+    """Bucket of the month before a 'YYYY-MM' bucket."""
+    year, number = int(month[:4]), int(month[5:7])
+    if number == 1:
+        return f"{year - 1}-12"
+    return f"{year}-{number - 1:02d}"
+
+
+def backfill_recent_index(table_name='image_captions'):
+    """
+    Add the recency bucket to captions saved before the index existed.
     
+    Args:
+        table_name: DynamoDB table name
+        
+    Returns:
+        int: Number of items updated
+    """
+    try:
+        table = dynamodb.Table(table_name)
+        scan_params = {
+            'FilterExpression': Attr(RECENT_BUCKET).not_exists() & Attr('timestamp').exists(),
+            'ProjectionExpression': 'image_id, #ts',
+            'ExpressionAttributeNames': {'#ts': 'timestamp'}
+        }
+        updated = 0
+        
+        while True:
+            response = table.scan(**scan_params)
+            for item in response.get('Items', []):
+                table.update_item(
+                    Key={'image_id': item['image_id']},
+                    UpdateExpression='SET #bucket = :bucket',
+                    ExpressionAttributeNames={'#bucket': RECENT_BUCKET},
+                    ExpressionAttributeValues={':bucket': recent_bucket(item['timestamp'])}
+                )
+                updated += 1
+            if 'LastEvaluatedKey' not in response:
+                return updated
+            scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            
     except ClientError as e:
-        raise Exception(f"Failed to retrieve from DynamoDB: {str(e)}")
+        raise Exception(f"Failed to backfill recency index: {str(e)}")
+
+
+def _recent_index_definition():
+    """GSI definition of the recency index."""
+    return {
+        'IndexName': RECENT_INDEX,
+        'KeySchema': [
+            {'AttributeName': RECENT_BUCKET, 'KeyType': 'HASH'},
+            {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
+        ],
+        'Projection': {'ProjectionType': 'ALL'}
+    }
+
+
+def ensure_recent_index(table_name='image_captions'):
+    """
+    Add the recency index to an existing table that does not have it yet.
+    
+    Run backfill_recent_index afterwards so older captions are listed too.
+    
+    Args:
+        table_name: Name of the table
+    """
+    try:
+        dynamodb_client = boto3.client('dynamodb', region_name='eu-north-1')
+        table = dynamodb_client.describe_table(TableName=table_name)['Table']
+        indexes = [index['IndexName'] for index in table.get('GlobalSecondaryIndexes', [])]
+        if RECENT_INDEX in indexes:
+            return
+            
+        dynamodb_client.update_table(
+            TableName=table_name,
+            AttributeDefinitions=[
+                {'AttributeName': RECENT_BUCKET, 'AttributeType': 'S'},
+                {'AttributeName': 'timestamp', 'AttributeType': 'S'}
+            ],
+            GlobalSecondaryIndexUpdates=[{'Create': _recent_index_definition()}]
+        )
+        print(f"✅ Creating recency index on '{table_name}'")
+        
+    except ClientError as e:
+        raise Exception(f"Failed to add recency index: {str(e)}")
 
 
 def create_dynamodb_table_if_not_exists(table_name='image_captions'):
@@ -136,6 +315,7 @@ def create_dynamodb_table_if_not_exists(table_name='image_captions'):
         
         if table_name in existing_tables:
             print(f"✅ Table '{table_name}' already exists")
+            ensure_recent_index(table_name)
             return
         
         # Create table
@@ -151,8 +331,17 @@ def create_dynamodb_table_if_not_exists(table_name='image_captions'):
                 {
                     'AttributeName': 'image_id',
                     'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': RECENT_BUCKET,
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'timestamp',
+                    'AttributeType': 'S'
                 }
             ],
+            GlobalSecondaryIndexes=[_recent_index_definition()],
             BillingMode='PAY_PER_REQUEST'  # On-demand pricing
         )
         
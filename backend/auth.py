@@ -1,8 +1,8 @@
 """Authentication and authorization using AWS Cognito."""
 from typing import Optional, Dict, Any
-import boto3
 from botocore.exceptions import ClientError
 from backend.config import config_manager
+from backend.aws_clients import get_client
 
 
 class AuthManager:
@@ -15,10 +15,7 @@ class AuthManager:
     def _get_client(self):
         """Lazy initialization of Cognito client."""
         if not self.cognito_client:
-            self.cognito_client = boto3.client(
-                'cognito-idp',
-                region_name=self.config.aws_region
-            )
+            self.cognito_client = get_client('cognito-idp', self.config.aws_region)
         return self.cognito_client
     
     def verify_token(self, access_token: str) -> Optional[Dict[str, Any]]:
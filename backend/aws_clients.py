@@ -0,0 +1,183 @@
+"""Shared, tuned boto3 clients and resources."""
+import threading
+from typing import Any, Dict, Iterable, Optional, Tuple
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Connection pool per client; worker pools (deletes, lookups, prefetch) share it
+MAX_POOL_CONNECTIONS = 50
+
+# Timeouts in seconds, and retries with client-side rate adaptation on throttling
+CONNECT_TIMEOUT = 3
+READ_TIMEOUT = 20
+MAX_ATTEMPTS = 5
+RETRY_MODE = 'adaptive'
+
+# Model inference can take far longer than a regular API call
+SERVICE_READ_TIMEOUTS = {
+    'bedrock-runtime': 120,
+    'sagemaker-runtime': 120,
+}
+
+# Clients the caption path otherwise creates lazily on its first request
+DEFAULT_SERVICES = ('dynamodb', 'rekognition', 'bedrock-runtime', 'sagemaker-runtime')
+
+# Cheap read calls that open a pooled connection (DNS, TCP, TLS) before the first
+# request; sagemaker-runtime has no such call, so only its client is built
+WARMUP_CALLS = {
+    'dynamodb': ('describe_endpoints', {}),
+    'rekognition': ('list_collections', {'MaxResults': 1}),
+    'bedrock-runtime': ('list_async_invokes', {'maxResults': 1}),
+}
+
+_clients: Dict[Tuple, Any] = {}
+_lock = threading.Lock()
+
+# Per-thread resources, dropped when clear_clients bumps the generation
+_local = threading.local()
+_generation = 0
+
+
+def client_config(service_name: str) -> Config:
+    """
+    Botocore settings used for a service.
+    
+    Args:
+        service_name: AWS service name, e.g. 's3'
+        
+    Returns:
+        botocore Config
+    """
+    return Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=SERVICE_READ_TIMEOUTS.get(service_name, READ_TIMEOUT),
+        retries={'max_attempts': MAX_ATTEMPTS, 'mode': RETRY_MODE},
+        tcp_keepalive=True
+    )
+
+
+def get_client(service_name: str, region_name: Optional[str] = None, **kwargs):
+    """
+    Get the shared low-level client for a service and region.
+    
+    Clients are thread-safe, so one client (and its connection pool) is
+    reused by every caller asking for the same service, region and options.
+    
+    Args:
+        service_name: AWS service name
+        region_name: AWS region
+        **kwargs: Extra boto3.client arguments, e.g. endpoint_url
+        
+    Returns:
+        boto3 client
+    """
+    return _get_or_create('client', service_name, region_name, kwargs)
+
+
+def get_resource(service_name: str, region_name: Optional[str] = None, **kwargs):
+    """
+    Get the calling thread's resource for a service and region.
+    
+    Resource objects are not thread-safe, so each thread gets its own. They
+    are built on the shared client from get_client, so every thread still
+    uses one connection pool.
+    
+    Args:
+        service_name: AWS service name
+        region_name: AWS region
+        **kwargs: Extra boto3.resource arguments, e.g. endpoint_url
+        
+    Returns:
+        boto3 service resource
+    """
+    if getattr(_local, 'generation', None) != _generation:
+        _local.resources = {}
+        _local.generation = _generation
+        
+    key = (service_name, region_name, tuple(sorted(kwargs.items())))
+    instance = _local.resources.get(key)
+    if instance is None:
+        # One shared resource provides the class, so the service model is loaded once
+        prototype = _get_or_create('resource', service_name, region_name, kwargs)
+        instance = type(prototype)(client=get_client(service_name, region_name, **kwargs))
+        _local.resources[key] = instance
+    return instance
+
+
+class ThreadLocalTable:
+    """
+    DynamoDB Table handle that can be shared between threads.
+    
+    Each attribute is looked up on the calling thread's Table resource.
+    """
+    
+    def __init__(self, table_name: str, region_name: Optional[str] = None, **kwargs):
+        """
+        Initialize the handle.
+        
+        Args:
+            table_name: Table name
+            region_name: AWS region
+            **kwargs: Extra boto3.resource arguments, e.g. endpoint_url
+        """
+        self.name = table_name
+        self._region_name = region_name
+        self._kwargs = kwargs
+    
+    def __getattr__(self, name: str):
+        return getattr(get_resource('dynamodb', self._region_name, **self._kwargs).Table(self.name), name)
+
+
+def prewarm(region_name: Optional[str] = None, services: Iterable[str] = DEFAULT_SERVICES):
+    """
+    Create clients up front and open a connection for each, so the first
+    request does not pay for loading service models, resolving credentials,
+    DNS or the TLS handshake.
+    
+    Args:
+        region_name: AWS region
+        services: Services to create clients for
+    """
+    for service_name in services:
+        try:
+            client = get_client(service_name, region_name)
+            if service_name in WARMUP_CALLS:
+                operation, params = WARMUP_CALLS[service_name]
+                getattr(client, operation)(**params)
+        except ClientError:
+            # A refused call (e.g. missing permission) still leaves a warm connection
+            pass
+        except Exception as e:
+            print(f"Error warming up {service_name} client: {e}")
+
+
+def clear_clients():
+    """Forget all cached clients and resources, e.g. after credentials change."""
+    global _generation
+    with _lock:
+        _clients.clear()
+        _generation += 1
+
+
+def _get_or_create(kind: str, service_name: str, region_name: Optional[str], kwargs: Dict[str, Any]):
+    """Look up a cached client or resource, creating it once under the lock."""
+    key = (kind, service_name, region_name, tuple(sorted(kwargs.items())))
+    instance = _clients.get(key)
+    if instance is not None:
+        return instance
+        
+    # The default boto3 session is not thread-safe, so creation is serialized
+    with _lock:
+        instance = _clients.get(key)
+        if instance is None:
+            factory = boto3.client if kind == 'client' else boto3.resource
+            instance = factory(
+                service_name,
+                region_name=region_name,
+                config=client_config(service_name),
+                **kwargs
+            )
+            _clients[key] = instance
+        return instance
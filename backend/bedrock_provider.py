@@ -4,10 +4,10 @@ import json
 import base64
 from typing import Tuple, List, Optional
 from PIL import Image
-import boto3
 from botocore.exceptions import ClientError
 from backend.caption_base import CaptionProvider
 from backend.config import config_manager
+from backend.aws_clients import get_client
 
 
 class BedrockProvider(CaptionProvider):
@@ -20,10 +20,7 @@ class BedrockProvider(CaptionProvider):
     def _get_client(self):
         """Lazy initialization of Bedrock client."""
         if not self.client:
-            self.client = boto3.client(
-                'bedrock-runtime',
-                region_name=self.config.aws_region
-            )
+            self.client = get_client('bedrock-runtime', self.config.aws_region)
         return self.client
     
     def is_available(self) -> bool:
@@ -0,0 +1,204 @@
+"""Read-through cache for user history pages."""
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+from backend.models import HistoryItem
+
+HistoryPage = Tuple[List[HistoryItem], Optional[Dict[str, Any]]]
+
+
+class HistoryCache:
+    """
+    Per-user, per-page history cache with a TTL and an entry bound.
+    
+    Entries live in a local LRU. When a Redis URL is given, pages are also
+    shared between processes, and a per-user generation counter in Redis
+    makes invalidation visible to every process at once.
+    
+    Callers take generation() before reading a page from the table and pass
+    it to put, so a page read while the user's history changed is never
+    cached under the new generation.
+    """
+    
+    def __init__(self, ttl_seconds: int = 60, max_entries: int = 1024, redis_url: Optional[str] = None):
+        """
+        Initialize the cache.
+        
+        Args:
+            ttl_seconds: How long a page may be served from cache
+            max_entries: Maximum pages kept in process memory
+            redis_url: Optional Redis URL for the shared tier
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.redis_url = redis_url
+        self.redis_client = None
+        self._entries: "OrderedDict[Tuple, Tuple[float, HistoryPage]]" = OrderedDict()
+        # Bumped by every invalidation; local pages read before one are not stored
+        self._invalidations = 0
+        self._lock = Lock()
+    
+    def _get_redis_client(self):
+        """Lazy initialization of the shared tier client."""
+        if not self.redis_client:
+            # Optional dependency, only needed for the shared tier
+            import redis
+            self.redis_client = redis.Redis.from_url(self.redis_url, socket_timeout=0.5)
+        return self.redis_client
+    
+    def get(self, user_id: str, limit: int, cursor: Optional[Dict[str, Any]]) -> Optional[HistoryPage]:
+        """
+        Look up a cached page.
+        
+        Args:
+            user_id: User ID
+            limit: Page size
+            cursor: Pagination key the page starts after
+            
+        Returns:
+            Tuple of (items, next key), or None on a miss
+        """
+        generation = self.generation(user_id)
+        if generation is None:
+            return None
+        key = (user_id, generation[0], limit, self._cursor_token(cursor))
+        now = time.monotonic()
+        
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                items, next_key = entry[1]
+                return list(items), next_key
+                
+        if not self.redis_url:
+            return None
+        try:
+            raw = self._get_redis_client().get(self._redis_key(key))
+        except Exception as e:
+            print(f"Error reading shared history cache: {e}")
+            return None
+        if raw is None:
+            return None
+            
+        data = json.loads(raw)
+        page = ([HistoryItem.from_item(item) for item in data['items']], data['next_key'])
+        self._store(key, page, generation[1])
+        return list(page[0]), page[1]
+    
+    def put(
+        self,
+        user_id: str,
+        limit: int,
+        cursor: Optional[Dict[str, Any]],
+        items: List[HistoryItem],
+        next_key: Optional[Dict[str, Any]],
+        generation: Optional[Tuple[int, int]]
+    ):
+        """
+        Cache a page read from the table.
+        
+        Args:
+            user_id: User ID
+            limit: Page size
+            cursor: Pagination key the page starts after
+            items: Page items
+            next_key: Pagination key for the following page
+            generation: Result of generation() taken before the page was read
+        """
+        if generation is None:
+            return
+        shared_generation, invalidations = generation
+        key = (user_id, shared_generation, limit, self._cursor_token(cursor))
+        if not self._store(key, (list(items), next_key), invalidations):
+            return
+            
+        if not self.redis_url:
+            return
+        try:
+            payload = json.dumps({'items': [item.to_item() for item in items], 'next_key': next_key}, default=str)
+            self._get_redis_client().set(self._redis_key(key), payload, ex=self.ttl_seconds)
+        except Exception as e:
+            print(f"Error writing shared history cache: {e}")
+    
+    def invalidate_user(self, user_id: str):
+        """
+        Drop every cached page for a user after their history changed.
+        
+        Args:
+            user_id: User ID
+        """
+        with self._lock:
+            self._invalidations += 1
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+                
+        if not self.redis_url:
+            return
+        try:
+            # Orphans the user's shared pages; they expire with their TTL
+            client = self._get_redis_client()
+            client.incr(f"history:gen:{user_id}")
+            client.expire(f"history:gen:{user_id}", max(self.ttl_seconds * 2, 3600))
+        except Exception as e:
+            print(f"Error invalidating shared history cache: {e}")
+    
+    def clear(self):
+        """Drop all locally cached pages."""
+        with self._lock:
+            self._entries.clear()
+    
+    def generation(self, user_id: str) -> Optional[Tuple[int, int]]:
+        """
+        Invalidation generation to pass to put for a page about to be read.
+        
+        Args:
+            user_id: User ID
+            
+        Returns:
+            Opaque generation, or None if pages must not be cached
+        """
+        shared_generation = self._generation(user_id)
+        if shared_generation is None:
+            return None
+        with self._lock:
+            return shared_generation, self._invalidations
+    
+    def _store(self, key: Tuple, page: HistoryPage, invalidations: int) -> bool:
+        """
+        Insert into the local LRU, evicting the oldest entries past the bound.
+        
+        Returns:
+            False if an invalidation happened since the page was read
+        """
+        with self._lock:
+            if invalidations != self._invalidations:
+                return False
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, page)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return True
+    
+    def _generation(self, user_id: str) -> Optional[int]:
+        """Current invalidation generation for a user, or None if it cannot be read."""
+        if not self.redis_url:
+            return 0
+        try:
+            value = self._get_redis_client().get(f"history:gen:{user_id}")
+            return int(value) if value else 0
+        except Exception as e:
+            # Without the generation, cached pages might be stale
+            print(f"Error reading shared history cache: {e}")
+            return None
+    
+    def _cursor_token(self, cursor: Optional[Dict[str, Any]]) -> str:
+        """Stable string form of a pagination key."""
+        return json.dumps(cursor, sort_keys=True, default=str) if cursor else ''
+    
+    def _redis_key(self, key: Tuple) -> str:
+        """Shared tier key for a page."""
+        user_id, generation, limit, cursor = key
+        return f"history:{user_id}:{generation}:{limit}:{cursor}"
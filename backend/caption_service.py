@@ -2,9 +2,9 @@
 import io
 from typing import Tuple, List, Optional
 from PIL import Image
-import boto3
 from botocore.exceptions import ClientError
 from backend.config import config_manager
+from backend.aws_clients import get_client
 from backend.models import CaptionProvider as ProviderEnum
 from backend.bedrock_provider import BedrockProvider
 from backend.sagemaker_provider import SageMakerProvider
@@ -28,10 +28,7 @@ class CaptionService:
     def _get_rekognition_client(self):
         """Lazy initialization of Rekognition client."""
         if not self.rekognition_client:
-            self.rekognition_client = boto3.client(
-                'rekognition',
-                region_name=self.config.aws_region
-            )
+            self.rekognition_client = get_client('rekognition', self.config.aws_region)
         return self.rekognition_client
     
     def detect_labels(self, image_bytes: bytes) -> List[str]:
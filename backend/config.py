@@ -1,9 +1,9 @@
 """Configuration management using environment variables and AWS Secrets Manager."""
 import os
 import json
-import boto3
 from typing import Optional, Dict, Any
 from backend.models import AppConfig, CaptionProvider
+from backend.aws_clients import get_client
 
 
 class ConfigManager:
@@ -35,6 +35,28 @@ class ConfigManager:
             "thumbnail_size": int(os.getenv("THUMBNAIL_SIZE", "300")),
             "presigned_url_expiry": int(os.getenv("PRESIGNED_URL_EXPIRY", "3600")),
             "retention_days": int(os.getenv("RETENTION_DAYS", "90")),
+            "content_addressed_storage": os.getenv("CONTENT_ADDRESSED_STORAGE", "false").lower() == "true",
+            "async_thumbnails": os.getenv("ASYNC_THUMBNAILS", "false").lower() == "true",
+            "derivative_queue_url": os.getenv("DERIVATIVE_QUEUE_URL"),
+            "storage_backend": os.getenv("STORAGE_BACKEND", "s3"),
+            "direct_uploads": os.getenv("DIRECT_UPLOADS", "false").lower() == "true",
+            "local_storage_path": os.getenv("LOCAL_STORAGE_PATH", ".storage"),
+            "gcs_credentials_path": os.getenv("GOOGLE_CLOUD_SERVICE_ACCOUNT_PATH"),
+            "max_image_pixels": int(os.getenv("MAX_IMAGE_PIXELS", "40000000")),
+            "max_image_frames": int(os.getenv("MAX_IMAGE_FRAMES", "100")),
+            "max_concurrent_decodes": int(os.getenv("MAX_CONCURRENT_DECODES", "4")),
+            "history_cache_ttl": int(os.getenv("HISTORY_CACHE_TTL", "60")),
+            "history_cache_max_entries": int(os.getenv("HISTORY_CACHE_MAX_ENTRIES", "1024")),
+            "cache_redis_url": os.getenv("CACHE_REDIS_URL"),
+            "caption_write_behind": os.getenv("CAPTION_WRITE_BEHIND", "false").lower() == "true",
+            "caption_flush_interval": float(os.getenv("CAPTION_FLUSH_INTERVAL", "1.0")),
+            "cursor_secret": os.getenv("CURSOR_SECRET"),
+            "prewarm_aws_clients": os.getenv("PREWARM_AWS_CLIENTS", "false").lower() == "true",
+            "dynamodb_fast_codec": os.getenv("DYNAMODB_FAST_CODEC", "false").lower() == "true",
+            "idempotency_ttl_seconds": int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400")),
+            "rate_limit_backend": os.getenv("RATE_LIMIT_BACKEND", "memory").lower(),
+            "rate_limit_redis_url": os.getenv("RATE_LIMIT_REDIS_URL"),
+            "rate_limit_max_lease": int(os.getenv("RATE_LIMIT_MAX_LEASE", "8")),
         }
         
         # Load secrets from AWS Secrets Manager if ARN is provided
@@ -52,8 +74,8 @@ class ConfigManager:
     def _load_secrets(self, secret_arn: str, region: str) -> Dict[str, Any]:
         """Load secrets from AWS Secrets Manager."""
         if not self.secrets_client:
-            self.secrets_client = boto3.client('secretsmanager', region_name=region)
-        
+            self.secrets_client = get_client('secretsmanager', region)
+            
         try:
             response = self.secrets_client.get_secret_value(SecretId=secret_arn)
             secret_string = response.get('SecretString')
@@ -0,0 +1,72 @@
+"""Signed, opaque pagination cursors."""
+import base64
+import hashlib
+import hmac
+import json
+import os
+from typing import Any, Dict
+from backend.config import config_manager
+
+# Used when no CURSOR_SECRET is configured; cursors then only work in this process
+_process_secret = os.urandom(32)
+
+
+class InvalidCursorError(ValueError):
+    """Raised when a cursor is malformed, tampered with, or issued to another user."""
+
+
+def encode_cursor(key: Dict[str, Any], user_id: str) -> str:
+    """
+    Encode a DynamoDB pagination key as an opaque token bound to a user.
+    
+    Args:
+        key: LastEvaluatedKey from a query
+        user_id: User the cursor is issued to
+        
+    Returns:
+        URL-safe cursor string
+    """
+    payload = json.dumps(key, sort_keys=True, separators=(',', ':'), default=str).encode()
+    signature = _sign(payload, user_id)
+    return _b64encode(payload) + '.' + _b64encode(signature)
+
+
+def decode_cursor(cursor: str, user_id: str) -> Dict[str, Any]:
+    """
+    Verify a cursor and recover the pagination key.
+    
+    Args:
+        cursor: Token from encode_cursor
+        user_id: User presenting the cursor
+        
+    Returns:
+        ExclusiveStartKey for the next query
+        
+    Raises:
+        InvalidCursorError: If the cursor is invalid for this user
+    """
+    try:
+        encoded_payload, encoded_signature = cursor.split('.')
+        payload = _b64decode(encoded_payload)
+        signature = _b64decode(encoded_signature)
+    except ValueError:
+        raise InvalidCursorError("Malformed cursor")
+        
+    if not hmac.compare_digest(signature, _sign(payload, user_id)):
+        raise InvalidCursorError("Cursor signature does not match")
+    return json.loads(payload)
+
+
+def _sign(payload: bytes, user_id: str) -> bytes:
+    """HMAC of the payload, scoped to the user."""
+    secret = config_manager.config.cursor_secret
+    key = secret.encode() if secret else _process_secret
+    return hmac.new(key, user_id.encode() + b'\0' + payload, hashlib.sha256).digest()
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
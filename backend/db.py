@@ -1,12 +1,113 @@
 """DynamoDB database operations for captions and user history."""
-from typing import List, Optional, Dict, Any
-from datetime import datetime
+import atexit
+import functools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Optional, Dict, Any, Tuple
+from datetime import datetime, timezone
 from decimal import Decimal
-import boto3
 from boto3.dynamodb.conditions import Key, Attr
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 from backend.config import config_manager
-from backend.models import CaptionResult, UserHistory
+from backend.aws_clients import get_client, get_resource
+from backend.dynamo_codec import LowLevelTable
+from backend.models import CaptionResult, UserHistory, HistoryItem, UsageMetrics
+from backend.ids import is_ulid, ulid_for
+from backend.cache import HistoryCache
+from backend.write_behind import CaptionWriteBuffer
+from backend.cursor import decode_cursor, encode_cursor
+from backend.search import caption_tokens, index_key, matches, parse_query, term_prefix
+from backend.facets import LABEL_COUNTS_SK, caption_labels, facet_item, facet_key, label_prefix
+
+# BatchWriteItem accepts at most 25 requests, BatchGetItem 100 keys
+BATCH_WRITE_SIZE = 25
+BATCH_GET_SIZE = 100
+DELETE_WORKERS = 4
+LOOKUP_WORKERS = 8
+
+# Background fetches of the next history page
+PREFETCH_WORKERS = 2
+
+# Search index updates run off the save path; one worker keeps them in order
+INDEX_WORKERS = 1
+INDEX_WRITE_ATTEMPTS = 3
+INDEX_RETRY_DELAY = 0.5
+
+# Backoff for UnprocessedItems (seconds)
+MAX_BATCH_RETRIES = 8
+BATCH_RETRY_BASE_DELAY = 0.05
+BATCH_RETRY_MAX_DELAY = 2.0
+
+# Aggregate usage counters are spread over shards to avoid a hot key
+USAGE_PK = 'METRICS#USAGE'
+USAGE_SHARDS = 10
+USER_STATS_SK = 'STATS'
+
+# Index updates that failed after retries; cleared by migrations.rebuild_search_index
+INDEX_FAILURES_SK = 'INDEX_FAILURES'
+
+# Idempotency records share the user's partition: SK = IDEMPOTENCY#<request key>
+IDEMPOTENCY_PREFIX = 'IDEMPOTENCY#'
+
+# Epoch-seconds attribute DynamoDB TTL deletes items by (enabled in infra/terraform/dynamodb.tf)
+TTL_ATTRIBUTE = 'ttl'
+
+# Attributes rendered on history pages ('timestamp' is a reserved word)
+HISTORY_PROJECTION = 'image_id, user_id, concise_caption, creative_caption, thumbnail_url, labels, #ts'
+SEARCH_PROJECTION = HISTORY_PROJECTION + ', SK'
+
+logger = logging.getLogger(__name__)
+
+
+def image_sort_key(image_id: str, timestamp: datetime) -> str:
+    """
+    Build the time-ordered sort key for a caption item.
+    
+    ULID image IDs already sort by creation time; other (legacy UUID) IDs
+    get a deterministic ULID derived from the caption timestamp.
+    
+    Args:
+        image_id: Image ID
+        timestamp: Caption timestamp
+        
+    Returns:
+        Sort key value
+    """
+    sort_id = image_id if is_ulid(image_id) else ulid_for(timestamp, image_id)
+    return f"IMAGE#{sort_id}"
+
+
+def expiry_time(timestamp: datetime, retention_days: int) -> Optional[int]:
+    """
+    TTL value for an item created at a given time.
+    
+    Args:
+        timestamp: Creation time (naive datetimes are UTC)
+        retention_days: Days to keep the item; 0 or less keeps it forever
+        
+    Returns:
+        Expiry as epoch seconds, or None if the item does not expire
+    """
+    if retention_days <= 0:
+        return None
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp()) + retention_days * 86400
+
+
+def is_expired(item: Dict[str, Any], now: int) -> bool:
+    """Whether an item is past its TTL but not yet deleted by DynamoDB (which runs up to a few days late)."""
+    return TTL_ATTRIBUTE in item and int(item[TTL_ATTRIBUTE]) <= now
+
+
+def _log_prefetch_error(future):
+    """Report a failed history prefetch; the page is simply fetched on demand."""
+    error = future.exception()
+    if error:
+        print(f"Error prefetching history: {error}")
 
 
 class DynamoDBManager:
@@ -14,39 +115,92 @@ class DynamoDBManager:
     
     def __init__(self):
         self.config = config_manager.config
-        self.dynamodb = boto3.resource('dynamodb', region_name=self.config.aws_region)
-        self.table = self.dynamodb.Table(self.config.dynamodb_table)
+        # Resources are not thread-safe and the manager is shared between sessions
+        self._dynamodb = None
+        self._table = None
+        self.history_cache = None
+        if self.config.history_cache_ttl > 0:
+            self.history_cache = HistoryCache(
+                ttl_seconds=self.config.history_cache_ttl,
+                max_entries=self.config.history_cache_max_entries,
+                redis_url=self.config.cache_redis_url
+            )
+        self.write_buffer = None
+        if self.config.caption_write_behind:
+            self.write_buffer = CaptionWriteBuffer(self, flush_interval=self.config.caption_flush_interval)
+            # Write buffered captions on interpreter shutdown
+            atexit.register(self.write_buffer.stop)
+        self._prefetch_executor = None
+        self._prefetch_lock = threading.Lock()
+        self._index_executor = None
+        self._index_futures = set()
+        self._index_lock = threading.Lock()
+        # Index updates given up on by this process
+        self.index_failures = 0
+        self.fast_table = None
+        if self.config.dynamodb_fast_codec:
+            # Skips the resource layer's TypeSerializer/Decimal conversion on hot paths
+            self.fast_table = LowLevelTable(get_client('dynamodb', self.config.aws_region), self.table.name)
+    
+    @property
+    def dynamodb(self):
+        """The calling thread's DynamoDB resource, unless one was assigned."""
+        if self._dynamodb is not None:
+            return self._dynamodb
+        return get_resource('dynamodb', self.config.aws_region)
     
-    def save_caption(self, caption_result: CaptionResult) -> bool:
+    @dynamodb.setter
+    def dynamodb(self, resource):
+        self._dynamodb = resource
+    
+    @property
+    def table(self):
+        """The calling thread's captions table, unless one was assigned."""
+        if self._table is not None:
+            return self._table
+        return self.dynamodb.Table(self.config.dynamodb_table)
+    
+    @table.setter
+    def table(self, table):
+        self._table = table
+    
+    def save_caption(
+        self,
+        caption_result: CaptionResult,
+        file_size: int = 0,
+        processing_time: Optional[float] = None,
+        sync: bool = False
+    ) -> bool:
         """
-        Save caption result to DynamoDB.
+        Save caption result to DynamoDB and update the usage counters.
+        
+        With write-behind enabled the caption is buffered and written in a
+        batch shortly after, unless sync is set.
         
         Args:
             caption_result: CaptionResult to save
+            file_size: Stored image size in bytes
+            processing_time: Caption generation time in seconds
+            sync: Write immediately even when write-behind is enabled
             
         Returns:
-            True if successful
+            True if successful (or buffered)
         """
+        if self.write_buffer and not sync:
+            self.write_buffer.add(caption_result, file_size, processing_time)
+            return True
+            
         try:
-            item = {
-                'PK': f"USER#{caption_result.user_id}",
-                'SK': f"IMAGE#{caption_result.image_id}",
-                'image_id': caption_result.image_id,
-                'user_id': caption_result.user_id,
-                'concise_caption': caption_result.concise_caption,
-                'creative_caption': caption_result.creative_caption,
-                'labels': caption_result.labels or [],
-                'model': caption_result.model,
-                'provider': caption_result.provider.value,
-                'confidence': Decimal(str(caption_result.confidence)) if caption_result.confidence else None,
-                'timestamp': caption_result.timestamp.isoformat(),
-                's3_url': caption_result.s3_url,
-                'thumbnail_url': caption_result.thumbnail_url,
-                'GSI1PK': f"IMAGE#{caption_result.image_id}",  # For querying by image_id
-                'GSI1SK': caption_result.timestamp.isoformat()
-            }
+            item = self._caption_item(caption_result, file_size)
+            response = self._hot_table().put_item(Item=item, ReturnValues='ALL_OLD')
+            self._invalidate_history(caption_result.user_id)
+            self._update_indexes(response.get('Attributes'), item)
             
-            self.table.put_item(Item=item)
+            # Overwriting an existing caption does not change the aggregates
+            if not response.get('Attributes'):
+                self._record_usage([
+                    (caption_result.user_id, caption_result.provider.value, file_size, processing_time)
+                ])
             return True
         except ClientError as e:
             print(f"Error saving caption: {e}")
@@ -69,37 +223,77 @@ class DynamoDBManager:
         Returns:
             Tuple of (list of UserHistory, pagination token)
         """
-        try:
-            query_params = {
-                'KeyConditionExpression': Key('PK').eq(f"USER#{user_id}") & Key('SK').begins_with('IMAGE#'),
-                'Limit': limit,
-                'ScanIndexForward': False  # Sort descending by SK (timestamp)
-            }
-            
-            if last_evaluated_key:
-                query_params['ExclusiveStartKey'] = last_evaluated_key
-            
-            response = self.table.query(**query_params)
-            
-            history = []
-            for item in response.get('Items', []):
-                history.append(UserHistory(
-                    image_id=item['image_id'],
-                    user_id=item['user_id'],
-                    concise_caption=item['concise_caption'],
-                    creative_caption=item['creative_caption'],
-                    thumbnail_url=item['thumbnail_url'],
-                    timestamp=datetime.fromisoformat(item['timestamp']),
-                    labels=item.get('labels')
-                ))
+        items, next_key = self.get_history_items(user_id, limit, last_evaluated_key)
+        return [item.to_user_history() for item in items], next_key
+    
+    def get_history_items(
+        self,
+        user_id: str,
+        limit: int = 50,
+        last_evaluated_key: Optional[Dict[str, Any]] = None
+    ) -> tuple[List[HistoryItem], Optional[Dict[str, Any]]]:
+        """
+        Get a page of history as lightweight items for rendering.
+        
+        Only the displayed attributes are fetched, and items skip pydantic
+        validation, which keeps the history page cheap to decode. Pages are
+        served from the history cache when possible.
+        
+        Args:
+            user_id: User ID
+            limit: Maximum number of items to return
+            last_evaluated_key: Pagination token from previous query
             
-            next_key = response.get('LastEvaluatedKey')
-            return history, next_key
+        Returns:
+            Tuple of (list of HistoryItem, pagination token)
+        """
+        # Read your own writes: buffered captions are written before reading
+        if self.write_buffer and self.write_buffer.has_pending(user_id):
+            self.write_buffer.flush()
             
+        if self.history_cache:
+            cached = self.history_cache.get(user_id, limit, last_evaluated_key)
+            if cached is not None:
+                return cached
+                
+        try:
+            return self._query_history(self._hot_table().query, user_id, limit, last_evaluated_key)
         except ClientError as e:
             print(f"Error getting user history: {e}")
             return [], None
     
+    def get_history_page(
+        self,
+        user_id: str,
+        page_size: int = 20,
+        cursor: Optional[str] = None
+    ) -> Tuple[List[HistoryItem], Optional[str]]:
+        """
+        Get a page of history addressed by an opaque cursor.
+        
+        The cursor is signed and bound to the user, so clients cannot forge
+        start keys or page through another user's history. When the history
+        cache is enabled the following page is fetched in the background.
+        
+        Args:
+            user_id: User ID
+            page_size: Maximum number of items to return
+            cursor: Cursor returned with the previous page, None for the first
+            
+        Returns:
+            Tuple of (list of HistoryItem, cursor for the next page or None)
+            
+        Raises:
+            InvalidCursorError: If the cursor was not issued to this user
+        """
+        start_key = decode_cursor(cursor, user_id) if cursor else None
+        items, next_key = self.get_history_items(user_id, page_size, start_key)
+        if not next_key:
+            return items, None
+            
+        self._prefetch_history(user_id, page_size, next_key)
+        return items, encode_cursor(next_key, user_id)
+    
     def get_caption_by_image_id(self, image_id: str) -> Optional[CaptionResult]:
         """
         Get caption by image ID.
@@ -111,95 +305,779 @@ class DynamoDBManager:
             CaptionResult if found, None otherwise
         """
         try:
-            # Query using GSI1
-            response = self.table.query(
-                IndexName='GSI1',
-                KeyConditionExpression=Key('GSI1PK').eq(f"IMAGE#{image_id}"),
-                Limit=1
-            )
-            
-            items = response.get('Items', [])
-            if not items:
-                return None
-            
-            item = items[0]
-            return CaptionResult(
-                image_id=item['image_id'],
-                user_id=item['user_id'],
-                concise_caption=item['concise_caption'],
-                creative_caption=item['creative_caption'],
-                labels=item.get('labels'),
-                model=item['model'],
-                provider=item['provider'],
-                confidence=float(item['confidence']) if item.get('confidence') else None,
-                timestamp=datetime.fromisoformat(item['timestamp']),
-                s3_url=item['s3_url'],
-                thumbnail_url=item['thumbnail_url']
-            )
+            item = self._query_image_index(self.dynamodb.meta.client, image_id)
+            return self._caption_from_item(item) if item else None
         except ClientError as e:
             print(f"Error getting caption: {e}")
             return None
     
-    def delete_user_data(self, user_id: str) -> int:
+    def get_captions_by_image_ids(
+        self,
+        image_ids: List[str],
+        user_id: Optional[str] = None
+    ) -> List[Optional[CaptionResult]]:
         """
-        Delete all data for a user.
+        Get captions for many images at once.
+        
+        When the owning user is known, ULID image IDs map straight to primary
+        keys and are fetched with BatchGetItem, 100 keys per request. Other
+        IDs are looked up on GSI1 with parallel queries.
+        
+        Args:
+            image_ids: Image IDs
+            user_id: Owner of the images, if known; restricts results to this user
+            
+        Returns:
+            CaptionResult (or None if not found or expired) for each ID, in input order
+        """
+        unique_ids = list(dict.fromkeys(image_ids))
+        client = self.dynamodb.meta.client
+        found: Dict[str, Dict[str, Any]] = {}
+        
+        if user_id:
+            direct_ids = [image_id for image_id in unique_ids if is_ulid(image_id)]
+            index_ids = [image_id for image_id in unique_ids if not is_ulid(image_id)]
+        else:
+            direct_ids, index_ids = [], unique_ids
+            
+        try:
+            with ThreadPoolExecutor(max_workers=LOOKUP_WORKERS) as executor:
+                batches = [
+                    executor.submit(self._batch_get, client, [
+                        {'PK': f"USER#{user_id}", 'SK': f"IMAGE#{image_id}"}
+                        for image_id in direct_ids[i:i + BATCH_GET_SIZE]
+                    ])
+                    for i in range(0, len(direct_ids), BATCH_GET_SIZE)
+                ]
+                queries = {
+                    image_id: executor.submit(self._query_image_index, client, image_id)
+                    for image_id in index_ids
+                }
+                
+                for batch in batches:
+                    for item in batch.result():
+                        found[item['image_id']] = item
+                for image_id, query in queries.items():
+                    item = query.result()
+                    if item and (not user_id or item['user_id'] == user_id):
+                        found[image_id] = item
+        except ClientError as e:
+            print(f"Error getting captions: {e}")
+            
+        # Expired captions are hidden like on history pages
+        now = int(time.time())
+        captions = {
+            image_id: self._caption_from_item(item)
+            for image_id, item in found.items() if not is_expired(item, now)
+        }
+        return [captions.get(image_id) for image_id in image_ids]
+    
+    def search_history(self, user_id: str, query: str, limit: int = 20) -> List[HistoryItem]:
+        """
+        Search a user's captions and labels.
+        
+        Every word must match (AND); a trailing '*' matches a word prefix.
+        Each term is one keys-only query on the user's token index entries,
+        so the cost depends on the number of matches, not the history size.
         
         Args:
             user_id: User ID
+            query: Search text, e.g. "beach dog*"
+            limit: Maximum number of results
             
         Returns:
-            Number of items deleted
+            Matching history items, newest first
         """
+        terms = parse_query(query)
+        if not terms:
+            return []
+        if self.write_buffer and self.write_buffer.has_pending(user_id):
+            self.write_buffer.flush()
+        self._wait_for_index()
+        
+        client = self.dynamodb.meta.client
+        results: List[HistoryItem] = []
         try:
-            # Query all items for user
-            response = self.table.query(
-                KeyConditionExpression=Key('PK').eq(f"USER#{user_id}")
-            )
+            with ThreadPoolExecutor(max_workers=min(len(terms), LOOKUP_WORKERS)) as executor:
+                matched = list(executor.map(lambda term: self._search_term(client, user_id, term), terms))
+            sort_ids = sorted(set.intersection(*matched), reverse=True)
+            
+            # Captions are re-checked, so entries left behind by an overwrite never match
+            for i in range(0, len(sort_ids), BATCH_GET_SIZE):
+                keys = [{'PK': f"USER#{user_id}", 'SK': f"IMAGE#{sort_id}"} for sort_id in sort_ids[i:i + BATCH_GET_SIZE]]
+                found = {item['SK']: item for item in self._batch_get(client, keys, SEARCH_PROJECTION)}
+                for key in keys:
+                    item = found.get(key['SK'])
+                    if item and matches(caption_tokens(item), terms):
+                        results.append(HistoryItem.from_item(item))
+                        if len(results) == limit:
+                            return results
+        except ClientError as e:
+            print(f"Error searching history: {e}")
+        return results
+    
+    def get_user_history_by_label(
+        self,
+        user_id: str,
+        label: str,
+        limit: int = 50,
+        last_evaluated_key: Optional[Dict[str, Any]] = None
+    ) -> tuple[List[HistoryItem], Optional[Dict[str, Any]]]:
+        """
+        Get a page of a user's history filtered to one detected label.
+        
+        Reads the label's facet entries, newest first.
+        
+        Args:
+            user_id: User ID
+            label: Label as returned by get_label_counts, e.g. "Dog"
+            limit: Maximum number of items to return
+            last_evaluated_key: Pagination token from previous query
+            
+        Returns:
+            Tuple of (list of HistoryItem, pagination token)
+        """
+        if self.write_buffer and self.write_buffer.has_pending(user_id):
+            self.write_buffer.flush()
+        self._wait_for_index()
+        
+        query_params = {
+            'KeyConditionExpression': Key('PK').eq(f"USER#{user_id}") & Key('SK').begins_with(label_prefix(label)),
+            'ProjectionExpression': HISTORY_PROJECTION,
+            # TTL deletes run up to a few days late, so expired captions are filtered out
+            'FilterExpression': Attr(TTL_ATTRIBUTE).not_exists() | Attr(TTL_ATTRIBUTE).gt(int(time.time())),
+            'ExpressionAttributeNames': {'#ts': 'timestamp'},
+            'ScanIndexForward': False
+        }
+        if last_evaluated_key:
+            query_params['ExclusiveStartKey'] = last_evaluated_key
+            
+        try:
+            items, next_key = self._query_filtered(self.table.query, query_params, limit)
+        except ClientError as e:
+            print(f"Error getting history by label: {e}")
+            return [], None
+        return [HistoryItem.from_item(item) for item in items], next_key
+    
+    def get_label_counts(self, user_id: str) -> Dict[str, int]:
+        """
+        Count a user's captions per detected label, for a filter sidebar.
+        
+        Args:
+            user_id: User ID
+            
+        Returns:
+            Label to caption count, most frequent first
+        """
+        self._wait_for_index()
+        try:
+            response = self.table.get_item(Key={'PK': f"USER#{user_id}", 'SK': LABEL_COUNTS_SK})
+        except ClientError as e:
+            print(f"Error getting label counts: {e}")
+            return {}
+            
+        counts = {
+            name: int(value) for name, value in response.get('Item', {}).items()
+            if name not in ('PK', 'SK') and value > 0
+        }
+        return dict(sorted(counts.items(), key=lambda entry: (-entry[1], entry[0])))
+    
+    def delete_caption(self, user_id: str, image_id: str, s3_manager=None) -> bool:
+        """
+        Delete one caption with its index entries and update the usage counters.
+        
+        Args:
+            user_id: Owner of the caption
+            image_id: Image ID
+            s3_manager: S3Manager releasing the caption's content-addressed image, if it has one
             
-            items = response.get('Items', [])
-            deleted = 0
+        Returns:
+            True if a caption was deleted
+        """
+        if self.write_buffer and self.write_buffer.has_pending(user_id):
+            self.write_buffer.flush()
+            
+        try:
+            if is_ulid(image_id):
+                key = {'PK': f"USER#{user_id}", 'SK': f"IMAGE#{image_id}"}
+            else:
+                item = self._query_image_index(self.dynamodb.meta.client, image_id)
+                if not item or item['user_id'] != user_id:
+                    return False
+                key = {'PK': item['PK'], 'SK': item['SK']}
+                
+            old_item = self.table.delete_item(Key=key, ReturnValues='ALL_OLD').get('Attributes')
+        except ClientError as e:
+            print(f"Error deleting caption: {e}")
+            return False
+        finally:
+            self._invalidate_history(user_id)
+            
+        if not old_item:
+            return False
+        self._update_indexes(old_item, None)
+        if s3_manager and old_item.get('content_hash'):
+            s3_manager.release_image(user_id, old_item['content_hash'])
+        if old_item.get('request_key'):
+            # A retry of the original request must caption the image again, not replay this one
+            self._delete_request_record(user_id, old_item['request_key'])
             
-            # Delete items in batches
-            with self.table.batch_writer() as batch:
-                for item in items:
-                    batch.delete_item(
-                        Key={'PK': item['PK'], 'SK': item['SK']}
-                    )
-                    deleted += 1
+        deltas = {
+            'captions': -1,
+            'bytes_stored': -int(old_item.get('file_size', 0)),
+            f"provider_{old_item['provider']}": -1
+        }
+        response = self._update_counters({'PK': f"USER#{user_id}", 'SK': USER_STATS_SK}, deltas)
+        if response and response['Attributes']['captions'] == 0:
+            deltas['users'] = -1
+        self._update_usage_shard(deltas)
+        return True
+    
+    def delete_user_data(self, user_id: str) -> int:
+        """
+        Delete all data for a user.
+        
+        Every page of the user's partition is read (keys only) and deleted
+        with concurrent BatchWriteItem calls while the next page is fetched.
+        The user's contribution is then subtracted from the usage counters.
+        
+        Args:
+            user_id: User ID
             
-            return deleted
+        Returns:
+            Number of items deleted
+        """
+        if self.write_buffer:
+            self.write_buffer.discard(user_id)
+        # Pending index writes would otherwise recreate entries after the delete
+        self._wait_for_index()
+        stats = self._get_user_stats(user_id)
+        client = self.dynamodb.meta.client
+        futures = []
+        
+        try:
+            with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as executor:
+                query_params = {
+                    'KeyConditionExpression': Key('PK').eq(f"USER#{user_id}"),
+                    'ProjectionExpression': 'PK, SK'
+                }
+                
+                while True:
+                    response = self.table.query(**query_params)
+                    keys = [{'PK': item['PK'], 'SK': item['SK']} for item in response.get('Items', [])]
+                    for i in range(0, len(keys), BATCH_WRITE_SIZE):
+                        futures.append(executor.submit(self._batch_delete, client, keys[i:i + BATCH_WRITE_SIZE]))
+                        
+                    if 'LastEvaluatedKey' not in response:
+                        break
+                    query_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
         except ClientError as e:
             print(f"Error deleting user data: {e}")
-            return 0
+        finally:
+            self._invalidate_history(user_id)
+            
+        deleted = 0
+        for future in futures:
+            try:
+                deleted += future.result()
+            except ClientError as e:
+                print(f"Error deleting user data: {e}")
+                
+        if stats and deleted:
+            deltas = {name: -int(value) for name, value in stats.items() if name not in ('PK', 'SK')}
+            # delete_caption already stopped counting a user whose last caption it removed
+            if int(stats.get('captions', 0)) > 0:
+                deltas['users'] = -1
+            self._update_usage_shard(deltas)
+        return deleted
     
-    def get_usage_metrics(self) -> Dict[str, Any]:
+    def get_usage_metrics(self) -> Optional[UsageMetrics]:
         """
         Get usage metrics for admin dashboard.
         
+        Reads the sharded aggregate counter items with a single query
+        instead of scanning the table.
+        
         Returns:
-            Dictionary with usage metrics
+            UsageMetrics, or None on error
         """
         try:
-            # Scan table for metrics (not recommended for large tables - use CloudWatch instead)
-            response = self.table.scan(
-                Select='COUNT'
+            response = self.table.query(
+                KeyConditionExpression=Key('PK').eq(USAGE_PK),
+                ConsistentRead=True
             )
+        except ClientError as e:
+            print(f"Error getting usage metrics: {e}")
+            return None
             
-            total_items = response.get('Count', 0)
+        totals: Dict[str, int] = {}
+        for shard in response.get('Items', []):
+            for name, value in shard.items():
+                if name not in ('PK', 'SK'):
+                    totals[name] = totals.get(name, 0) + int(value)
+                    
+        captions = totals.get('captions', 0)
+        processed = totals.get('processed', 0)
+        errors = totals.get('errors', 0)
+        return UsageMetrics(
+            total_uploads=captions,
+            total_users=totals.get('users', 0),
+            captions_generated=captions,
+            avg_processing_time=totals.get('processing_ms', 0) / processed / 1000 if processed else 0.0,
+            error_rate=errors / (captions + errors) if captions + errors else 0.0,
+            storage_used_gb=totals.get('bytes_stored', 0) / 1024 ** 3,
+            index_failures=totals.get('index_failures', 0),
+            captions_by_provider={
+                name[len('provider_'):]: count for name, count in totals.items() if name.startswith('provider_')
+            }
+        )
+    
+    def record_usage_error(self):
+        """Count a failed caption request towards the error rate."""
+        self._update_usage_shard({'errors': 1})
+    
+    def _hot_table(self):
+        """Table used for history reads and caption writes."""
+        return self.fast_table or self.table
+    
+    def _invalidate_history(self, user_id: str):
+        """Drop cached history pages after a user's items changed."""
+        if self.history_cache:
+            self.history_cache.invalidate_user(user_id)
+    
+    def _query_history(
+        self,
+        query,
+        user_id: str,
+        limit: int,
+        last_evaluated_key: Optional[Dict[str, Any]]
+    ) -> Tuple[List[HistoryItem], Optional[Dict[str, Any]]]:
+        """
+        Query one history page and store it in the history cache.
+        
+        Args:
+            query: Table.query, LowLevelTable.query, or the resource client's
+                query bound to the table
+            user_id: User ID
+            limit: Maximum number of items to return
+            last_evaluated_key: Pagination token from previous query
             
-            # Get unique users (simplified - in production, use a separate counter)
-            users = set()
-            response = self.table.scan(
-                ProjectionExpression='user_id'
-            )
-            for item in response.get('Items', []):
-                users.add(item.get('user_id'))
+        Returns:
+            Tuple of (list of HistoryItem, pagination token)
+        """
+        query_params = {
+            # A string expression works for both the resource and the low-level codec path
+            'KeyConditionExpression': 'PK = :pk AND begins_with(SK, :sk)',
+            'ExpressionAttributeValues': {':pk': f"USER#{user_id}", ':sk': 'IMAGE#', ':now': int(time.time())},
+            'ProjectionExpression': HISTORY_PROJECTION,
+            # TTL deletes run up to a few days late, so expired captions are filtered out
+            'FilterExpression': 'attribute_not_exists(#ttl) OR #ttl > :now',
+            'ExpressionAttributeNames': {'#ts': 'timestamp', '#ttl': TTL_ATTRIBUTE},
+            'ScanIndexForward': False  # SKs are ULIDs, so this is newest first
+        }
+        
+        if last_evaluated_key:
+            query_params['ExclusiveStartKey'] = last_evaluated_key
             
-            return {
-                'total_captions': total_items,
-                'total_users': len(users),
-                'timestamp': datetime.utcnow().isoformat()
-            }
+        # Taken before the read, so a page that races an invalidation is not cached as current
+        generation = self.history_cache.generation(user_id) if self.history_cache else None
+        items, next_key = self._query_filtered(query, query_params, limit)
+        
+        history = [HistoryItem.from_item(item) for item in items]
+        if self.history_cache:
+            self.history_cache.put(user_id, limit, last_evaluated_key, history, next_key, generation)
+        return history, next_key
+    
+    def _query_filtered(
+        self,
+        query,
+        query_params: Dict[str, Any],
+        limit: int
+    ) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """
+        Run a filtered query until it has returned limit items or reached the end.
+        
+        Limit caps the items DynamoDB evaluates, not the ones the filter
+        keeps, so a single query can come back short or empty while more
+        matches follow.
+        
+        Args:
+            query: Query callable; query_params (without Limit) are passed to it
+            query_params: Query arguments, may include ExclusiveStartKey
+            limit: Maximum number of items to return
+            
+        Returns:
+            Tuple of (raw items, pagination token)
+        """
+        items: List[Dict[str, Any]] = []
+        params = dict(query_params)
+        while True:
+            # Never evaluate past the last item returned, so the token resumes right after it
+            params['Limit'] = limit - len(items)
+            response = query(**params)
+            items.extend(response.get('Items', []))
+            next_key = response.get('LastEvaluatedKey')
+            if not next_key or len(items) >= limit:
+                return items, next_key
+            params['ExclusiveStartKey'] = next_key
+    
+    def _prefetch_history(self, user_id: str, limit: int, start_key: Dict[str, Any]):
+        """Warm the history cache with the page starting at start_key."""
+        if not self.history_cache or self.history_cache.get(user_id, limit, start_key) is not None:
+            return
+            
+        with self._prefetch_lock:
+            if self._prefetch_executor is None:
+                self._prefetch_executor = ThreadPoolExecutor(
+                    max_workers=PREFETCH_WORKERS, thread_name_prefix='history-prefetch'
+                )
+                atexit.register(self._prefetch_executor.shutdown, wait=False)
+                
+        if self.fast_table:
+            query = self.fast_table.query
+        else:
+            # Table resources are not thread-safe; the resource's client is
+            query = functools.partial(self.dynamodb.meta.client.query, TableName=self.table.name)
+        future = self._prefetch_executor.submit(self._query_history, query, user_id, limit, start_key)
+        future.add_done_callback(_log_prefetch_error)
+    
+    def _batch_delete(self, client, keys: List[Dict[str, str]]) -> int:
+        """
+        Delete up to 25 items, retrying unprocessed ones with exponential backoff.
+        
+        Args:
+            client: DynamoDB client (thread-safe, unlike the Table resource)
+            keys: Primary keys to delete
+            
+        Returns:
+            Number of items deleted
+        """
+        return self._batch_write(client, [{'DeleteRequest': {'Key': key}} for key in keys])
+    
+    def _batch_write(self, client, requests: List[Dict[str, Any]]) -> int:
+        """
+        Send up to 25 put/delete requests, retrying unprocessed ones with exponential backoff.
+        
+        Args:
+            client: DynamoDB client (thread-safe, unlike the Table resource)
+            requests: PutRequest/DeleteRequest entries
+            
+        Returns:
+            Number of requests applied
+        """
+        request_items = {self.table.name: requests}
+        
+        for attempt in range(MAX_BATCH_RETRIES + 1):
+            response = client.batch_write_item(RequestItems=request_items)
+            request_items = response.get('UnprocessedItems') or {}
+            if not request_items:
+                return len(requests)
+            if attempt < MAX_BATCH_RETRIES:
+                time.sleep(min(BATCH_RETRY_MAX_DELAY, BATCH_RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1))
+                
+        unprocessed = len(request_items.get(self.table.name, []))
+        print(f"Warning: {unprocessed} write requests left unprocessed after {MAX_BATCH_RETRIES} retries")
+        return len(requests) - unprocessed
+    
+    def _index_requests(
+        self,
+        old_item: Optional[Dict[str, Any]],
+        new_item: Optional[Dict[str, Any]]
+    ) -> List[Dict[str, Any]]:
+        """
+        Search and label facet writes that turn a caption's old entries into its new ones.
+        
+        Facet entries carry a copy of the caption, so they are rewritten
+        whenever the caption is.
+        
+        Args:
+            old_item: Caption item before the change, None if it is new
+            new_item: Caption item after the change, None if it was deleted
+            
+        Returns:
+            PutRequest/DeleteRequest entries
+        """
+        item = new_item or old_item
+        if not item:
+            return []
+        user_id = item['user_id']
+        sort_id = item['SK'][len('IMAGE#'):]
+        old_tokens, new_tokens = caption_tokens(old_item), caption_tokens(new_item)
+        
+        # Index entries expire with their caption
+        expiry = {TTL_ATTRIBUTE: new_item[TTL_ATTRIBUTE]} if new_item and TTL_ATTRIBUTE in new_item else {}
+        requests = [
+            {'PutRequest': {'Item': {**index_key(user_id, token, sort_id), **expiry}}}
+            for token in sorted(new_tokens - old_tokens)
+        ]
+        requests += [
+            {'DeleteRequest': {'Key': index_key(user_id, token, sort_id)}}
+            for token in sorted(old_tokens - new_tokens)
+        ]
+        
+        old_labels, new_labels = caption_labels(old_item), caption_labels(new_item)
+        requests += [{'PutRequest': {'Item': facet_item(new_item, label)}} for label in sorted(new_labels)]
+        requests += [
+            {'DeleteRequest': {'Key': facet_key(user_id, label, sort_id)}}
+            for label in sorted(old_labels - new_labels)
+        ]
+        return requests
+    
+    def _update_indexes(self, old_item: Optional[Dict[str, Any]], new_item: Optional[Dict[str, Any]]):
+        """Queue the search and facet changes for one caption on the background worker."""
+        with self._index_lock:
+            if self._index_executor is None:
+                self._index_executor = ThreadPoolExecutor(
+                    max_workers=INDEX_WORKERS, thread_name_prefix='search-index'
+                )
+                # Finish queued index writes on interpreter shutdown
+                atexit.register(self._index_executor.shutdown, wait=True)
+            future = self._index_executor.submit(self._write_indexes, old_item, new_item)
+            self._index_futures.add(future)
+            
+        future.add_done_callback(self._index_done)
+    
+    def _write_indexes(self, old_item: Optional[Dict[str, Any]], new_item: Optional[Dict[str, Any]]):
+        """
+        Apply the search and facet changes for one caption and update its label counts.
+        
+        Entry writes are idempotent puts and deletes, so they are retried as
+        a whole. Updates that still fail are logged and counted, since the
+        indexes then need migrations.rebuild_search_index.
+        """
+        requests = self._index_requests(old_item, new_item)
+        item = new_item or old_item
+        if not item:
+            return
+        client = self.dynamodb.meta.client
+        error = None
+        for attempt in range(INDEX_WRITE_ATTEMPTS):
+            try:
+                applied = sum(
+                    self._batch_write(client, requests[i:i + BATCH_WRITE_SIZE])
+                    for i in range(0, len(requests), BATCH_WRITE_SIZE)
+                )
+                if applied == len(requests):
+                    error = None
+                    break
+                error = f"{len(requests) - applied} entries left unprocessed"
+            except (ClientError, BotoCoreError) as e:
+                error = e
+            if attempt < INDEX_WRITE_ATTEMPTS - 1:
+                time.sleep(INDEX_RETRY_DELAY * 2 ** attempt)
+        if error:
+            self._record_index_failure(item, error)
+            
+        old_labels, new_labels = caption_labels(old_item), caption_labels(new_item)
+        deltas = {label: 1 for label in new_labels - old_labels}
+        deltas.update({label: -1 for label in old_labels - new_labels})
+        if deltas:
+            # Not retried: ADD is not idempotent
+            counts = self._update_counters({'PK': f"USER#{item['user_id']}", 'SK': LABEL_COUNTS_SK}, deltas)
+            if counts is None:
+                self._record_index_failure(item, 'label counts not updated')
+    
+    def _record_index_failure(self, item: Dict[str, Any], error: Any):
+        """Log an index update that was given up on and count it in the usage metrics."""
+        logger.error(
+            f"Search index update failed for {item['SK']} of user {item['user_id']}: {error}; "
+            f"run rebuild_search_index"
+        )
+        with self._index_lock:
+            self.index_failures += 1
+        self._update_counters({'PK': USAGE_PK, 'SK': INDEX_FAILURES_SK}, {'index_failures': 1})
+    
+    def _index_done(self, future):
+        """Forget a finished index update, reporting its error if any."""
+        with self._index_lock:
+            self._index_futures.discard(future)
+        error = future.exception()
+        if error:
+            logger.error(f"Error updating search index: {error}")
+    
+    def _wait_for_index(self):
+        """Block until queued search index updates have been written."""
+        with self._index_lock:
+            pending = list(self._index_futures)
+        wait(pending)
+    
+    def _search_term(self, client, user_id: str, term: Tuple[str, bool]) -> set:
+        """Caption sort IDs whose index entries match a search term."""
+        sort_ids = set()
+        query_params = {
+            'TableName': self.table.name,
+            'KeyConditionExpression': 'PK = :pk AND begins_with(SK, :prefix)',
+            'ExpressionAttributeValues': {':pk': f"USER#{user_id}", ':prefix': term_prefix(term)},
+            'ProjectionExpression': 'SK'
+        }
+        while True:
+            response = client.query(**query_params)
+            sort_ids.update(item['SK'].rsplit('#', 1)[1] for item in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                return sort_ids
+            query_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    
+    def _caption_item(self, caption_result: CaptionResult, file_size: int = 0) -> Dict[str, Any]:
+        """Build the table item for a caption."""
+        item = {
+            'PK': f"USER#{caption_result.user_id}",
+            'SK': image_sort_key(caption_result.image_id, caption_result.timestamp),
+            'image_id': caption_result.image_id,
+            'user_id': caption_result.user_id,
+            'concise_caption': caption_result.concise_caption,
+            'creative_caption': caption_result.creative_caption,
+            'labels': caption_result.labels or [],
+            'model': caption_result.model,
+            'provider': caption_result.provider.value,
+            'confidence': Decimal(str(caption_result.confidence)) if caption_result.confidence else None,
+            'timestamp': caption_result.timestamp.isoformat(),
+            's3_url': caption_result.s3_url,
+            'thumbnail_url': caption_result.thumbnail_url,
+            'GSI1PK': f"IMAGE#{caption_result.image_id}",  # For querying by image_id
+            'GSI1SK': caption_result.timestamp.isoformat()
+        }
+        if file_size:
+            item['file_size'] = file_size
+        if caption_result.content_hash:
+            item['content_hash'] = caption_result.content_hash
+        if caption_result.request_key:
+            item['request_key'] = caption_result.request_key
+        expires = expiry_time(caption_result.timestamp, self.config.retention_days)
+        if expires:
+            item[TTL_ATTRIBUTE] = expires
+        return item
+    
+    def _record_usage(self, captions: List[Tuple[str, str, int, Optional[float]]]):
+        """
+        Add new captions to the per-user and global usage counters.
+        
+        Args:
+            captions: (user_id, provider, file_size, processing_time) per new caption
+        """
+        per_user: Dict[str, Dict[str, int]] = {}
+        deltas: Dict[str, int] = {'captions': 0, 'bytes_stored': 0}
+        for user_id, provider, file_size, processing_time in captions:
+            user_deltas = per_user.setdefault(user_id, {'captions': 0, 'bytes_stored': 0})
+            provider_counter = f"provider_{provider}"
+            for counters in (user_deltas, deltas):
+                counters['captions'] += 1
+                counters['bytes_stored'] += file_size
+                counters[provider_counter] = counters.get(provider_counter, 0) + 1
+            if processing_time is not None:
+                deltas['processing_ms'] = deltas.get('processing_ms', 0) + int(processing_time * 1000)
+                deltas['processed'] = deltas.get('processed', 0) + 1
+                
+        for user_id, user_deltas in per_user.items():
+            # The per-user stats item tells whether these are the user's first captions
+            # and what to subtract when the user's data is deleted
+            response = self._update_counters({'PK': f"USER#{user_id}", 'SK': USER_STATS_SK}, user_deltas)
+            if response and response['Attributes']['captions'] == user_deltas['captions']:
+                deltas['users'] = deltas.get('users', 0) + 1
+                
+        self._update_usage_shard(deltas)
+    
+    def _delete_request_record(self, user_id: str, request_key: str):
+        """Drop the idempotency record that replays a caption."""
+        try:
+            self.table.delete_item(Key={'PK': f"USER#{user_id}", 'SK': f"{IDEMPOTENCY_PREFIX}{request_key}"})
         except ClientError as e:
-            print(f"Error getting usage metrics: {e}")
-            return {}
+            print(f"Error deleting request record: {e}")
+    
+    def _get_user_stats(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Read a user's usage stats item."""
+        try:
+            response = self.table.get_item(
+                Key={'PK': f"USER#{user_id}", 'SK': USER_STATS_SK},
+                ConsistentRead=True
+            )
+            return response.get('Item')
+        except ClientError as e:
+            print(f"Error reading usage stats: {e}")
+            return None
+    
+    def _update_usage_shard(self, deltas: Dict[str, int]):
+        """Atomically add deltas to one randomly chosen counter shard."""
+        self._update_counters({'PK': USAGE_PK, 'SK': f"SHARD#{random.randrange(USAGE_SHARDS)}"}, deltas)
+    
+    def _update_counters(self, key: Dict[str, str], deltas: Dict[str, int]) -> Optional[Dict[str, Any]]:
+        """Atomically ADD deltas to counter attributes of one item, returning the new values."""
+        names = {f"#c{i}": name for i, name in enumerate(deltas)}
+        values = {f":c{i}": value for i, value in enumerate(deltas.values())}
+        try:
+            return self.table.update_item(
+                Key=key,
+                UpdateExpression='ADD ' + ', '.join(f"#c{i} :c{i}" for i in range(len(deltas))),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+                ReturnValues='UPDATED_NEW'
+            )
+        except ClientError as e:
+            print(f"Error updating usage counters: {e}")
+            return None
+    
+    def _caption_from_item(self, item: Dict[str, Any]) -> CaptionResult:
+        """Convert a table item to a CaptionResult."""
+        return CaptionResult(
+            image_id=item['image_id'],
+            user_id=item['user_id'],
+            concise_caption=item['concise_caption'],
+            creative_caption=item['creative_caption'],
+            labels=item.get('labels'),
+            model=item['model'],
+            provider=item['provider'],
+            confidence=float(item['confidence']) if item.get('confidence') else None,
+            timestamp=datetime.fromisoformat(item['timestamp']),
+            s3_url=item['s3_url'],
+            thumbnail_url=item['thumbnail_url'],
+            content_hash=item.get('content_hash'),
+            request_key=item.get('request_key')
+        )
+    
+    def _query_image_index(self, client, image_id: str) -> Optional[Dict[str, Any]]:
+        """Find a caption item by image ID on GSI1."""
+        response = client.query(
+            TableName=self.table.name,
+            IndexName='GSI1',
+            KeyConditionExpression='GSI1PK = :pk',
+            ExpressionAttributeValues={':pk': f"IMAGE#{image_id}"},
+            Limit=1
+        )
+        items = response.get('Items', [])
+        return items[0] if items else None
+    
+    def _batch_get(
+        self,
+        client,
+        keys: List[Dict[str, str]],
+        projection: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Fetch up to 100 items, retrying unprocessed keys with exponential backoff.
+        
+        Args:
+            client: DynamoDB client (thread-safe, unlike the Table resource)
+            keys: Primary keys to fetch
+            projection: Optional ProjectionExpression ('#ts' stands for timestamp)
+            
+        Returns:
+            Items found
+        """
+        items = []
+        request = {'Keys': keys}
+        if projection:
+            request['ProjectionExpression'] = projection
+            request['ExpressionAttributeNames'] = {'#ts': 'timestamp'}
+        request_items = {self.table.name: request}
+        
+        for attempt in range(MAX_BATCH_RETRIES + 1):
+            response = client.batch_get_item(RequestItems=request_items)
+            items.extend(response.get('Responses', {}).get(self.table.name, []))
+            request_items = response.get('UnprocessedKeys') or {}
+            if not request_items:
+                return items
+            if attempt < MAX_BATCH_RETRIES:
+                time.sleep(min(BATCH_RETRY_MAX_DELAY, BATCH_RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1))
+                
+        unprocessed = len(request_items.get(self.table.name, {}).get('Keys', []))
+        print(f"Warning: {unprocessed} keys left unread after {MAX_BATCH_RETRIES} retries")
+        return items
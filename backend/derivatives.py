@@ -0,0 +1,146 @@
+"""Background worker for generating image derivatives such as thumbnails."""
+import json
+import queue
+import threading
+from typing import Callable, Dict, Any, Optional, Set, Tuple
+from botocore.exceptions import ClientError
+from backend.config import config_manager
+from backend.aws_clients import get_client
+
+
+class DerivativeWorker:
+    """Runs derivative jobs off the request path from a local or SQS-backed queue."""
+
+    def __init__(self, handler: Callable[[Dict[str, Any]], None], queue_url: Optional[str] = None):
+        """
+        Initialize the worker.
+
+        Args:
+            handler: Callable that produces the derivative for one job
+            queue_url: Optional SQS queue URL for durable jobs
+        """
+        self.config = config_manager.config
+        self.handler = handler
+        self.queue_url = queue_url
+        self.sqs_client = None
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _get_sqs_client(self):
+        """Lazy initialization of SQS client."""
+        if not self.sqs_client:
+            self.sqs_client = get_client('sqs', self.config.aws_region)
+        return self.sqs_client
+
+    def submit(self, job: Dict[str, Any]):
+        """
+        Queue a derivative job.
+
+        Args:
+            job: Job description; must contain 'target_key'
+        """
+        if self.queue_url:
+            # Any worker may consume a durable job, so completion is not seen here
+            self._get_sqs_client().send_message(
+                QueueUrl=self.queue_url,
+                MessageBody=json.dumps(job)
+            )
+        else:
+            with self._lock:
+                self._pending.add(job['target_key'])
+            self._queue.put(job)
+
+        self.start()
+
+    def is_pending(self, target_key: str) -> bool:
+        """Check whether a local job for this key was submitted here and has not finished."""
+        with self._lock:
+            return target_key in self._pending
+
+    def start(self):
+        """Start the background thread if it is not running."""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='derivative-worker', daemon=True)
+            self._thread.start()
+
+    def drain(self, timeout: Optional[float] = None):
+        """
+        Block until all locally queued jobs are processed.
+
+        Args:
+            timeout: Maximum seconds to wait (None waits forever)
+        """
+        if self.queue_url:
+            return
+
+        done = threading.Event()
+
+        def wait():
+            self._queue.join()
+            done.set()
+
+        threading.Thread(target=wait, daemon=True).start()
+        done.wait(timeout)
+
+    def stop(self, drain: bool = True, timeout: Optional[float] = 30):
+        """
+        Stop the worker, optionally finishing queued jobs first.
+
+        Args:
+            drain: Whether to process locally queued jobs before stopping
+            timeout: Maximum seconds to wait
+        """
+        if drain:
+            self.drain(timeout)
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        """Process jobs until stopped."""
+        while not self._stop.is_set():
+            job, receipt = self._next_job()
+            if job is None:
+                continue
+
+            try:
+                self.handler(job)
+                if receipt:
+                    self._get_sqs_client().delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+            except Exception as e:
+                # SQS redelivers the message after its visibility timeout
+                print(f"Error generating derivative {job.get('target_key')}: {e}")
+            finally:
+                if not receipt:
+                    with self._lock:
+                        self._pending.discard(job['target_key'])
+                    self._queue.task_done()
+
+    def _next_job(self) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """Fetch the next job and its SQS receipt handle, if any."""
+        if not self.queue_url:
+            try:
+                return self._queue.get(timeout=1), None
+            except queue.Empty:
+                return None, None
+
+        try:
+            response = self._get_sqs_client().receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=1,
+                WaitTimeSeconds=10
+            )
+        except ClientError as e:
+            print(f"Error receiving derivative jobs: {e}")
+            self._stop.wait(5)
+            return None, None
+
+        for message in response.get('Messages', []):
+            return json.loads(message['Body']), message['ReceiptHandle']
+        return None, None
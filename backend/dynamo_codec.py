@@ -0,0 +1,156 @@
+"""Direct conversion between plain items and DynamoDB wire-format items."""
+from decimal import Decimal
+from typing import Any, Dict
+from boto3.dynamodb.types import Binary
+
+# Request parameters holding a single item or key, and response fields to decode
+ITEM_PARAMS = ('Item', 'Key', 'ExclusiveStartKey', 'ExpressionAttributeValues')
+ITEM_RESPONSE_FIELDS = ('Item', 'Attributes', 'LastEvaluatedKey')
+
+
+def encode_value(value: Any) -> Dict[str, Any]:
+    """
+    Encode one Python value as an AttributeValue.
+    
+    Accepts the same types as boto3's TypeSerializer, including rejecting
+    floats, but dispatches on the exact type first.
+    
+    Args:
+        value: Value to encode
+        
+    Returns:
+        AttributeValue dict
+        
+    Raises:
+        TypeError: If the type cannot be stored
+    """
+    value_type = type(value)
+    if value_type is str:
+        return {'S': value}
+    if value_type is int or value_type is Decimal:
+        return {'N': str(value)}
+    if value_type is bool:
+        return {'BOOL': value}
+    if value is None:
+        return {'NULL': True}
+    if value_type is list or value_type is tuple:
+        return {'L': [encode_value(element) for element in value]}
+    if value_type is dict:
+        return {'M': {key: encode_value(element) for key, element in value.items()}}
+    return _encode_other(value)
+
+
+def decode_value(attribute: Dict[str, Any]) -> Any:
+    """
+    Decode one AttributeValue.
+    
+    Integral numbers decode to int and other numbers to Decimal; both
+    compare equal to the Decimal that TypeDeserializer returns.
+    
+    Args:
+        attribute: AttributeValue dict
+        
+    Returns:
+        Python value
+    """
+    for tag, value in attribute.items():
+        if tag == 'S':
+            return value
+        return _DECODERS[tag](value)
+    raise TypeError("Empty AttributeValue")
+
+
+def encode_item(item: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Encode a plain item (or key) to wire format."""
+    return {name: encode_value(value) for name, value in item.items()}
+
+
+def decode_item(item: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Decode a wire-format item (or key) to plain values."""
+    return {name: decode_value(value) for name, value in item.items()}
+
+
+class LowLevelTable:
+    """
+    Table-like wrapper over the low-level client that uses this codec.
+    
+    Supports the query, get_item and put_item calls made on hot paths. Unlike
+    Table, it is thread-safe and only accepts string condition expressions.
+    """
+    
+    def __init__(self, client, table_name: str):
+        """
+        Initialize the wrapper.
+        
+        Args:
+            client: Low-level DynamoDB client
+            table_name: Table name
+        """
+        self.client = client
+        self.name = table_name
+    
+    def query(self, **kwargs) -> Dict[str, Any]:
+        """Query with plain-value parameters, returning plain items."""
+        return self._call(self.client.query, kwargs)
+    
+    def get_item(self, **kwargs) -> Dict[str, Any]:
+        """Get one item with a plain key."""
+        return self._call(self.client.get_item, kwargs)
+    
+    def put_item(self, **kwargs) -> Dict[str, Any]:
+        """Put a plain item."""
+        return self._call(self.client.put_item, kwargs)
+    
+    def _call(self, operation, params: Dict[str, Any]) -> Dict[str, Any]:
+        """Encode item parameters, call the operation and decode the response."""
+        for name in ITEM_PARAMS:
+            if name in params:
+                params[name] = encode_item(params[name])
+        response = operation(TableName=self.name, **params)
+        
+        if 'Items' in response:
+            response['Items'] = [decode_item(item) for item in response['Items']]
+        for name in ITEM_RESPONSE_FIELDS:
+            if name in response:
+                response[name] = decode_item(response[name])
+        return response
+
+
+def _encode_other(value: Any) -> Dict[str, Any]:
+    """Encode subclasses (e.g. str enums), binary and set values."""
+    if isinstance(value, str):
+        # str() of a str enum member is its name, not its value
+        return {'S': str.__str__(value)}
+    if isinstance(value, int):
+        return {'N': str(int(value))}
+    if isinstance(value, Decimal):
+        return {'N': str(value)}
+    if isinstance(value, (bytes, bytearray, Binary)):
+        return {'B': bytes(value.value if isinstance(value, Binary) else value)}
+    if isinstance(value, (set, frozenset)) and value:
+        elements = [encode_value(element) for element in value]
+        tag = next(iter(elements[0]))
+        if tag in ('S', 'N', 'B') and all(tag in element for element in elements):
+            return {tag + 'S': [element[tag] for element in elements]}
+    raise TypeError(f"Unsupported type {type(value)!r} for value {value!r}")
+
+
+def _decode_number(value: str) -> Any:
+    """int for integral numbers, Decimal otherwise."""
+    try:
+        return int(value)
+    except ValueError:
+        return Decimal(value)
+
+
+_DECODERS = {
+    'N': _decode_number,
+    'BOOL': lambda value: value,
+    'NULL': lambda value: None,
+    'L': lambda value: [decode_value(element) for element in value],
+    'M': lambda value: {key: decode_value(element) for key, element in value.items()},
+    'B': Binary,
+    'SS': set,
+    'NS': lambda value: {_decode_number(element) for element in value},
+    'BS': lambda value: {Binary(element) for element in value},
+}
@@ -0,0 +1,34 @@
+"""User data erasure across object storage and DynamoDB."""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+from backend.s3_manager import S3Manager
+from backend.db import DynamoDBManager
+
+
+def erase_user_data(
+    user_id: str,
+    s3_manager: Optional[S3Manager] = None,
+    db_manager: Optional[DynamoDBManager] = None
+) -> Dict[str, int]:
+    """
+    Delete a user's stored images and caption items in parallel.
+    
+    Args:
+        user_id: User ID
+        s3_manager: S3Manager to use (created if not given)
+        db_manager: DynamoDBManager to use (created if not given)
+        
+    Returns:
+        Dictionary with the number of objects and items deleted
+    """
+    s3_manager = s3_manager or S3Manager()
+    db_manager = db_manager or DynamoDBManager()
+    
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        objects = executor.submit(s3_manager.delete_user_images, user_id)
+        items = executor.submit(db_manager.delete_user_data, user_id)
+        
+        return {
+            'objects_deleted': objects.result(),
+            'items_deleted': items.result()
+        }
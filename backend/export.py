@@ -0,0 +1,270 @@
+"""Export caption items to JSONL or Parquet files with a parallel segmented scan.
+
+Run with: python -m backend.export <output_dir> [options]
+"""
+import argparse
+import base64
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+from boto3.dynamodb.types import Binary
+from backend.aws_clients import get_client
+from backend.db import DynamoDBManager
+from backend.dynamo_codec import decode_item
+from backend.segmented_scan import CapacityThrottle, ScanCheckpoint, scan_pages
+
+# Output formats and the checkpoint file kept next to the exported files
+FORMATS = ('jsonl', 'parquet')
+CHECKPOINT_FILE = 'export-checkpoint.json'
+
+# Items per scan request; smaller pages spread consumed capacity more evenly
+SCAN_PAGE_SIZE = 500
+
+# Rows per Parquet file: the most rows held in memory per segment
+PARQUET_ROWS_PER_FILE = 50000
+
+# Columns written to Parquet, whose files need one schema; JSONL keeps every attribute
+PARQUET_COLUMNS = (
+    'image_id', 'user_id', 'concise_caption', 'creative_caption', 'labels', 'model', 'provider',
+    'confidence', 'timestamp', 's3_url', 'thumbnail_url', 'file_size'
+)
+
+
+def export_captions(
+    output_dir: str,
+    db_manager: Optional[DynamoDBManager] = None,
+    fmt: str = 'jsonl',
+    segments: int = 4,
+    consistent_read: bool = False,
+    max_read_units: Optional[float] = None,
+    page_size: int = SCAN_PAGE_SIZE
+) -> Dict[str, int]:
+    """
+    Export every caption item with one scan worker per table segment.
+    
+    Each segment streams to its own files and records its scan position in
+    a checkpoint after every write, so memory stays bounded and an
+    interrupted export resumes where it stopped when run again with the
+    same output directory. Rows written after the last checkpoint are
+    discarded on resume, so no row is exported twice.
+    
+    Args:
+        output_dir: Directory for the exported files and the checkpoint
+        db_manager: DynamoDBManager whose table is exported (default: new manager)
+        fmt: 'jsonl' or 'parquet' (requires pyarrow)
+        segments: Number of parallel scan segments
+        consistent_read: Use strongly consistent reads (twice the capacity)
+        max_read_units: Optional target of consumed read capacity units per second
+        page_size: Items per scan request
+        
+    Returns:
+        Counts of rows exported, pages read and capacity units consumed
+        
+    Raises:
+        ValueError: If the format is unknown or the checkpoint belongs to another table or layout
+        ImportError: If Parquet is requested without pyarrow installed
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    if fmt == 'parquet':
+        import pyarrow  # noqa: F401  (fail before scanning, not in the workers)
+        
+    db_manager = db_manager or DynamoDBManager()
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = ScanCheckpoint(
+        os.path.join(output_dir, CHECKPOINT_FILE),
+        {'table': db_manager.table.name, 'format': fmt, 'segments': segments},
+        {'rows': 0, 'offset': 0, 'part': 0}
+    )
+    throttle = CapacityThrottle(max_read_units) if max_read_units else None
+    
+    # Low-level client: thread-safe, and items skip the resource layer's conversion
+    if db_manager.fast_table:
+        client = db_manager.fast_table.client
+    else:
+        client = get_client('dynamodb', db_manager.config.aws_region)
+    scan_params = {
+        'TableName': db_manager.table.name,
+        'TotalSegments': segments,
+        'ConsistentRead': consistent_read,
+        'ReturnConsumedCapacity': 'TOTAL',
+        'Limit': page_size,
+        'FilterExpression': 'begins_with(SK, :image)',
+        'ExpressionAttributeValues': {':image': {'S': 'IMAGE#'}}
+    }
+    worker = _SegmentExport(client, scan_params, output_dir, fmt, checkpoint, throttle)
+    
+    with ThreadPoolExecutor(max_workers=segments, thread_name_prefix='export') as executor:
+        results = list(executor.map(worker.run, range(segments)))
+        
+    stats = {'rows': checkpoint.total('rows'), 'pages': 0, 'capacity_units': 0}
+    for result in results:
+        stats['pages'] += result['pages']
+        stats['capacity_units'] += result['capacity_units']
+    return stats
+
+
+class _SegmentExport:
+    """Scans one segment at a time into its files."""
+    
+    def __init__(self, client, scan_params, output_dir, fmt, checkpoint, throttle):
+        self.client = client
+        self.scan_params = scan_params
+        self.output_dir = output_dir
+        self.fmt = fmt
+        self.checkpoint = checkpoint
+        self.throttle = throttle
+    
+    def run(self, segment: int) -> Dict[str, int]:
+        """Export one segment, resuming from its checkpoint."""
+        position = self.checkpoint.position(segment)
+        result = {'pages': 0, 'capacity_units': 0}
+        if position.get('done'):
+            return result
+            
+        writer = self._writer(segment, position)
+        pending: List[Dict[str, Any]] = []
+        
+        try:
+            for response in scan_pages(self.client, self.scan_params, segment, position['key']):
+                units = response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+                result['pages'] += 1
+                result['capacity_units'] += units
+                pending.extend(_export_row(decode_item(item)) for item in response.get('Items', []))
+                
+                position['key'] = response.get('LastEvaluatedKey')
+                position['done'] = not position['key']
+                if position['done'] or writer.ready(pending):
+                    writer.write(pending, position)
+                    pending = []
+                    self.checkpoint.save(segment, position)
+                    
+                if self.throttle and not position['done']:
+                    self.throttle.consume(units)
+            return result
+        finally:
+            writer.close()
+    
+    def _writer(self, segment: int, position: Dict[str, Any]):
+        """Open a segment's output, dropping anything written after its checkpoint."""
+        name = f"captions-{segment:04d}-of-{self.scan_params['TotalSegments']:04d}"
+        if self.fmt == 'jsonl':
+            return _JsonlWriter(os.path.join(self.output_dir, f"{name}.jsonl"), position)
+        return _ParquetWriter(os.path.join(self.output_dir, name), position)
+
+
+class _JsonlWriter:
+    """Appends each page to one file; the checkpoint stores the committed length."""
+    
+    def __init__(self, path: str, position: Dict[str, Any]):
+        self.file = open(path, 'a+b')
+        self.file.truncate(position['offset'])
+        self.file.seek(position['offset'])
+    
+    def ready(self, rows: List[Dict[str, Any]]) -> bool:
+        """Every page is written as soon as it is read."""
+        return True
+    
+    def write(self, rows: List[Dict[str, Any]], position: Dict[str, Any]):
+        """Append rows and sync them before the position is checkpointed."""
+        self.file.write(b''.join((json.dumps(row, default=_json_default) + '\n').encode() for row in rows))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        position['offset'] = self.file.tell()
+        position['rows'] += len(rows)
+    
+    def close(self):
+        """Close the file."""
+        self.file.close()
+
+
+class _ParquetWriter:
+    """Writes one Parquet file per batch of rows; the checkpoint stores the next file number."""
+    
+    def __init__(self, prefix: str, position: Dict[str, Any]):
+        self.prefix = prefix
+        # Files numbered from the checkpoint on were never committed
+        part = position['part']
+        while os.path.exists(self._path(part)):
+            os.remove(self._path(part))
+            part += 1
+    
+    def ready(self, rows: List[Dict[str, Any]]) -> bool:
+        """Write once a file's worth of rows is buffered."""
+        return len(rows) >= PARQUET_ROWS_PER_FILE
+    
+    def write(self, rows: List[Dict[str, Any]], position: Dict[str, Any]):
+        """Write rows to the next numbered file."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        if rows:
+            columns = {name: [row.get(name) for row in rows] for name in PARQUET_COLUMNS}
+            columns['labels'] = [labels or [] for labels in columns['labels']]
+            columns['confidence'] = [None if value is None else float(value) for value in columns['confidence']]
+            pq.write_table(pa.table(columns, schema=_parquet_schema()), self._path(position['part']))
+            position['part'] += 1
+        position['rows'] += len(rows)
+    
+    def close(self):
+        """Nothing stays open between files."""
+    
+    def _path(self, part: int) -> str:
+        """Path of a numbered file."""
+        return f"{self.prefix}-{part:06d}.parquet"
+
+
+def _parquet_schema():
+    """Arrow schema of PARQUET_COLUMNS."""
+    import pyarrow as pa
+    
+    return pa.schema([
+        (name, pa.list_(pa.string()) if name == 'labels'
+            else pa.float64() if name == 'confidence'
+            else pa.int64() if name == 'file_size'
+            else pa.string())
+        for name in PARQUET_COLUMNS
+    ])
+
+
+def _export_row(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Caption item without the table's key and index attributes."""
+    return {name: value for name, value in item.items() if name not in ('PK', 'SK', 'GSI1PK', 'GSI1SK')}
+
+
+def _json_default(value: Any) -> Any:
+    """JSON encoding of the non-JSON types items can hold."""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    if isinstance(value, Binary):
+        return base64.b64encode(value.value).decode()
+    raise TypeError(f"Cannot export {type(value)!r}")
+
+
+def main():
+    """Command-line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output_dir')
+    parser.add_argument('--format', choices=FORMATS, default='jsonl')
+    parser.add_argument('--segments', type=int, default=4, help='Parallel scan segments')
+    parser.add_argument('--consistent-read', action='store_true')
+    parser.add_argument('--max-read-units', type=float, help='Target consumed read capacity units per second')
+    parser.add_argument('--page-size', type=int, default=SCAN_PAGE_SIZE)
+    
+    args = parser.parse_args()
+    print(export_captions(
+        args.output_dir,
+        fmt=args.format,
+        segments=args.segments,
+        consistent_read=args.consistent_read,
+        max_read_units=args.max_read_units,
+        page_size=args.page_size
+    ))
+
+
+if __name__ == '__main__':
+    main()
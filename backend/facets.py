@@ -0,0 +1,55 @@
+"""Label facet entries for browsing a user's history by detected label."""
+from typing import Any, Dict, Optional
+
+# Facet entries live in the user's partition: SK = LABEL#<label>#<caption sort id>
+LABEL_PREFIX = 'LABEL#'
+
+# Per-user item holding one counter attribute per label
+LABEL_COUNTS_SK = 'LABELS'
+
+# Caption attributes copied onto facet entries, so a facet page is one query (and entries expire with the caption)
+FACET_ATTRIBUTES = (
+    'image_id', 'user_id', 'concise_caption', 'creative_caption', 'thumbnail_url', 'labels', 'timestamp', 'ttl'
+)
+
+
+def caption_labels(item: Optional[Dict[str, Any]]) -> set:
+    """
+    Labels a caption item is filed under.
+    
+    Args:
+        item: Caption item (or None for a caption that did not exist)
+        
+    Returns:
+        Set of non-empty, stripped labels
+    """
+    if not item:
+        return set()
+    return {label.strip() for label in item.get('labels') or [] if label.strip()}
+
+
+def facet_key(user_id: str, label: str, sort_id: str) -> Dict[str, str]:
+    """Primary key of a caption's facet entry for a label."""
+    return {'PK': f"USER#{user_id}", 'SK': f"{LABEL_PREFIX}{label}#{sort_id}"}
+
+
+def facet_item(item: Dict[str, Any], label: str) -> Dict[str, Any]:
+    """
+    Facet entry for a caption item under one of its labels.
+    
+    Args:
+        item: Caption item
+        label: One of the caption's labels
+        
+    Returns:
+        Facet item with the rendered history attributes
+    """
+    sort_id = item['SK'][len('IMAGE#'):]
+    entry = facet_key(item['user_id'], label, sort_id)
+    entry.update({name: item[name] for name in FACET_ATTRIBUTES if name in item})
+    return entry
+
+
+def label_prefix(label: str) -> str:
+    """Sort key prefix of all facet entries for a label."""
+    return f"{LABEL_PREFIX}{label.strip()}#"
@@ -0,0 +1,154 @@
+"""Idempotent caption requests, claimed and completed with conditional writes."""
+import hashlib
+import json
+import time
+from typing import Any, Callable, Optional, Tuple
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+from backend.config import config_manager
+from backend.aws_clients import ThreadLocalTable
+from backend.db import IDEMPOTENCY_PREFIX, TTL_ATTRIBUTE
+
+# Record states
+IN_PROGRESS = 'IN_PROGRESS'
+COMPLETED = 'COMPLETED'
+
+# Seconds after which the claim of a request that never finished (crashed worker) can be taken over
+IN_PROGRESS_TIMEOUT = 300
+
+
+class RequestInProgressError(Exception):
+    """Another call with the same request key is still running."""
+
+
+def request_key(user_id: str, content: bytes, **params: Any) -> str:
+    """
+    Key identifying a request by user, content and parameters.
+    
+    Args:
+        user_id: Requesting user
+        content: Request payload, e.g. the uploaded image bytes
+        **params: Parameters that change the result, e.g. provider and model
+        
+    Returns:
+        Hex SHA-256 digest
+    """
+    digest = hashlib.sha256()
+    digest.update(user_id.encode())
+    digest.update(b'\0')
+    digest.update(hashlib.sha256(content).digest())
+    digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class IdempotencyStore:
+    """Runs each request once and replays its stored result to repeated calls."""
+    
+    def __init__(self, table=None, ttl_seconds: Optional[int] = None):
+        """
+        Initialize the store.
+        
+        Args:
+            table: DynamoDB Table resource (default: the captions table)
+            ttl_seconds: How long results are replayed (default from config, 0 disables)
+        """
+        config = config_manager.config
+        self.table = table or ThreadLocalTable(config.dynamodb_table, config.aws_region)
+        self.ttl_seconds = config.idempotency_ttl_seconds if ttl_seconds is None else ttl_seconds
+    
+    def run_once(self, user_id: str, key: str, work: Callable[[], Any]) -> Any:
+        """
+        Run work unless a call with the same key already completed.
+        
+        Args:
+            user_id: Requesting user
+            key: Request key (see request_key)
+            work: Produces a JSON-serializable result
+            
+        Returns:
+            The result of work, or the stored result of an earlier call
+            
+        Raises:
+            RequestInProgressError: If an earlier call with the key is still running
+        """
+        if self.ttl_seconds <= 0:
+            return work()
+            
+        claimed, result = self.begin(user_id, key)
+        if not claimed:
+            return result
+        try:
+            result = work()
+        except Exception:
+            # Let a retry do the work again
+            self.release(user_id, key)
+            raise
+        self.complete(user_id, key, result)
+        return result
+    
+    def begin(self, user_id: str, key: str) -> Tuple[bool, Any]:
+        """
+        Claim a request, or look up the result of an earlier call.
+        
+        Args:
+            user_id: Requesting user
+            key: Request key
+            
+        Returns:
+            (True, None) if the caller should do the work, else (False, stored result)
+            
+        Raises:
+            RequestInProgressError: If an earlier call with the key is still running
+        """
+        now = int(time.time())
+        try:
+            # New, expired (TTL deletes run late) or abandoned records can be claimed
+            self.table.put_item(
+                Item={
+                    **self._key(user_id, key),
+                    'status': IN_PROGRESS,
+                    'lease_expires': now + IN_PROGRESS_TIMEOUT,
+                    TTL_ATTRIBUTE: now + self.ttl_seconds
+                },
+                ConditionExpression=(
+                    Attr('PK').not_exists()
+                    | Attr(TTL_ATTRIBUTE).lt(now)
+                    | (Attr('status').eq(IN_PROGRESS) & Attr('lease_expires').lt(now))
+                )
+            )
+            return True, None
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+                
+        record = self.table.get_item(Key=self._key(user_id, key), ConsistentRead=True).get('Item')
+        if record is None:
+            # Released by a failed call in the meantime
+            return self.begin(user_id, key)
+        if record['status'] == COMPLETED:
+            return False, json.loads(record['result'])
+        raise RequestInProgressError(f"Request {key[:12]} is already being processed")
+    
+    def complete(self, user_id: str, key: str, result: Any):
+        """Store the result of a claimed request for replays."""
+        self.table.put_item(Item={
+            **self._key(user_id, key),
+            'status': COMPLETED,
+            'result': json.dumps(result),
+            TTL_ATTRIBUTE: int(time.time()) + self.ttl_seconds
+        })
+    
+    def release(self, user_id: str, key: str):
+        """Drop the claim of a request that failed, unless it completed meanwhile."""
+        try:
+            self.table.delete_item(
+                Key=self._key(user_id, key),
+                ConditionExpression=Attr('status').eq(IN_PROGRESS)
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                print(f"Error releasing request {key[:12]}: {e}")
+    
+    def _key(self, user_id: str, key: str):
+        """Primary key of a request's record."""
+        return {'PK': f"USER#{user_id}", 'SK': f"{IDEMPOTENCY_PREFIX}{key}"}
@@ -0,0 +1,87 @@
+"""Time-ordered identifiers (ULID) so DynamoDB sort keys follow creation time."""
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+# Crockford base32, which sorts in the same order as the encoded integers
+ULID_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+ULID_LENGTH = 26
+
+_lock = threading.Lock()
+_last_ms = -1
+_last_random = 0
+
+
+def new_ulid() -> str:
+    """
+    Generate a ULID: 48-bit millisecond timestamp followed by 80 random bits.
+    
+    IDs generated in the same millisecond by this process stay strictly increasing.
+    
+    Returns:
+        26-character ULID string
+    """
+    global _last_ms, _last_random
+    with _lock:
+        now_ms = int(time.time() * 1000)
+        if now_ms <= _last_ms:
+            now_ms = _last_ms
+            _last_random = (_last_random + 1) & ((1 << 80) - 1)
+        else:
+            _last_ms = now_ms
+            _last_random = int.from_bytes(os.urandom(10), 'big')
+        return _encode(now_ms, _last_random)
+
+
+def ulid_for(timestamp: datetime, seed: str) -> str:
+    """
+    Deterministic ULID for an existing record, used when re-keying legacy items.
+    
+    Args:
+        timestamp: Creation time of the record
+        seed: Stable unique value (e.g. the legacy UUID) for the random part
+        
+    Returns:
+        26-character ULID string
+    """
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    timestamp_ms = int(timestamp.timestamp() * 1000)
+    random_part = int.from_bytes(hashlib.sha256(seed.encode()).digest()[:10], 'big')
+    return _encode(timestamp_ms, random_part)
+
+
+def is_ulid(value: str) -> bool:
+    """Check whether a string is a ULID."""
+    return len(value) == ULID_LENGTH and all(c in ULID_ALPHABET for c in value)
+
+
+def ulid_timestamp(value: str) -> Optional[datetime]:
+    """
+    Extract the creation time from a ULID.
+    
+    Args:
+        value: ULID string
+        
+    Returns:
+        UTC datetime, or None if value is not a ULID
+    """
+    if not is_ulid(value):
+        return None
+    timestamp_ms = 0
+    for c in value[:10]:
+        timestamp_ms = timestamp_ms * 32 + ULID_ALPHABET.index(c)
+    return datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc)
+
+
+def _encode(timestamp_ms: int, random_part: int) -> str:
+    """Encode 128 bits as 26 base32 characters."""
+    value = (timestamp_ms << 80) | random_part
+    chars = []
+    for _ in range(ULID_LENGTH):
+        chars.append(ULID_ALPHABET[value & 0x1F])
+        value >>= 5
+    return ''.join(reversed(chars))
@@ -0,0 +1,269 @@
+"""Header-only image validation and bounded pixel decoding."""
+import io
+import struct
+import threading
+from contextlib import contextmanager
+from typing import NamedTuple, Optional, Iterator, Tuple
+from PIL import Image
+from backend.config import config_manager
+
+
+class ImageValidationError(ValueError):
+    """Raised when an upload is not an acceptable image."""
+
+
+class ImageInfo(NamedTuple):
+    """Image properties read from the file header."""
+    format: str
+    width: int
+    height: int
+    frames: int
+    
+    @property
+    def pixels(self) -> int:
+        """Pixels in one frame."""
+        return self.width * self.height
+
+
+# Formats we can probe without decoding pixel data
+SUPPORTED_FORMATS = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+
+_decode_semaphore: Optional[threading.BoundedSemaphore] = None
+_semaphore_lock = threading.Lock()
+
+
+def sniff_format(data: bytes) -> Optional[str]:
+    """
+    Identify image format from magic bytes.
+    
+    Args:
+        data: Start of the file (at least 12 bytes)
+        
+    Returns:
+        PIL format name, or None if unrecognized
+    """
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'GIF'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+
+def probe_image(data: bytes) -> ImageInfo:
+    """
+    Read format, dimensions and frame count from the image header.
+    
+    No pixel data is decoded; for animated formats only chunk headers are walked.
+    
+    Args:
+        data: Image file bytes
+        
+    Returns:
+        ImageInfo
+        
+    Raises:
+        ImageValidationError: If the format is unsupported or the header is malformed
+    """
+    image_format = sniff_format(data)
+    if image_format is None:
+        raise ImageValidationError("Unsupported or unrecognized image format")
+        
+    try:
+        if image_format == 'JPEG':
+            width, height, frames = _probe_jpeg(data)
+        elif image_format == 'PNG':
+            width, height, frames = _probe_png(data)
+        elif image_format == 'GIF':
+            width, height, frames = _probe_gif(data)
+        else:
+            width, height, frames = _probe_webp(data)
+    except (struct.error, IndexError):
+        raise ImageValidationError(f"Truncated or malformed {image_format} header")
+        
+    if width <= 0 or height <= 0:
+        raise ImageValidationError(f"Invalid image dimensions {width}x{height}")
+        
+    return ImageInfo(image_format, width, height, max(frames, 1))
+
+
+def validate_image(
+    data: bytes,
+    max_pixels: Optional[int] = None,
+    max_frames: Optional[int] = None
+) -> ImageInfo:
+    """
+    Validate an upload against the pixel budget before any decode.
+    
+    Args:
+        data: Image file bytes
+        max_pixels: Maximum pixels per frame (default from config)
+        max_frames: Maximum number of frames (default from config)
+        
+    Returns:
+        ImageInfo of the accepted image
+        
+    Raises:
+        ImageValidationError: If the image is unsupported or over budget
+    """
+    config = config_manager.config
+    max_pixels = max_pixels or config.max_image_pixels
+    max_frames = max_frames or config.max_image_frames
+    
+    info = probe_image(data)
+    if info.pixels > max_pixels:
+        raise ImageValidationError(
+            f"Image dimensions {info.width}x{info.height} exceed the {max_pixels:,} pixel limit"
+        )
+    if info.frames > max_frames:
+        raise ImageValidationError(f"Image has {info.frames} frames; at most {max_frames} allowed")
+    return info
+
+
+@contextmanager
+def decode_slot() -> Iterator[None]:
+    """Hold one of the limited pixel-decoding slots."""
+    global _decode_semaphore
+    if _decode_semaphore is None:
+        with _semaphore_lock:
+            if _decode_semaphore is None:
+                _decode_semaphore = threading.BoundedSemaphore(config_manager.config.max_concurrent_decodes)
+                
+    with _decode_semaphore:
+        yield
+
+
+def decode_image(data: bytes, max_dimension: Optional[int] = None) -> Image.Image:
+    """
+    Validate and fully decode an image while holding a decode slot.
+    
+    Args:
+        data: Image file bytes
+        max_dimension: If set, JPEGs are decoded at a reduced scale no smaller than this
+        
+    Returns:
+        Decoded PIL image (format attribute preserved)
+    """
+    validate_image(data)
+    
+    with decode_slot():
+        image = Image.open(io.BytesIO(data))
+        if max_dimension and image.format == 'JPEG':
+            # DCT scaling makes the decoder skip work for large JPEGs
+            image.draft(image.mode, (max_dimension, max_dimension))
+        image.load()
+    return image
+
+
+def _probe_jpeg(data: bytes) -> Tuple[int, int, int]:
+    """Find the start-of-frame marker and read its dimensions."""
+    offset = 2
+    while offset < len(data):
+        if data[offset] != 0xFF:
+            raise ImageValidationError("Malformed JPEG marker")
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            # Fill byte
+            offset += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            offset += 2
+            continue
+        if marker in (0xD9, 0xDA):
+            break
+            
+        length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return width, height, 1
+        offset += 2 + length
+        
+    raise ImageValidationError("JPEG has no frame header")
+
+
+def _probe_png(data: bytes) -> Tuple[int, int, int]:
+    """Read IHDR, and acTL for animated PNGs."""
+    if data[12:16] != b'IHDR':
+        raise ImageValidationError("PNG is missing IHDR")
+    width, height = struct.unpack('>II', data[16:24])
+    
+    frames = 1
+    offset = 8
+    while offset + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+        if chunk_type == b'acTL':
+            frames = struct.unpack('>I', data[offset + 8:offset + 12])[0]
+            break
+        if chunk_type in (b'IDAT', b'IEND'):
+            break
+        offset += 12 + length
+    return width, height, frames
+
+
+def _probe_gif(data: bytes) -> Tuple[int, int, int]:
+    """Read the logical screen and count image descriptors by skipping data sub-blocks."""
+    width, height, flags = struct.unpack('<HHB', data[6:11])
+    offset = 13
+    if flags & 0x80:
+        offset += 3 * (2 ** ((flags & 0x07) + 1))
+        
+    frames = 0
+    while offset < len(data):
+        block = data[offset]
+        if block == 0x3B:  # Trailer
+            break
+        if block == 0x21:  # Extension: label, then sub-blocks
+            offset = _skip_gif_sub_blocks(data, offset + 2)
+        elif block == 0x2C:  # Image descriptor
+            frame_width, frame_height, frame_flags = struct.unpack('<HHB', data[offset + 5:offset + 10])
+            width, height = max(width, frame_width), max(height, frame_height)
+            frames += 1
+            offset += 10
+            if frame_flags & 0x80:
+                offset += 3 * (2 ** ((frame_flags & 0x07) + 1))
+            # LZW minimum code size, then image data sub-blocks
+            offset = _skip_gif_sub_blocks(data, offset + 1)
+        else:
+            raise ImageValidationError("Malformed GIF block")
+    return width, height, frames
+
+
+def _skip_gif_sub_blocks(data: bytes, offset: int) -> int:
+    """Return the offset just past a chain of GIF data sub-blocks."""
+    while True:
+        size = data[offset]
+        offset += 1
+        if size == 0:
+            return offset
+        offset += size
+
+
+def _probe_webp(data: bytes) -> Tuple[int, int, int]:
+    """Read the VP8/VP8L/VP8X header, counting ANMF chunks for animations."""
+    chunk_type = data[12:16]
+    chunk = data[20:30]
+    
+    if chunk_type == b'VP8 ':
+        width, height = struct.unpack('<HH', chunk[6:10])
+        return width & 0x3FFF, height & 0x3FFF, 1
+    if chunk_type == b'VP8L':
+        bits = struct.unpack('<I', chunk[1:5])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, 1
+    if chunk_type != b'VP8X':
+        raise ImageValidationError("Unknown WebP chunk")
+        
+    width = int.from_bytes(chunk[4:7], 'little') + 1
+    height = int.from_bytes(chunk[7:10], 'little') + 1
+    frames = 1
+    if chunk[0] & 0x02:  # Animation flag
+        frames = 0
+        offset = 12
+        while offset + 8 <= len(data):
+            fourcc, length = struct.unpack('<4sI', data[offset:offset + 8])
+            if fourcc == b'ANMF':
+                frames += 1
+            offset += 8 + length + (length & 1)
+    return width, height, frames
@@ -0,0 +1,585 @@
+"""Online data migrations for the captions table.
+
+Run with: python -m backend.migrations <migration> [options]
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+from backend.config import config_manager
+from backend.aws_clients import get_resource
+from backend.db import (
+    DynamoDBManager, expiry_time, image_sort_key, is_expired, BATCH_WRITE_SIZE, INDEX_FAILURES_SK, TTL_ATTRIBUTE,
+    USAGE_PK, USAGE_SHARDS, USER_STATS_SK
+)
+from backend.ids import ulid_timestamp
+from backend.models import CaptionProvider, CaptionResult
+from backend.segmented_scan import CapacityThrottle, ScanCheckpoint, scan_pages
+from backend.search import TOKEN_PREFIX, caption_tokens, index_key
+from backend.facets import LABEL_COUNTS_SK, LABEL_PREFIX, caption_labels, facet_item, facet_key
+
+
+def migrate_sort_keys(
+    table=None,
+    dry_run: bool = False,
+    max_items_per_second: Optional[float] = None
+) -> Dict[str, int]:
+    """
+    Re-key caption items whose sort key is a random UUID to time-ordered ULID keys.
+    
+    Each item is moved with a transaction that puts the new key and deletes the
+    old one, so readers see exactly one copy and the app can keep serving while
+    this runs. Its search and label facet entries are then moved to the new
+    sort key. An old item whose new key already exists (from an interrupted
+    run or a concurrent writer) is deleted, and its entries are moved to the
+    existing item. Re-running is safe: migrated items are skipped.
+    
+    Args:
+        table: DynamoDB Table resource (default from config)
+        dry_run: Only count items that would be migrated
+        max_items_per_second: Optional pacing to limit write capacity use
+        
+    Returns:
+        Counts of scanned, migrated, duplicate, skipped and failed items
+    """
+    table = table or _default_table()
+    client = table.meta.client
+    
+    stats = {'scanned': 0, 'migrated': 0, 'duplicates': 0, 'skipped': 0, 'failed': 0}
+    scan_params = {'FilterExpression': Attr('SK').begins_with('IMAGE#')}
+    
+    while True:
+        response = table.scan(**scan_params)
+        
+        for item in response.get('Items', []):
+            stats['scanned'] += 1
+            new_sk = image_sort_key(item['image_id'], datetime.fromisoformat(item['timestamp']))
+            if item['SK'] == new_sk:
+                stats['skipped'] += 1
+                continue
+            if dry_run:
+                stats['migrated'] += 1
+                continue
+                
+            try:
+                client.transact_write_items(TransactItems=[
+                    {
+                        'Put': {
+                            'TableName': table.name,
+                            'Item': {**item, 'SK': new_sk},
+                            'ConditionExpression': 'attribute_not_exists(PK)'
+                        }
+                    },
+                    {
+                        'Delete': {
+                            'TableName': table.name,
+                            'Key': {'PK': item['PK'], 'SK': item['SK']},
+                            'ConditionExpression': 'attribute_exists(PK)'
+                        }
+                    }
+                ])
+                _move_index_entries(table, item, {**item, 'SK': new_sk})
+                stats['migrated'] += 1
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'TransactionCanceledException':
+                    print(f"Error migrating {item['PK']} {item['SK']}: {e}")
+                    stats['failed'] += 1
+                elif _remove_duplicate(table, item, new_sk):
+                    stats['duplicates'] += 1
+                else:
+                    # Already moved or deleted by a concurrent writer
+                    stats['skipped'] += 1
+                    
+            if max_items_per_second:
+                time.sleep(1 / max_items_per_second)
+                
+        if 'LastEvaluatedKey' not in response:
+            return stats
+        scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def _move_index_entries(table, old_item: Dict[str, Any], new_item: Dict[str, Any]):
+    """
+    Delete a caption's search and label facet entries under its old sort key,
+    and write them under the new one.
+    
+    Label counts are unchanged, since the caption keeps its labels.
+    
+    Args:
+        table: DynamoDB Table resource
+        old_item: Caption item under its old sort key
+        new_item: Caption item under its new sort key
+    """
+    user_id = old_item['user_id']
+    old_sort_id = old_item['SK'][len('IMAGE#'):]
+    with table.batch_writer() as batch:
+        for token in caption_tokens(old_item):
+            batch.delete_item(Key=index_key(user_id, token, old_sort_id))
+        for label in caption_labels(old_item):
+            batch.delete_item(Key=facet_key(user_id, label, old_sort_id))
+            
+        new_sort_id = new_item['SK'][len('IMAGE#'):]
+        expiry = {TTL_ATTRIBUTE: new_item[TTL_ATTRIBUTE]} if TTL_ATTRIBUTE in new_item else {}
+        for token in caption_tokens(new_item):
+            batch.put_item(Item={**index_key(user_id, token, new_sort_id), **expiry})
+        for label in caption_labels(new_item):
+            batch.put_item(Item=facet_item(new_item, label))
+
+
+def _remove_duplicate(table, item: Dict[str, Any], new_sk: str) -> bool:
+    """Delete an item left under its old sort key when its new key already exists."""
+    target = table.get_item(Key={'PK': item['PK'], 'SK': new_sk}, ConsistentRead=True)
+    if 'Item' not in target:
+        return False
+    try:
+        table.delete_item(
+            Key={'PK': item['PK'], 'SK': item['SK']},
+            ConditionExpression='attribute_exists(PK)'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+    _move_index_entries(table, item, target['Item'])
+    return True
+
+
+def rebuild_usage_counters(table=None) -> Dict[str, int]:
+    """
+    Recompute the usage counter items from the caption items.
+    
+    Needed once for tables that held captions before the counters existed,
+    and periodically afterwards: captions removed by TTL are never
+    subtracted from the counters. Expired captions are not counted, and
+    users without captions get zeroed counters. Captions saved while this
+    runs may be counted twice or not at all, so run it during low traffic.
+    Error and processing-time counters cannot be derived from items and are
+    carried over.
+    
+    Args:
+        table: DynamoDB Table resource (default from config)
+        
+    Returns:
+        The rebuilt global totals
+    """
+    table = table or _default_table()
+    now = int(time.time())
+    users: Dict[str, Dict[str, int]] = {}
+    scan_params = {
+        'FilterExpression': Attr('SK').begins_with('IMAGE#') | Attr('SK').eq(USER_STATS_SK),
+        'ProjectionExpression': 'PK, SK, user_id, provider, file_size, #ttl',
+        'ExpressionAttributeNames': {'#ttl': TTL_ATTRIBUTE}
+    }
+    
+    while True:
+        response = table.scan(**scan_params)
+        for item in response.get('Items', []):
+            user_id = item['PK'][len('USER#'):]
+            stats = users.setdefault(user_id, {'captions': 0, 'bytes_stored': 0})
+            if item['SK'] == USER_STATS_SK or is_expired(item, now):
+                continue
+            stats['captions'] += 1
+            stats['bytes_stored'] += int(item.get('file_size', 0))
+            provider_counter = f"provider_{item.get('provider', 'unknown')}"
+            stats[provider_counter] = stats.get(provider_counter, 0) + 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        
+    totals: Dict[str, Any] = {'users': sum(1 for stats in users.values() if stats['captions'])}
+    for stats in users.values():
+        for name, value in stats.items():
+            totals[name] = totals.get(name, 0) + value
+            
+    shards = table.query(KeyConditionExpression=Key('PK').eq(USAGE_PK), ConsistentRead=True).get('Items', [])
+    for shard in shards:
+        for name in ('errors', 'processing_ms', 'processed'):
+            totals[name] = totals.get(name, 0) + int(shard.get(name, 0))
+            
+    with table.batch_writer() as batch:
+        for user_id, stats in users.items():
+            batch.put_item(Item={'PK': f"USER#{user_id}", 'SK': USER_STATS_SK, **stats})
+        batch.put_item(Item={'PK': USAGE_PK, 'SK': 'SHARD#0', **totals})
+        for shard in range(1, USAGE_SHARDS):
+            batch.delete_item(Key={'PK': USAGE_PK, 'SK': f"SHARD#{shard}"})
+    return totals
+
+
+def rebuild_search_index(table=None) -> Dict[str, int]:
+    """
+    Write search index and label facet entries for every caption item, and
+    reset each user's label counts.
+    
+    Needed once for captions saved before the indexes existed, and
+    periodically afterwards: captions removed by TTL are never subtracted
+    from the label counts, and index updates the app gave up on are
+    counted in UsageMetrics.index_failures (reset here). Expired captions
+    are skipped. Entries are idempotent puts, so it is safe to rerun;
+    search entries of moved or edited captions are ignored by searches.
+    
+    Args:
+        table: DynamoDB Table resource (default from config)
+        
+    Returns:
+        Counts of captions indexed, search entries and facet entries written
+    """
+    table = table or _default_table()
+    now = int(time.time())
+    stats = {'captions': 0, 'entries': 0, 'facets': 0}
+    label_counts: Dict[str, Dict[str, int]] = {}
+    # Reset first so failures during the run stay recorded
+    table.delete_item(Key={'PK': USAGE_PK, 'SK': INDEX_FAILURES_SK})
+    scan_params = {
+        'FilterExpression': Attr('SK').begins_with('IMAGE#') | Attr('SK').eq(LABEL_COUNTS_SK),
+        'ProjectionExpression': 'PK, SK, image_id, user_id, labels, concise_caption, creative_caption, '
+                                'thumbnail_url, #ts, #ttl',
+        'ExpressionAttributeNames': {'#ts': 'timestamp', '#ttl': TTL_ATTRIBUTE}
+    }
+    
+    with table.batch_writer(overwrite_by_pkeys=['PK', 'SK']) as batch:
+        while True:
+            response = table.scan(**scan_params)
+            for item in response.get('Items', []):
+                # Users whose labelled captions all expired get empty counts
+                counts = label_counts.setdefault(item['PK'][len('USER#'):], {})
+                if item['SK'] == LABEL_COUNTS_SK or is_expired(item, now):
+                    continue
+                sort_id = item['SK'][len('IMAGE#'):]
+                expiry = {TTL_ATTRIBUTE: item[TTL_ATTRIBUTE]} if TTL_ATTRIBUTE in item else {}
+                for token in caption_tokens(item):
+                    batch.put_item(Item={**index_key(item['user_id'], token, sort_id), **expiry})
+                    stats['entries'] += 1
+                for label in caption_labels(item):
+                    batch.put_item(Item=facet_item(item, label))
+                    counts[label] = counts.get(label, 0) + 1
+                    stats['facets'] += 1
+                stats['captions'] += 1
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            
+        for user_id, counts in label_counts.items():
+            batch.put_item(Item={'PK': f"USER#{user_id}", 'SK': LABEL_COUNTS_SK, **counts})
+    return stats
+
+
+def backfill_ttl(
+    db_manager: Optional[DynamoDBManager] = None,
+    retention_days: Optional[int] = None,
+    segments: int = 4,
+    max_items_per_second: Optional[float] = None
+) -> Dict[str, int]:
+    """
+    Stamp the TTL attribute on caption, search index and label facet items
+    written before captions carried one.
+    
+    Each item expires retention_days after its caption was created, so
+    DynamoDB deletes it in the background instead of a cleanup scan. Items
+    past their retention expire right away. The scan only reads unstamped
+    items, so an interrupted run is resumed by running it again.
+    
+    Args:
+        db_manager: DynamoDBManager of the table (default: new manager)
+        retention_days: Days to keep items (default: config retention_days)
+        segments: Number of parallel scan segments
+        max_items_per_second: Optional pacing of items stamped
+        
+    Returns:
+        Counts of scanned, stamped, skipped and failed items
+        
+    Raises:
+        ValueError: If retention is disabled (0 days or less)
+    """
+    db_manager = db_manager or DynamoDBManager()
+    if retention_days is None:
+        retention_days = db_manager.config.retention_days
+    if retention_days <= 0:
+        raise ValueError("retention_days must be positive to stamp a TTL")
+        
+    client = db_manager.dynamodb.meta.client
+    throttle = CapacityThrottle(max_items_per_second) if max_items_per_second else None
+    scan_params = {
+        'TableName': db_manager.table.name,
+        'TotalSegments': segments,
+        'FilterExpression': 'attribute_not_exists(#ttl) AND '
+                            '(begins_with(SK, :image) OR begins_with(SK, :token) OR begins_with(SK, :label))',
+        'ProjectionExpression': 'PK, SK, #ts',
+        'ExpressionAttributeNames': {'#ttl': TTL_ATTRIBUTE, '#ts': 'timestamp'},
+        'ExpressionAttributeValues': {':image': 'IMAGE#', ':token': TOKEN_PREFIX, ':label': LABEL_PREFIX}
+    }
+    
+    def stamp_segment(segment: int) -> Dict[str, int]:
+        stats = {'scanned': 0, 'stamped': 0, 'skipped': 0, 'failed': 0}
+        for response in scan_pages(client, scan_params, segment):
+            items = response.get('Items', [])
+            for item in items:
+                stats['scanned'] += 1
+                created = _created_at(item)
+                if not created:
+                    stats['skipped'] += 1
+                    continue
+                try:
+                    client.update_item(
+                        TableName=db_manager.table.name,
+                        Key={'PK': item['PK'], 'SK': item['SK']},
+                        UpdateExpression='SET #ttl = :ttl',
+                        # Deleted or already stamped meanwhile: leave it alone
+                        ConditionExpression='attribute_exists(PK) AND attribute_not_exists(#ttl)',
+                        ExpressionAttributeNames={'#ttl': TTL_ATTRIBUTE},
+                        ExpressionAttributeValues={':ttl': expiry_time(created, retention_days)}
+                    )
+                    stats['stamped'] += 1
+                except ClientError as e:
+                    if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                        stats['skipped'] += 1
+                    else:
+                        print(f"Error stamping TTL on {item['PK']} {item['SK']}: {e}")
+                        stats['failed'] += 1
+            if throttle and items:
+                throttle.consume(len(items))
+        return stats
+        
+    with ThreadPoolExecutor(max_workers=segments, thread_name_prefix='ttl-backfill') as executor:
+        results = list(executor.map(stamp_segment, range(segments)))
+    return {name: sum(result[name] for result in results) for name in results[0]}
+
+
+def _created_at(item: Dict[str, Any]) -> Optional[datetime]:
+    """Creation time of a caption-derived item: its timestamp, or the caption's ULID sort id."""
+    if item.get('timestamp'):
+        return datetime.fromisoformat(item['timestamp'])
+    return ulid_timestamp(item['SK'].rsplit('#', 1)[-1])
+
+
+# Legacy captions (aws_utils' image_id-keyed table) have no owner and were made with BLIP
+LEGACY_USER_ID = 'legacy'
+LEGACY_MODEL = 'Salesforce/blip-image-captioning-base'
+
+# Legacy items read per scan request (and per batch_get_item of their targets)
+LEGACY_PAGE_SIZE = 100
+
+# Changed items reported by a dry run
+DIFF_SAMPLE_SIZE = 20
+
+
+def legacy_caption_result(row: Dict[str, Any], user_id: str = LEGACY_USER_ID) -> Optional[CaptionResult]:
+    """
+    Map a legacy {image_id, timestamp, caption_text, image_url} row to a CaptionResult.
+    
+    The single legacy caption is used as both the concise and the creative
+    caption, and the image URL as both the original and the thumbnail.
+    
+    Args:
+        row: Legacy table item
+        user_id: Owner of the migrated captions
+        
+    Returns:
+        CaptionResult, or None if the row lacks a caption or timestamp
+    """
+    if not row.get('caption_text') or not row.get('timestamp'):
+        return None
+    return CaptionResult(
+        image_id=row['image_id'],
+        user_id=user_id,
+        concise_caption=row['caption_text'],
+        creative_caption=row['caption_text'],
+        model=LEGACY_MODEL,
+        provider=CaptionProvider.HUGGINGFACE,
+        timestamp=datetime.fromisoformat(row['timestamp']),
+        s3_url=row.get('image_url', ''),
+        thumbnail_url=row.get('image_url', '')
+    )
+
+
+def migrate_legacy_table(
+    source_table: str = 'image_captions',
+    db_manager: Optional[DynamoDBManager] = None,
+    user_id: str = LEGACY_USER_ID,
+    segments: int = 4,
+    checkpoint_path: str = 'legacy-migration-checkpoint.json',
+    dry_run: bool = False,
+    max_items_per_second: Optional[float] = None
+) -> Dict[str, Any]:
+    """
+    Copy the legacy image_id-keyed table into the PK/SK captions table.
+    
+    Each segment of a parallel scan maps its rows to caption items, reads the
+    items already in the target and writes only new or changed ones in
+    25-item batches. Usage counters, search entries and label facets are
+    updated like for any saved caption, so the app keeps serving from the
+    target table while this runs. Every page is checkpointed; running again
+    with the same checkpoint resumes, and re-copying finds nothing to write.
+    
+    Args:
+        source_table: Legacy table name
+        db_manager: DynamoDBManager of the target table (default: new manager)
+        user_id: Owner of the migrated captions
+        segments: Number of parallel scan segments
+        checkpoint_path: Checkpoint file (ignored in a dry run)
+        dry_run: Only compare rows with the target and report the differences
+        max_items_per_second: Optional pacing of items written (or compared)
+        
+    Returns:
+        Counts of scanned, new, changed, unchanged, invalid and failed items,
+        plus 'diffs' (changed attribute names of sample items) in a dry run
+        
+    Raises:
+        ValueError: If the source is the target table, or the checkpoint belongs to another job
+    """
+    db_manager = db_manager or DynamoDBManager()
+    if source_table == db_manager.table.name:
+        raise ValueError(f"{source_table} is already the target table")
+    counters = {name: 0 for name in ('scanned', 'new', 'changed', 'unchanged', 'invalid', 'failed')}
+    job = {'source': source_table, 'target': db_manager.table.name, 'user_id': user_id, 'segments': segments}
+    
+    checkpoint = None if dry_run else ScanCheckpoint(checkpoint_path, job, counters)
+    throttle = CapacityThrottle(max_items_per_second) if max_items_per_second else None
+    client = db_manager.dynamodb.meta.client
+    diffs: List[Dict[str, Any]] = []
+    diffs_lock = threading.Lock()
+    scan_params = {'TableName': source_table, 'TotalSegments': segments, 'Limit': LEGACY_PAGE_SIZE}
+    
+    def migrate_segment(segment: int) -> Dict[str, Any]:
+        position = checkpoint.position(segment) if checkpoint else dict(counters, key=None)
+        if position.get('done'):
+            return position
+            
+        for response in scan_pages(client, scan_params, segment, position['key']):
+            targets = []
+            for row in response.get('Items', []):
+                position['scanned'] += 1
+                result = legacy_caption_result(row, user_id)
+                if result:
+                    targets.append(db_manager._caption_item(result))
+                else:
+                    position['invalid'] += 1
+                    
+            existing = {}
+            if targets:
+                keys = [{'PK': item['PK'], 'SK': item['SK']} for item in targets]
+                existing = {(item['PK'], item['SK']): item for item in db_manager._batch_get(client, keys)}
+                
+            writes = []
+            for item in targets:
+                old_item = existing.get((item['PK'], item['SK']))
+                changed = _changed_attributes(old_item, item)
+                if old_item and not changed:
+                    position['unchanged'] += 1
+                    continue
+                writes.append((old_item, item))
+                if dry_run and old_item:
+                    with diffs_lock:
+                        if len(diffs) < DIFF_SAMPLE_SIZE:
+                            diffs.append({'image_id': item['image_id'], 'changed': changed})
+                            
+            if not dry_run:
+                _write_legacy_captions(db_manager, client, writes, position)
+            else:
+                position['new'] += sum(1 for old_item, _ in writes if not old_item)
+                position['changed'] += sum(1 for old_item, _ in writes if old_item)
+                
+            position['key'] = response.get('LastEvaluatedKey')
+            position['done'] = not position['key']
+            if checkpoint:
+                checkpoint.save(segment, position)
+            if throttle and not position['done']:
+                throttle.consume(len(writes) if not dry_run else len(targets))
+        return position
+        
+    with ThreadPoolExecutor(max_workers=segments, thread_name_prefix='legacy-migration') as executor:
+        positions = list(executor.map(migrate_segment, range(segments)))
+        
+    if checkpoint:
+        stats: Dict[str, Any] = {name: checkpoint.total(name) for name in counters}
+    else:
+        stats = {name: sum(position[name] for position in positions) for name in counters}
+        stats['diffs'] = diffs
+    return stats
+
+
+def _write_legacy_captions(db_manager: DynamoDBManager, client, writes: List[tuple], position: Dict[str, Any]):
+    """Batch-write migrated captions and update the counters and indexes they feed."""
+    for i in range(0, len(writes), BATCH_WRITE_SIZE):
+        chunk = writes[i:i + BATCH_WRITE_SIZE]
+        written = db_manager._batch_write(client, [{'PutRequest': {'Item': item}} for _, item in chunk])
+        if written < len(chunk):
+            # Unprocessed puts are not identified; the rerun after fixing the cause rewrites them
+            position['failed'] += len(chunk) - written
+            continue
+            
+        new_items = [item for old_item, item in chunk if not old_item]
+        position['new'] += len(new_items)
+        position['changed'] += len(chunk) - len(new_items)
+        if new_items:
+            db_manager._record_usage([(item['user_id'], item['provider'], 0, None) for item in new_items])
+        for old_item, item in chunk:
+            db_manager._update_indexes(old_item, item)
+    if writes:
+        db_manager._invalidate_history(writes[0][1]['user_id'])
+
+
+def _changed_attributes(old_item: Optional[Dict[str, Any]], new_item: Dict[str, Any]) -> List[str]:
+    """Names of attributes that differ between a stored item and its replacement."""
+    if not old_item:
+        return sorted(new_item)
+    return sorted(name for name in set(old_item) | set(new_item) if old_item.get(name) != new_item.get(name))
+
+
+def _default_table():
+    """Table resource for the configured captions table."""
+    config = config_manager.config
+    return get_resource('dynamodb', config.aws_region).Table(config.dynamodb_table)
+
+
+def main():
+    """Command-line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='migration', required=True)
+    
+    sort_keys = subparsers.add_parser('sort-keys', help='Re-key history items to time-ordered sort keys')
+    sort_keys.add_argument('--dry-run', action='store_true')
+    sort_keys.add_argument('--rate', type=float, help='Maximum items migrated per second')
+    
+    subparsers.add_parser('usage-counters', help='Rebuild usage counter items from caption items')
+    subparsers.add_parser('search-index', help='Write search and label facet entries for existing captions')
+    
+    ttl = subparsers.add_parser('ttl', help='Stamp the TTL attribute on items written before it existed')
+    ttl.add_argument('--retention-days', type=int, help='Days to keep items (default: RETENTION_DAYS)')
+    ttl.add_argument('--segments', type=int, default=4, help='Parallel scan segments')
+    ttl.add_argument('--rate', type=float, help='Maximum items stamped per second')
+    
+    legacy = subparsers.add_parser('legacy-table', help='Copy the legacy image_id table into the captions table')
+    legacy.add_argument('source_table', help='Legacy table name')
+    legacy.add_argument('--user-id', default=LEGACY_USER_ID, help='Owner of the migrated captions')
+    legacy.add_argument('--segments', type=int, default=4, help='Parallel scan segments')
+    legacy.add_argument('--checkpoint', default='legacy-migration-checkpoint.json')
+    legacy.add_argument('--dry-run', action='store_true', help='Report what would change without writing')
+    legacy.add_argument('--rate', type=float, help='Maximum items written per second')
+    
+    args = parser.parse_args()
+    if args.migration == 'sort-keys':
+        stats = migrate_sort_keys(dry_run=args.dry_run, max_items_per_second=args.rate)
+        print(stats)
+    elif args.migration == 'usage-counters':
+        print(rebuild_usage_counters())
+    elif args.migration == 'search-index':
+        print(rebuild_search_index())
+    elif args.migration == 'ttl':
+        print(backfill_ttl(retention_days=args.retention_days, segments=args.segments, max_items_per_second=args.rate))
+    elif args.migration == 'legacy-table':
+        print(migrate_legacy_table(
+            args.source_table,
+            user_id=args.user_id,
+            segments=args.segments,
+            checkpoint_path=args.checkpoint,
+            dry_run=args.dry_run,
+            max_items_per_second=args.rate
+        ))
+
+
+if __name__ == '__main__':
+    main()
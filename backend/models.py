@@ -29,6 +29,7 @@ class ImageMetadata(BaseModel):
     file_size: int
     content_type: str
     timestamp: datetime = Field(default_factory=datetime.utcnow)
+    content_hash: Optional[str] = None  # Set when stored content-addressed
     
 
 class CaptionResult(BaseModel):
@@ -44,6 +45,8 @@ class CaptionResult(BaseModel):
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     s3_url: str
     thumbnail_url: str
+    content_hash: Optional[str] = None  # Shared content-addressed image, released on delete
+    request_key: Optional[str] = None  # Idempotency record replaying this caption, dropped on delete
 
 
 class UserHistory(BaseModel):
@@ -57,11 +60,89 @@ class UserHistory(BaseModel):
     labels: Optional[List[str]] = None
 
 
+class HistoryItem:
+    """
+    Compact history row for rendering, decoded without model validation.
+    
+    The timestamp is kept as the stored ISO string and only parsed on first access.
+    """
+    __slots__ = (
+        'image_id', 'user_id', 'concise_caption', 'creative_caption',
+        'thumbnail_url', 'labels', '_timestamp_raw', '_timestamp'
+    )
+    
+    def __init__(
+        self,
+        image_id: str,
+        user_id: str,
+        concise_caption: str,
+        creative_caption: str,
+        thumbnail_url: str,
+        timestamp_raw: str,
+        labels: Optional[List[str]] = None
+    ):
+        self.image_id = image_id
+        self.user_id = user_id
+        self.concise_caption = concise_caption
+        self.creative_caption = creative_caption
+        self.thumbnail_url = thumbnail_url
+        self.labels = labels
+        self._timestamp_raw = timestamp_raw
+        self._timestamp = None
+    
+    @classmethod
+    def from_item(cls, item: Dict[str, Any]) -> "HistoryItem":
+        """Build from a (projected) DynamoDB item."""
+        return cls(
+            item['image_id'],
+            item['user_id'],
+            item['concise_caption'],
+            item['creative_caption'],
+            item['thumbnail_url'],
+            item['timestamp'],
+            item.get('labels')
+        )
+    
+    @property
+    def timestamp(self) -> datetime:
+        """Caption timestamp."""
+        if self._timestamp is None:
+            self._timestamp = datetime.fromisoformat(self._timestamp_raw)
+        return self._timestamp
+    
+    def to_item(self) -> Dict[str, Any]:
+        """Plain dict in the stored item shape, the inverse of from_item."""
+        return {
+            'image_id': self.image_id,
+            'user_id': self.user_id,
+            'concise_caption': self.concise_caption,
+            'creative_caption': self.creative_caption,
+            'thumbnail_url': self.thumbnail_url,
+            'timestamp': self._timestamp_raw,
+            'labels': self.labels
+        }
+    
+    def to_user_history(self) -> UserHistory:
+        """Convert to the validated UserHistory model."""
+        return UserHistory(
+            image_id=self.image_id,
+            user_id=self.user_id,
+            concise_caption=self.concise_caption,
+            creative_caption=self.creative_caption,
+            thumbnail_url=self.thumbnail_url,
+            timestamp=self.timestamp,
+            labels=self.labels
+        )
+    
+    def __repr__(self) -> str:
+        return f"HistoryItem(image_id={self.image_id!r}, timestamp={self._timestamp_raw!r})"
+
+
 class RateLimitConfig(BaseModel):
     """Rate limiting configuration."""
     requests_per_hour: int = 60
     bucket_size: int = 60
-    refill_rate: float = 1.0  # tokens per second
+    refill_rate: float = Field(default=1.0, gt=0)  # tokens per second
 
 
 class AppConfig(BaseModel):
@@ -81,6 +162,28 @@ class AppConfig(BaseModel):
     thumbnail_size: int = 300
     presigned_url_expiry: int = 3600  # seconds
     retention_days: int = 90
+    content_addressed_storage: bool = False
+    async_thumbnails: bool = False
+    derivative_queue_url: Optional[str] = None
+    storage_backend: str = "s3"  # "s3", "gcs", "local" or "memory"
+    direct_uploads: bool = False  # Browsers upload to S3 with presigned POST policies
+    local_storage_path: str = ".storage"
+    gcs_credentials_path: Optional[str] = None
+    max_image_pixels: int = 40_000_000  # per frame, checked from the header
+    max_image_frames: int = 100
+    max_concurrent_decodes: int = 4
+    history_cache_ttl: int = 60  # seconds, 0 disables the history cache
+    history_cache_max_entries: int = 1024
+    cache_redis_url: Optional[str] = None  # Shared cache tier
+    caption_write_behind: bool = False
+    caption_flush_interval: float = 1.0  # seconds
+    cursor_secret: Optional[str] = None  # Signs pagination cursors
+    prewarm_aws_clients: bool = False  # Create AWS clients at startup
+    dynamodb_fast_codec: bool = False  # Low-level client + codec on hot paths
+    idempotency_ttl_seconds: int = 86400  # Replays within this window reuse the result, 0 disables
+    rate_limit_backend: str = "memory"  # "memory", "dynamodb" or "redis" (shared by all tasks)
+    rate_limit_redis_url: Optional[str] = None  # Defaults to cache_redis_url
+    rate_limit_max_lease: int = 8  # Tokens a hot user borrows from a shared store at once
     
     @validator("caption_provider", pre=True)
     def validate_provider(cls, v):
@@ -88,6 +191,13 @@ class AppConfig(BaseModel):
         if isinstance(v, str):
             return CaptionProvider(v.lower())
         return v
+    
+    @validator("storage_backend", pre=True)
+    def validate_storage_backend(cls, v):
+        """Normalize storage backend names."""
+        if isinstance(v, str):
+            return v.strip().lower()
+        return v
 
 
 class UsageMetrics(BaseModel):
@@ -98,3 +208,7 @@ class UsageMetrics(BaseModel):
     avg_processing_time: float
     error_rate: float
     storage_used_gb: float
+    # Search index updates that need migrations.rebuild_search_index
+    index_failures: int = 0
+    captions_by_provider: Dict[str, int] = Field(default_factory=dict)
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
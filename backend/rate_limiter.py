@@ -1,17 +1,293 @@
 """Rate limiting implementation using token bucket algorithm."""
+import math
 import time
-from typing import Dict
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Dict, List, Optional, Sequence, Tuple
 from threading import Lock
-from backend.models import RateLimitConfig
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+from backend.models import AppConfig, RateLimitConfig
+
+# Buckets kept by the in-process store; least recently used ones are dropped beyond this
+MAX_TRACKED_USERS = 100000
+
+# Independently locked partitions of the in-process store
+LOCK_STRIPES = 16
+
+# Most buckets a check evicts, so no single check pays for a long sweep
+EVICTION_BATCH = 4
+
+# Keys kept by SlidingWindowCounter before idle ones are swept
+MAX_WINDOW_KEYS = 100000
+
+# Shared buckets live in the captions table: PK = RATELIMIT#<user>
+RATE_LIMIT_PREFIX = 'RATELIMIT#'
+BUCKET_SK = 'BUCKET'
+
+# Attempts at the optimistic bucket update when other tasks update the same bucket
+MAX_CONFLICT_RETRIES = 5
+
+# Idle buckets are dropped by the store this long after they would be full again (seconds)
+IDLE_BUCKET_GRACE = 60
+
+# Tokens borrowed from a shared store are spent locally within this window (seconds)
+LEASE_SECONDS = 2.0
+
+# Expired leases are swept once this many users hold one
+LEASE_SWEEP_THRESHOLD = 10000
+
+
+class BucketStore(ABC):
+    """Token bucket state, kept per process or shared by every task."""
+    
+    @abstractmethod
+    def take(self, key: str, count: int, capacity: int, refill_rate: float) -> int:
+        """
+        Take up to count whole tokens from a bucket, refilling it first.
+        
+        Args:
+            key: Bucket key (user ID)
+            count: Tokens wanted
+            capacity: Bucket size; new buckets start full
+            refill_rate: Tokens added per second
+            
+        Returns:
+            Number of tokens taken (0 if the bucket is empty)
+        """
+        pass
+    
+    @abstractmethod
+    def peek(self, key: str, capacity: int, refill_rate: float) -> float:
+        """Tokens currently in a bucket, without taking any."""
+        pass
+    
+    @abstractmethod
+    def reset(self, key: str):
+        """Forget a bucket, so it starts full again."""
+        pass
+
+
+class MemoryBucketStore(BucketStore):
+    """
+    Buckets of this process, bounded in memory and striped across locks.
+    
+    A bucket is stored as one float: the (monotonic) time at which it will
+    be full again. Buckets that are full carry no state and are evicted as
+    they come up in least-recently-used order; beyond max_users the least
+    recently used buckets are dropped even if not full, which resets them.
+    """
+    
+    def __init__(self, max_users: int = MAX_TRACKED_USERS, stripes: int = LOCK_STRIPES):
+        """
+        Initialize the store.
+        
+        Args:
+            max_users: Most buckets kept at once
+            stripes: Number of independently locked partitions
+        """
+        self.max_per_stripe = max(1, max_users // stripes)
+        # key -> time the bucket is full again, least recently used first
+        self._stripes: List[OrderedDict] = [OrderedDict() for _ in range(stripes)]
+        self._locks = [Lock() for _ in range(stripes)]
+        self._stripe_count = stripes
+    
+    def take(self, key: str, count: int, capacity: int, refill_rate: float) -> int:
+        index = hash(key) % self._stripe_count
+        buckets = self._stripes[index]
+        with self._locks[index]:
+            now = time.monotonic()
+            # Popping and re-inserting moves the key to the end, cheaper than move_to_end
+            full_at = buckets.pop(key, now)
+            if full_at < now:
+                full_at = now
+            taken = min(count, int(capacity - (full_at - now) * refill_rate))
+            buckets[key] = full_at + taken / refill_rate
+            
+            # Drop full buckets, and the least recently used ones beyond the limit
+            oldest = next(iter(buckets))
+            if buckets[oldest] > now and len(buckets) <= self.max_per_stripe:
+                return taken
+            for _ in range(EVICTION_BATCH):
+                del buckets[oldest]
+                if not buckets:
+                    break
+                oldest = next(iter(buckets))
+                if buckets[oldest] > now and len(buckets) <= self.max_per_stripe:
+                    break
+            return taken
+    
+    def peek(self, key: str, capacity: int, refill_rate: float) -> float:
+        index = hash(key) % self._stripe_count
+        with self._locks[index]:
+            now = time.monotonic()
+            full_at = self._stripes[index].get(key, now)
+            return capacity - max(0.0, full_at - now) * refill_rate
+    
+    def reset(self, key: str):
+        index = hash(key) % self._stripe_count
+        with self._locks[index]:
+            self._stripes[index].pop(key, None)
+    
+    def __len__(self) -> int:
+        """Number of buckets kept."""
+        return sum(len(buckets) for buckets in self._stripes)
+
+
+class DynamoDBBucketStore(BucketStore):
+    """
+    Buckets shared by all tasks, updated with conditional writes.
+    
+    Each take reads the bucket and writes it back on the condition that
+    nobody else updated it meanwhile, retrying on conflict. Idle buckets
+    expire through the table TTL.
+    """
+    
+    def __init__(self, table):
+        """
+        Initialize the store.
+        
+        Args:
+            table: DynamoDB Table resource (the captions table)
+        """
+        self.table = table
+    
+    def take(self, key: str, count: int, capacity: int, refill_rate: float) -> int:
+        item_key = self._key(key)
+        for _ in range(MAX_CONFLICT_RETRIES):
+            now = time.time()
+            item = self.table.get_item(Key=item_key, ConsistentRead=True).get('Item')
+            tokens = self._refilled(item, now, capacity, refill_rate)
+            taken = min(count, int(tokens))
+            if not taken:
+                return 0
+                
+            try:
+                self.table.put_item(
+                    Item={
+                        **item_key,
+                        'tokens': Decimal(str(round(tokens - taken, 6))),
+                        'updated': Decimal(str(now)),
+                        'ttl': int(now + capacity / refill_rate) + IDLE_BUCKET_GRACE
+                    },
+                    ConditionExpression=Attr('updated').eq(item['updated']) if item else Attr('PK').not_exists()
+                )
+                return taken
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                    
+        print(f"Warning: rate limit bucket {key} stayed contended after {MAX_CONFLICT_RETRIES} attempts")
+        return 0
+    
+    def peek(self, key: str, capacity: int, refill_rate: float) -> float:
+        item = self.table.get_item(Key=self._key(key), ConsistentRead=True).get('Item')
+        return self._refilled(item, time.time(), capacity, refill_rate)
+    
+    def reset(self, key: str):
+        self.table.delete_item(Key=self._key(key))
+    
+    def _key(self, key: str) -> Dict[str, str]:
+        """Primary key of a bucket item."""
+        return {'PK': f"{RATE_LIMIT_PREFIX}{key}", 'SK': BUCKET_SK}
+    
+    def _refilled(self, item: Optional[Dict], now: float, capacity: int, refill_rate: float) -> float:
+        """Tokens in a stored bucket after refilling it up to now."""
+        if not item:
+            return capacity
+        return min(capacity, float(item['tokens']) + max(0.0, now - float(item['updated'])) * refill_rate)
+
+
+# Refill-and-take in one atomic step; uses the server clock so all tasks agree on time
+_REDIS_TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local count = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local taken = math.min(count, math.floor(tokens))
+if count > 0 then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - taken), 'updated', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + tonumber(ARGV[4]))
+end
+return {taken, tostring(tokens - taken)}
+"""
+
+
+class RedisBucketStore(BucketStore):
+    """Buckets shared by all tasks in Redis (or any server speaking its protocol), updated by a Lua script."""
+    
+    def __init__(self, redis_url: str):
+        """
+        Initialize the store.
+        
+        Args:
+            redis_url: Redis URL, e.g. redis://localhost:6379/0
+        """
+        self.redis_url = redis_url
+        self.redis_client = None
+        self._script = None
+    
+    def _get_script(self):
+        """Lazy initialization of the client and the registered script."""
+        if not self._script:
+            # Optional dependency, only needed for this store
+            import redis
+            self.redis_client = redis.Redis.from_url(self.redis_url, socket_timeout=0.5)
+            self._script = self.redis_client.register_script(_REDIS_TAKE_SCRIPT)
+        return self._script
+    
+    def take(self, key: str, count: int, capacity: int, refill_rate: float) -> int:
+        taken, _ = self._run(key, count, capacity, refill_rate)
+        return int(taken)
+    
+    def peek(self, key: str, capacity: int, refill_rate: float) -> float:
+        _, tokens = self._run(key, 0, capacity, refill_rate)
+        return float(tokens)
+    
+    def reset(self, key: str):
+        self._get_script()
+        self.redis_client.delete(self._redis_key(key))
+    
+    def _run(self, key: str, count: int, capacity: int, refill_rate: float) -> List:
+        """Run the take script; a count of 0 only reads."""
+        script = self._get_script()
+        return script(keys=[self._redis_key(key)], args=[capacity, refill_rate, count, IDLE_BUCKET_GRACE])
+    
+    def _redis_key(self, key: str) -> str:
+        return f"ratelimit:{key}"
 
 
 class RateLimiter:
-    """Token bucket rate limiter for per-user request limiting."""
+    """
+    Token bucket rate limiter for per-user request limiting.
+    
+    With a shared store, a user's checks take tokens from one bucket for the
+    whole cluster. Hot users borrow tokens in batches (a lease that grows
+    while it keeps running out, up to max_lease) and spend them locally, so
+    most checks need no round trip to the store.
+    """
     
-    def __init__(self, config: RateLimitConfig):
+    def __init__(self, config: RateLimitConfig, store: Optional[BucketStore] = None, max_lease: int = 1):
+        """
+        Initialize the limiter.
+        
+        Args:
+            config: Bucket size and refill rate
+            store: Bucket store (default: in this process)
+            max_lease: Most tokens borrowed at once; 1 takes every token from the store
+        """
         self.config = config
-        self.buckets: Dict[str, Dict[str, float]] = {}
-        self.lock = Lock()
+        self.store = store if store is not None else MemoryBucketStore()
+        self.max_lease = max(1, max_lease)
+        # user_id -> [tokens left, expiry (monotonic), size borrowed]
+        self._leases: Dict[str, List[float]] = {}
+        self._lease_lock = Lock()
     
     def is_allowed(self, user_id: str) -> bool:
         """
@@ -23,31 +299,27 @@ class RateLimiter:
         Returns:
             True if request is allowed
         """
-        with self.lock:
-            now = time.time()
-            
-            if user_id not in self.buckets:
-                self.buckets[user_id] = {
-                    'tokens': self.config.bucket_size,
-                    'last_update': now
-                }
-            
-            bucket = self.buckets[user_id]
+        if self.max_lease == 1:
+            return self._take(user_id, 1) == 1
             
-            # Refill tokens
-            time_passed = now - bucket['last_update']
-            bucket['tokens'] = min(
-                self.config.bucket_size,
-                bucket['tokens'] + time_passed * self.config.refill_rate
-            )
-            bucket['last_update'] = now
-            
-            # Check if request is allowed
-            if bucket['tokens'] >= 1.0:
-                bucket['tokens'] -= 1.0
+        now = time.monotonic()
+        with self._lease_lock:
+            lease = self._leases.get(user_id)
+            if lease and lease[1] > now and lease[0] >= 1:
+                lease[0] -= 1
                 return True
+            # Borrow more while a user spends a whole lease before it expires
+            size = min(self.max_lease, int(lease[2]) * 2) if lease and lease[1] > now else 1
             
+        taken = self._take(user_id, size)
+        if not taken:
             return False
+            
+        with self._lease_lock:
+            if len(self._leases) >= LEASE_SWEEP_THRESHOLD:
+                self._leases = {key: value for key, value in self._leases.items() if value[1] > now}
+            self._leases[user_id] = [taken - 1, now + LEASE_SECONDS, size]
+        return True
     
     def get_remaining(self, user_id: str) -> int:
         """
@@ -59,23 +331,157 @@ class RateLimiter:
         Returns:
             Number of remaining tokens
         """
-        with self.lock:
-            if user_id not in self.buckets:
-                return self.config.bucket_size
+        try:
+            tokens = self.store.peek(user_id, self.config.bucket_size, self.config.refill_rate)
+        except Exception as e:
+            print(f"Error reading rate limit: {e}")
+            return self.config.bucket_size
             
-            now = time.time()
-            bucket = self.buckets[user_id]
-            
-            time_passed = now - bucket['last_update']
-            tokens = min(
-                self.config.bucket_size,
-                bucket['tokens'] + time_passed * self.config.refill_rate
-            )
-            
-            return int(tokens)
+        with self._lease_lock:
+            lease = self._leases.get(user_id)
+            if lease and lease[1] > time.monotonic():
+                tokens += lease[0]
+        return int(tokens)
     
     def reset(self, user_id: str):
         """Reset rate limit for user."""
-        with self.lock:
-            if user_id in self.buckets:
-                del self.buckets[user_id]
+        with self._lease_lock:
+            self._leases.pop(user_id, None)
+        self.store.reset(user_id)
+    
+    def _take(self, user_id: str, count: int) -> int:
+        """Take tokens from the store; if the store is unreachable the request is let through."""
+        try:
+            return self.store.take(user_id, count, self.config.bucket_size, self.config.refill_rate)
+        except Exception as e:
+            print(f"Error checking rate limit: {e}")
+            return 1
+
+
+class SlidingWindowCounter:
+    """
+    Units (weighted requests) per key over a sliding window, in O(1) per key.
+    
+    Each key keeps the units of the current and the previous fixed window;
+    the sliding count weights the previous window by how much of it still
+    overlaps the last window_seconds.
+    """
+    
+    def __init__(self, window_seconds: float = 60, max_keys: int = MAX_WINDOW_KEYS):
+        """
+        Initialize the counter.
+        
+        Args:
+            window_seconds: Window the limits apply to
+            max_keys: Keys kept before idle ones are swept
+        """
+        self.window = window_seconds
+        self.max_keys = max_keys
+        # key -> [window index, units this window, units previous window]
+        self._counts: Dict[str, List[float]] = {}
+        self._lock = Lock()
+    
+    def hit(self, limits: Sequence[Tuple[str, int]], units: float = 1) -> Tuple[bool, float]:
+        """
+        Count a request against every key, if all of them have room for it.
+        
+        Args:
+            limits: (key, limit) pairs, e.g. per user and per client IP
+            units: Cost of the request
+            
+        Returns:
+            (allowed, seconds until a request of this cost would be allowed)
+        """
+        with self._lock:
+            now = time.monotonic()
+            retry_after = 0.0
+            for key, limit in limits:
+                state = self._state(key, now)
+                retry_after = max(retry_after, self._retry_after(state, limit, min(units, limit), now))
+            if retry_after:
+                return False, retry_after
+                
+            for key, _ in limits:
+                self._counts[key][1] += units
+            return True, 0.0
+    
+    def add(self, limits: Sequence[Tuple[str, int]], units: float):
+        """Count further units against keys without checking the limits."""
+        with self._lock:
+            now = time.monotonic()
+            for key, _ in limits:
+                self._state(key, now)[1] += units
+    
+    def status(self, limits: Sequence[Tuple[str, int]]) -> Tuple[int, int, int]:
+        """
+        Quota of the tightest key.
+        
+        Returns:
+            (limit, whole units remaining, seconds until the whole limit is available again)
+        """
+        with self._lock:
+            now = time.monotonic()
+            quotas = []
+            for key, limit in limits:
+                state = self._state(key, now)
+                quotas.append((limit - self._count(state, now), limit, state))
+            remaining, limit, state = min(quotas, key=lambda quota: quota[:2])
+            reset = self._retry_after(state, limit, limit, now)
+            return limit, max(0, int(remaining)), math.ceil(reset)
+    
+    def _state(self, key: str, now: float) -> List[float]:
+        """Counts of a key, rolled forward to the current window."""
+        index = int(now // self.window)
+        state = self._counts.get(key)
+        if state is None or state[0] < index - 1:
+            if state is None and len(self._counts) >= self.max_keys:
+                self._counts = {k: v for k, v in self._counts.items() if v[0] >= index - 1}
+            state = self._counts[key] = [index, 0.0, 0.0]
+        elif state[0] == index - 1:
+            state[:] = [index, 0.0, state[1]]
+        return state
+    
+    def _count(self, state: List[float], now: float) -> float:
+        """Units in the sliding window ending now."""
+        return state[2] * (1 - now % self.window / self.window) + state[1]
+    
+    def _retry_after(self, state: List[float], limit: int, units: float, now: float) -> float:
+        """Seconds until units more fit under the limit (0 if they fit now)."""
+        if self._count(state, now) + units <= limit:
+            return 0.0
+        elapsed = now % self.window
+        _, current, previous = state
+        if current + units <= limit:
+            # Fits once enough of the previous window has slid out
+            return max(self.window * (1 - (limit - units - current) / previous) - elapsed, 1e-3)
+        # Fits once enough of this window has slid out, during the next one
+        return self.window - elapsed + self.window * (1 - (limit - units) / current)
+
+
+def create_rate_limiter(config: RateLimitConfig, app_config: AppConfig) -> RateLimiter:
+    """
+    Build the rate limiter for the configured backend.
+    
+    Args:
+        config: Bucket size and refill rate
+        app_config: Application configuration (rate_limit_backend and friends)
+        
+    Returns:
+        RateLimiter
+        
+    Raises:
+        ValueError: If the backend is unknown
+    """
+    backend = app_config.rate_limit_backend
+    if backend == 'memory':
+        return RateLimiter(config)
+    if backend == 'dynamodb':
+        from backend.aws_clients import ThreadLocalTable
+        table = ThreadLocalTable(app_config.dynamodb_table, app_config.aws_region)
+        return RateLimiter(config, DynamoDBBucketStore(table), max_lease=app_config.rate_limit_max_lease)
+    if backend == 'redis':
+        redis_url = app_config.rate_limit_redis_url or app_config.cache_redis_url
+        if not redis_url:
+            raise ValueError("RATE_LIMIT_REDIS_URL is required for the redis rate limit backend")
+        return RateLimiter(config, RedisBucketStore(redis_url), max_lease=app_config.rate_limit_max_lease)
+    raise ValueError(f"Unknown rate limit backend: {backend}")
@@ -1,22 +1,52 @@
-"""S3 storage management for images and thumbnails."""
+"""Image and thumbnail storage management (S3 by default, pluggable backends)."""
 import io
-import uuid
-from typing import Tuple, Optional
-from datetime import timedelta
-import boto3
+import hashlib
+import atexit
+from collections import OrderedDict
+from threading import Lock
+from typing import Tuple, Optional, Dict, Any, Union
+from datetime import datetime, timedelta, timezone
 from botocore.exceptions import ClientError
 from PIL import Image, ExifTags
 from backend.config import config_manager
+from backend.aws_clients import ThreadLocalTable, get_client
 from backend.models import ImageMetadata
+from backend.derivatives import DerivativeWorker
+from backend.storage import create_storage_backend, guess_content_type, StorageError, STORAGE_ERRORS
+from backend.ids import new_ulid
+from backend.db import expiry_time, TTL_ATTRIBUTE
+from backend.image_validation import decode_image, ImageValidationError
+
+# Maximum number of upload digests remembered by the local dedup index
+HASH_INDEX_SIZE = 1024
+
+# Maximum number of thumbnail keys remembered as already generated
+READY_THUMBNAILS_SIZE = 4096
+
+# Duplicate uploads restart a shared image's lifecycle age at most this often (seconds)
+TOUCH_INTERVAL = 86400
+
+# Content types accepted for direct browser uploads
+ALLOWED_UPLOAD_CONTENT_TYPES = {'image/jpeg', 'image/png'}
 
 
 class S3Manager:
-    """Manages S3 operations for image storage."""
+    """Manages image storage operations on the configured storage backend."""
     
     def __init__(self):
         self.config = config_manager.config
-        self.s3_client = boto3.client('s3', region_name=self.config.aws_region)
-        
+        self.s3_client = None
+        if self.config.storage_backend == 's3':
+            self.s3_client = get_client('s3', self.config.aws_region)
+        self.storage = create_storage_backend(self.config, self.s3_client)
+        self.refs_table = None
+        # Maps (user_id, raw upload digest, strip_exif) -> (content_hash, original_key)
+        self._hash_index: "OrderedDict[Tuple[str, str, bool], Tuple[str, str]]" = OrderedDict()
+        self._hash_index_lock = Lock()
+        self.derivative_worker: Optional[DerivativeWorker] = None
+        self._ready_thumbnails: "OrderedDict[str, None]" = OrderedDict()
+        self._worker_lock = Lock()
+    
     def upload_image(
         self,
         user_id: str,
@@ -38,95 +68,214 @@ class S3Manager:
         Returns:
             ImageMetadata with S3 URLs
         """
-        image_id = str(uuid.uuid4())
-        
-        # Load image
-        image = Image.open(io.BytesIO(file_data))
+        if self.config.content_addressed_storage:
+            return self._upload_content_addressed(user_id, file_data, filename, content_type, strip_exif)
+            
+        image_id = new_ulid()
         
-        # Strip EXIF if requested
-        if strip_exif:
-            image = self._strip_exif(image)
+        # Load and normalize image
+        image, original_body = self._normalize_image(file_data, strip_exif)
         
         # Upload original image
         original_key = f"images/{user_id}/{image_id}/original.{self._get_extension(filename)}"
-        original_buffer = io.BytesIO()
-        image.save(original_buffer, format=image.format or 'JPEG')
-        original_buffer.seek(0)
-        
-        self.s3_client.put_object(
-            Bucket=self.config.s3_bucket,
-            Key=original_key,
-            Body=original_buffer.getvalue(),
-            ContentType=content_type,
-            ServerSideEncryption='AES256',
-            Metadata={
-                'user_id': user_id,
-                'image_id': image_id,
-                'original_filename': filename
-            }
-        )
+        self._put_original(original_key, original_body, content_type, {
+            'user_id': user_id,
+            'image_id': image_id,
+            'original_filename': filename
+        })
         
         # Create and upload thumbnail
         thumbnail_key = f"images/{user_id}/{image_id}/thumbnail.jpg"
-        thumbnail = self._create_thumbnail(image, self.config.thumbnail_size)
-        thumbnail_buffer = io.BytesIO()
-        thumbnail.save(thumbnail_buffer, format='JPEG', quality=85)
-        thumbnail_buffer.seek(0)
-        
-        self.s3_client.put_object(
-            Bucket=self.config.s3_bucket,
-            Key=thumbnail_key,
-            Body=thumbnail_buffer.getvalue(),
-            ContentType='image/jpeg',
-            ServerSideEncryption='AES256'
-        )
+        self._create_or_defer_thumbnail(image, original_key, thumbnail_key)
         
         return ImageMetadata(
             user_id=user_id,
             image_id=image_id,
-            s3_url=f"s3://{self.config.s3_bucket}/{original_key}",
-            thumbnail_url=f"s3://{self.config.s3_bucket}/{thumbnail_key}",
+            s3_url=self.storage.url_for(original_key),
+            thumbnail_url=self.storage.url_for(thumbnail_key),
+            original_filename=filename,
+            file_size=len(file_data),
+            content_type=content_type
+        )
+    
+    def create_upload_post(
+        self,
+        user_id: str,
+        filename: str,
+        content_type: str,
+        expiry: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """
+        Create a presigned POST policy for uploading an image directly to S3.
+        
+        The policy pins the object key, content type and encryption, and limits
+        the body to the configured maximum image size.
+        
+        Args:
+            user_id: User ID
+            filename: Original filename
+            content_type: MIME type the browser will send
+            expiry: Policy expiry in seconds (default from config)
+            
+        Returns:
+            Dict with the form URL, form fields, image ID, key and expiry time
+            
+        Raises:
+            ValueError: If the content type is not accepted
+            StorageError: If the storage backend has no browser POST uploads (use upload_image)
+        """
+        if content_type.lower() not in ALLOWED_UPLOAD_CONTENT_TYPES:
+            raise ValueError(f"Invalid content type: {content_type}")
+            
+        image_id = new_ulid()
+        key = f"images/{user_id}/{image_id}/original.{self._get_extension(filename)}"
+        expiry_seconds = expiry or self.config.presigned_url_expiry
+        max_bytes = self.config.max_image_size_mb * 1024 * 1024
+        
+        fields = {
+            'Content-Type': content_type,
+            'x-amz-server-side-encryption': 'AES256',
+            'x-amz-meta-user_id': user_id,
+            'x-amz-meta-image_id': image_id
+        }
+        conditions = [{name: value} for name, value in fields.items()]
+        conditions.append(['content-length-range', 1, max_bytes])
+        
+        try:
+            post = self.storage.presign_post(key, fields, conditions, expiry_seconds)
+        except NotImplementedError:
+            raise StorageError(
+                f"Direct uploads are not available with the '{self.config.storage_backend}' storage backend"
+            )
+            
+        return {
+            'url': post['url'],
+            'fields': post['fields'],
+            'image_id': image_id,
+            'key': key,
+            'expires_at': (datetime.utcnow() + timedelta(seconds=expiry_seconds)).isoformat()
+        }
+    
+    def complete_upload(
+        self,
+        user_id: str,
+        key: str,
+        filename: str,
+        strip_exif: bool = True
+    ) -> Tuple[ImageMetadata, bytes]:
+        """
+        Finish a direct upload by reading the object back and creating its thumbnail.
+        
+        Args:
+            user_id: User ID
+            key: Object key returned by create_upload_post
+            filename: Original filename
+            strip_exif: Whether to rewrite the original without EXIF metadata
+            
+        Returns:
+            Tuple of (ImageMetadata with S3 URLs, stored image bytes for captioning)
+        """
+        prefix = f"images/{user_id}/"
+        parts = key[len(prefix):].split('/') if key.startswith(prefix) else []
+        if len(parts) != 2 or not parts[1].startswith('original.'):
+            raise PermissionError(f"User {user_id} does not have access to {key}")
+        image_id = parts[0]
+        
+        content_type = guess_content_type(key)
+        file_data = self.storage.get(key)
+        try:
+            image = decode_image(file_data)
+        except ImageValidationError:
+            # The POST policy cannot inspect contents, so reject bad uploads here
+            self.storage.delete_many([key])
+            raise
+            
+        # Browsers upload the raw file, so EXIF has to be removed server-side
+        if strip_exif and image.getexif():
+            image, file_data = self._normalize_image(file_data, strip_exif)
+            self._put_original(key, file_data, content_type, {
+                'user_id': user_id,
+                'image_id': image_id,
+                'original_filename': filename
+            })
+            
+        thumbnail_key = f"images/{user_id}/{image_id}/thumbnail.jpg"
+        self._create_or_defer_thumbnail(image, key, thumbnail_key)
+        
+        metadata = ImageMetadata(
+            user_id=user_id,
+            image_id=image_id,
+            s3_url=self.storage.url_for(key),
+            thumbnail_url=self.storage.url_for(thumbnail_key),
             original_filename=filename,
             file_size=len(file_data),
             content_type=content_type
         )
+        return metadata, file_data
     
     def get_presigned_url(self, s3_url: str, expiry: Optional[int] = None) -> str:
         """
-        Generate presigned URL for S3 object.
+        Generate presigned URL for a stored object.
         
         Args:
-            s3_url: S3 URL (s3://bucket/key format)
+            s3_url: Storage URL (s3://bucket/key format for S3)
             expiry: URL expiry in seconds (default from config)
             
         Returns:
             Presigned URL
         """
-        if not s3_url.startswith('s3://'):
+        parsed = self.storage.parse_url(s3_url)
+        if not parsed:
             return s3_url
-            
-        # Parse S3 URL
-        parts = s3_url[5:].split('/', 1)
-        bucket = parts[0]
-        key = parts[1] if len(parts) > 1 else ''
+        bucket, key = parsed
         
         expiry_seconds = expiry or self.config.presigned_url_expiry
         
         try:
-            url = self.s3_client.generate_presigned_url(
-                'get_object',
-                Params={'Bucket': bucket, 'Key': key},
-                ExpiresIn=expiry_seconds
-            )
-            return url
-        except ClientError as e:
+            return self.storage.presign(key, expiry_seconds, bucket=bucket)
+        except STORAGE_ERRORS as e:
             print(f"Error generating presigned URL: {e}")
             return ""
     
+    def get_thumbnail_view(self, thumbnail_url: str) -> Union[str, bytes]:
+        """
+        Get something displayable for a thumbnail.
+        
+        While a deferred thumbnail has not been generated yet, the original
+        is resized on the fly instead.
+        
+        Args:
+            thumbnail_url: Storage URL of the thumbnail
+            
+        Returns:
+            Presigned URL of the thumbnail, or JPEG bytes of a resized original
+        """
+        parsed = self.storage.parse_url(thumbnail_url)
+        if not self.config.async_thumbnails or not parsed:
+            return self.get_presigned_url(thumbnail_url)
+            
+        key = parsed[1]
+        if self._thumbnail_ready(key):
+            return self.get_presigned_url(thumbnail_url)
+            
+        try:
+            original_key = self._find_original_key(key)
+            if not original_key:
+                return ""
+            image = decode_image(self.storage.get(original_key), max_dimension=self.config.thumbnail_size)
+            return self._encode_thumbnail(image)
+        except STORAGE_ERRORS + (ImageValidationError,) as e:
+            print(f"Error creating thumbnail preview: {e}")
+            return ""
+    
     def delete_user_images(self, user_id: str) -> int:
         """
         Delete all images for a user.
         
+        Content-addressed images live under the same prefix, so this releases
+        every reference to them at once; their BLOB# counters go with the
+        user's partition (DynamoDBManager.delete_user_data).
+        
         Args:
             user_id: User ID
             
@@ -134,30 +283,276 @@ class S3Manager:
             Number of objects deleted
         """
         prefix = f"images/{user_id}/"
+        with self._hash_index_lock:
+            for index_key in [k for k in self._hash_index if k[0] == user_id]:
+                del self._hash_index[index_key]
+                
+        # List all objects for user, then delete them in batches
+        try:
+            keys = self.storage.list_prefix(prefix)
+            if not keys:
+                return 0
+            return self.storage.delete_many(keys)
+        except STORAGE_ERRORS as e:
+            print(f"Error deleting user images: {e}")
+            return 0
+    
+    def release_image(self, user_id: str, content_hash: str) -> bool:
+        """
+        Drop one reference to a content-addressed image.
+        
+        The shared original and thumbnail are deleted once the last
+        reference is released.
+        
+        Args:
+            user_id: User ID
+            content_hash: Content hash returned in ImageMetadata
+            
+        Returns:
+            True if the stored objects were deleted
+        """
+        table = self._get_refs_table()
+        ref_key = {'PK': f"USER#{user_id}", 'SK': f"BLOB#{content_hash}"}
         
-        # List all objects for user
         try:
-            response = self.s3_client.list_objects_v2(
-                Bucket=self.config.s3_bucket,
-                Prefix=prefix
+            response = table.update_item(
+                Key=ref_key,
+                UpdateExpression='ADD ref_count :dec',
+                ExpressionAttributeValues={':dec': -1},
+                ReturnValues='UPDATED_NEW'
             )
+            if response['Attributes']['ref_count'] > 0:
+                return False
+                
+            # Only the caller that removes the exhausted counter deletes the objects
+            table.delete_item(
+                Key=ref_key,
+                ConditionExpression='ref_count <= :zero',
+                ExpressionAttributeValues={':zero': 0}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                print(f"Error releasing image {content_hash}: {e}")
+            return False
             
-            if 'Contents' not in response:
-                return 0
+        prefix = self._content_prefix(user_id, content_hash)
+        try:
+            self.storage.delete_many(self.storage.list_prefix(prefix))
+        except STORAGE_ERRORS as e:
+            print(f"Error deleting image {content_hash}: {e}")
+            return False
+            
+        with self._hash_index_lock:
+            for index_key in [k for k, v in self._hash_index.items() if v[0] == content_hash and k[0] == user_id]:
+                del self._hash_index[index_key]
+        return True
+    
+    def _upload_content_addressed(
+        self,
+        user_id: str,
+        file_data: bytes,
+        filename: str,
+        content_type: str,
+        strip_exif: bool
+    ) -> ImageMetadata:
+        """Store image under a key derived from its normalized content, skipping duplicates."""
+        image_id = new_ulid()
+        index_key = (user_id, hashlib.sha256(file_data).hexdigest(), strip_exif)
+        
+        with self._hash_index_lock:
+            known = self._hash_index.get(index_key)
+            if known:
+                self._hash_index.move_to_end(index_key)
+                
+        image = None
+        original_body = None
+        if known:
+            content_hash, original_key = known
+        else:
+            image, original_body = self._normalize_image(file_data, strip_exif)
+            content_hash = hashlib.sha256(original_body).hexdigest()
+            original_key = f"{self._content_prefix(user_id, content_hash)}original.{self._format_extension(image)}"
+            self._remember_hash(index_key, (content_hash, original_key))
             
-            # Delete objects
-            objects = [{'Key': obj['Key']} for obj in response['Contents']]
+        thumbnail_key = f"{self._content_prefix(user_id, content_hash)}thumbnail.jpg"
+        
+        # Take the reference before looking at the objects, so a concurrent release
+        # of the last other reference cannot delete them after the check.
+        # The counter expires with the objects: captions removed by TTL never release their reference
+        now = datetime.now(timezone.utc)
+        expires = expiry_time(now, self.config.retention_days)
+        ref_key = {'PK': f"USER#{user_id}", 'SK': f"BLOB#{content_hash}"}
+        update = {
+            'UpdateExpression': 'ADD ref_count :inc',
+            'ExpressionAttributeValues': {':inc': 1},
+            'ReturnValues': 'ALL_OLD'
+        }
+        if expires:
+            # touched_at records when the objects' lifecycle age last started
+            update['UpdateExpression'] += ' SET #ttl = :ttl, touched_at = if_not_exists(touched_at, :now)'
+            update['ExpressionAttributeNames'] = {'#ttl': TTL_ATTRIBUTE}
+            update['ExpressionAttributeValues'].update({':ttl': expires, ':now': int(now.timestamp())})
+        counter = self._get_refs_table().update_item(Key=ref_key, **update).get('Attributes', {})
+        
+        try:
+            # A new counter means no other reference protects the objects (a release
+            # may still be deleting them), so they are written again
+            shared = counter.get('ref_count', 0) > 0
+            if not (shared and self._reuse_stored(ref_key, counter, original_key, thumbnail_key)):
+                if original_body is None:
+                    image, original_body = self._normalize_image(file_data, strip_exif)
+                if not self.config.async_thumbnails:
+                    self._put_thumbnail(image, thumbnail_key)
+                # Original goes last so its presence implies a complete set
+                self._put_original(original_key, original_body, content_type, {
+                    'user_id': user_id,
+                    'content_hash': content_hash
+                })
+                if self.config.async_thumbnails:
+                    self._get_derivative_worker().submit({'source_key': original_key, 'target_key': thumbnail_key})
+        except Exception:
+            # No caption will hold the reference
+            self.release_image(user_id, content_hash)
+            raise
+            
+        return ImageMetadata(
+            user_id=user_id,
+            image_id=image_id,
+            s3_url=self.storage.url_for(original_key),
+            thumbnail_url=self.storage.url_for(thumbnail_key),
+            original_filename=filename,
+            file_size=len(file_data),
+            content_type=content_type,
+            content_hash=content_hash
+        )
+    
+    def _reuse_stored(self, ref_key: Dict[str, str], counter: Dict[str, Any], original_key: str, thumbnail_key: str) -> bool:
+        """
+        Check a shared image is still stored, restarting its lifecycle age when due.
+        
+        The bucket's lifecycle rule expires objects retention_days after they
+        were written. Copying them onto themselves restarts that age but is
+        billed like a PUT, so it happens at most once per TOUCH_INTERVAL; the
+        objects can expire up to that long before the newest caption using them.
+        
+        Args:
+            ref_key: Key of the image's BLOB# reference counter
+            counter: Counter attributes before this upload's reference
+            original_key: Key of the stored original
+            thumbnail_key: Key of the stored thumbnail
             
-            if objects:
-                self.s3_client.delete_objects(
-                    Bucket=self.config.s3_bucket,
-                    Delete={'Objects': objects}
+        Returns:
+            False if the original is missing and must be written again
+        """
+        now = int(datetime.now(timezone.utc).timestamp())
+        if self.config.retention_days <= 0 or now - int(counter.get('touched_at', 0)) < TOUCH_INTERVAL:
+            return self.storage.exists(original_key)
+        if not self.storage.touch(original_key):
+            return False
+        self.storage.touch(thumbnail_key)
+        self._get_refs_table().update_item(
+            Key=ref_key,
+            UpdateExpression='SET touched_at = :now',
+            ExpressionAttributeValues={':now': now}
+        )
+        return True
+    
+    def _create_or_defer_thumbnail(self, image: Image.Image, original_key: str, thumbnail_key: str):
+        """Upload the thumbnail now, or queue it when thumbnails are generated in the background."""
+        if self.config.async_thumbnails:
+            self._get_derivative_worker().submit({'source_key': original_key, 'target_key': thumbnail_key})
+        else:
+            self._put_thumbnail(image, thumbnail_key)
+    
+    def _get_derivative_worker(self) -> DerivativeWorker:
+        """Lazy initialization of the background thumbnail worker."""
+        with self._worker_lock:
+            if not self.derivative_worker:
+                self.derivative_worker = DerivativeWorker(
+                    self._generate_thumbnail,
+                    queue_url=self.config.derivative_queue_url
                 )
-                
-            return len(objects)
-        except ClientError as e:
-            print(f"Error deleting user images: {e}")
-            return 0
+                # Finish locally queued thumbnails on interpreter shutdown
+                atexit.register(self.derivative_worker.stop)
+            return self.derivative_worker
+    
+    def _generate_thumbnail(self, job: Dict[str, Any]):
+        """Derivative job handler: build a thumbnail from the stored original."""
+        image = decode_image(self.storage.get(job['source_key']), max_dimension=self.config.thumbnail_size)
+        self._put_thumbnail(image, job['target_key'])
+        self._mark_thumbnail_ready(job['target_key'])
+    
+    def _thumbnail_ready(self, key: str) -> bool:
+        """Check whether a thumbnail object exists, remembering positive answers."""
+        with self._worker_lock:
+            if key in self._ready_thumbnails:
+                return True
+            pending = self.derivative_worker is not None and self.derivative_worker.is_pending(key)
+            
+        if pending or not self.storage.exists(key):
+            return False
+        self._mark_thumbnail_ready(key)
+        return True
+    
+    def _mark_thumbnail_ready(self, key: str):
+        """Remember that a thumbnail exists."""
+        with self._worker_lock:
+            self._ready_thumbnails[key] = None
+            while len(self._ready_thumbnails) > READY_THUMBNAILS_SIZE:
+                self._ready_thumbnails.popitem(last=False)
+    
+    def _find_original_key(self, thumbnail_key: str) -> Optional[str]:
+        """Locate the original stored next to a thumbnail."""
+        prefix = thumbnail_key.rsplit('/', 1)[0] + '/original.'
+        keys = self.storage.list_prefix(prefix, limit=1)
+        return keys[0] if keys else None
+    
+    def _get_refs_table(self):
+        """Lazy initialization of the reference-count table."""
+        if not self.refs_table:
+            self.refs_table = ThreadLocalTable(self.config.dynamodb_table, self.config.aws_region)
+        return self.refs_table
+    
+    def _remember_hash(self, index_key: Tuple[str, str, bool], value: Tuple[str, str]):
+        """Record a digest in the bounded local dedup index."""
+        with self._hash_index_lock:
+            self._hash_index[index_key] = value
+            self._hash_index.move_to_end(index_key)
+            while len(self._hash_index) > HASH_INDEX_SIZE:
+                self._hash_index.popitem(last=False)
+    
+    def _content_prefix(self, user_id: str, content_hash: str) -> str:
+        """Key prefix for content-addressed objects."""
+        return f"images/{user_id}/sha256/{content_hash}/"
+    
+    def _normalize_image(self, file_data: bytes, strip_exif: bool) -> Tuple[Image.Image, bytes]:
+        """Validate and decode image, optionally strip EXIF, and re-encode the bytes to store."""
+        image = decode_image(file_data)
+        
+        # Strip EXIF if requested
+        if strip_exif:
+            image = self._strip_exif(image)
+            
+        buffer = io.BytesIO()
+        image.save(buffer, format=image.format or 'JPEG')
+        return image, buffer.getvalue()
+    
+    def _put_original(self, key: str, body: bytes, content_type: str, metadata: dict):
+        """Upload the original image bytes."""
+        self.storage.put(key, body, content_type, metadata)
+    
+    def _put_thumbnail(self, image: Image.Image, key: str):
+        """Create and upload a JPEG thumbnail."""
+        self.storage.put(key, self._encode_thumbnail(image), 'image/jpeg')
+    
+    def _encode_thumbnail(self, image: Image.Image) -> bytes:
+        """Resize image to thumbnail size and encode it as JPEG."""
+        thumbnail = self._create_thumbnail(image, self.config.thumbnail_size)
+        if thumbnail.mode not in ('RGB', 'L'):
+            thumbnail = thumbnail.convert('RGB')
+        thumbnail_buffer = io.BytesIO()
+        thumbnail.save(thumbnail_buffer, format='JPEG', quality=85)
+        return thumbnail_buffer.getvalue()
     
     def _strip_exif(self, image: Image.Image) -> Image.Image:
         """Remove EXIF metadata from image."""
@@ -175,3 +570,7 @@ class S3Manager:
     def _get_extension(self, filename: str) -> str:
         """Extract file extension."""
         return filename.rsplit('.', 1)[-1].lower() if '.' in filename else 'jpg'
+    
+    def _format_extension(self, image: Image.Image) -> str:
+        """File extension matching the format the image is stored in."""
+        return 'png' if image.format == 'PNG' else 'jpg'
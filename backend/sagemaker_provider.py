@@ -3,10 +3,10 @@ import io
 import json
 from typing import Tuple, List, Optional
 from PIL import Image
-import boto3
 from botocore.exceptions import ClientError
 from backend.caption_base import CaptionProvider
 from backend.config import config_manager
+from backend.aws_clients import get_client
 
 
 class SageMakerProvider(CaptionProvider):
@@ -19,10 +19,7 @@ class SageMakerProvider(CaptionProvider):
     def _get_client(self):
         """Lazy initialization of SageMaker Runtime client."""
         if not self.client:
-            self.client = boto3.client(
-                'sagemaker-runtime',
-                region_name=self.config.aws_region
-            )
+            self.client = get_client('sagemaker-runtime', self.config.aws_region)
         return self.client
     
     def is_available(self) -> bool:
@@ -0,0 +1,107 @@
+"""Tokenization and index keys for per-user caption search."""
+import re
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+# Index entries live in the user's partition: SK = TOKEN#<token>#<caption sort id>
+TOKEN_PREFIX = 'TOKEN#'
+
+# Tokens outside these bounds are not indexed
+MIN_TOKEN_LENGTH = 2
+MAX_TOKEN_LENGTH = 40
+
+# Upper bound on index entries written per caption
+MAX_TOKENS_PER_CAPTION = 100
+
+# Words too common in captions to be useful search terms
+STOP_WORDS = frozenset({
+    'a', 'an', 'and', 'are', 'as', 'at', 'by', 'for', 'from', 'in', 'into',
+    'is', 'it', 'its', 'of', 'on', 'or', 'the', 'to', 'with'
+})
+
+_WORD = re.compile(r'[^\W_]+')
+
+# A search term and whether it matches as a prefix
+SearchTerm = Tuple[str, bool]
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into lowercase index tokens, in order of first appearance.
+    
+    Args:
+        text: Caption or label text
+        
+    Returns:
+        Unique tokens
+    """
+    tokens = []
+    for word in _WORD.findall(text.lower()):
+        if MIN_TOKEN_LENGTH <= len(word) <= MAX_TOKEN_LENGTH and word not in STOP_WORDS:
+            tokens.append(word)
+    return list(dict.fromkeys(tokens))
+
+
+def caption_tokens(item: Dict[str, Any]) -> Set[str]:
+    """
+    Tokens indexed for a caption item: labels first, then both captions.
+    
+    Args:
+        item: Caption item (or None for a caption that did not exist)
+        
+    Returns:
+        Set of at most MAX_TOKENS_PER_CAPTION tokens
+    """
+    if not item:
+        return set()
+    texts = list(item.get('labels') or [])
+    texts += [item.get('concise_caption') or '', item.get('creative_caption') or '']
+    tokens: List[str] = []
+    for text in texts:
+        tokens.extend(tokenize(text))
+    return set(list(dict.fromkeys(tokens))[:MAX_TOKENS_PER_CAPTION])
+
+
+def parse_query(query: str) -> List[SearchTerm]:
+    """
+    Parse a search query into AND-ed terms.
+    
+    A trailing '*' makes a term match as a prefix ("beach dog*" finds
+    captions containing "beach" and any word starting with "dog").
+    
+    Args:
+        query: Query text
+        
+    Returns:
+        Unique (term, is_prefix) pairs
+    """
+    terms: List[SearchTerm] = []
+    for word in query.split():
+        tokens = _WORD.findall(word.lower())
+        for position, token in enumerate(tokens):
+            # Only the last token of a starred word is a prefix: "golden-ret*" is golden AND ret*
+            is_prefix = word.endswith('*') and position == len(tokens) - 1
+            if len(token) > MAX_TOKEN_LENGTH:
+                continue
+            if not is_prefix and (len(token) < MIN_TOKEN_LENGTH or token in STOP_WORDS):
+                continue
+            terms.append((token, is_prefix))
+    return list(dict.fromkeys(terms))
+
+
+def matches(tokens: Set[str], terms: Iterable[SearchTerm]) -> bool:
+    """Check that every term matches one of a caption's tokens."""
+    return all(
+        any(token.startswith(term) for token in tokens) if is_prefix else term in tokens
+        for term, is_prefix in terms
+    )
+
+
+def index_key(user_id: str, token: str, sort_id: str) -> Dict[str, str]:
+    """Primary key of the index entry for a token of a caption."""
+    return {'PK': f"USER#{user_id}", 'SK': f"{TOKEN_PREFIX}{token}#{sort_id}"}
+
+
+def term_prefix(term: SearchTerm) -> str:
+    """Sort key prefix of the index entries matching a term."""
+    token, is_prefix = term
+    return f"{TOKEN_PREFIX}{token}" if is_prefix else f"{TOKEN_PREFIX}{token}#"
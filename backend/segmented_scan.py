@@ -0,0 +1,128 @@
+"""Building blocks for resumable, throttled parallel scans of a table."""
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional
+
+
+class CapacityThrottle:
+    """
+    Token bucket on consumed capacity (or items), shared by all scan workers.
+    
+    Work is done first and paid for afterwards, so workers sleep off any
+    debt before their next request. Bursts are capped at one second of budget.
+    """
+    
+    def __init__(self, units_per_second: float):
+        """
+        Initialize the throttle.
+        
+        Args:
+            units_per_second: Target units consumed per second
+        """
+        self.rate = units_per_second
+        self._available = units_per_second
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def consume(self, units: float) -> float:
+        """
+        Charge consumed units and wait until the budget allows another request.
+        
+        Args:
+            units: Units consumed by the last request
+            
+        Returns:
+            Seconds slept
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._available = min(self.rate, self._available + (now - self._updated) * self.rate)
+            self._updated = now
+            self._available -= units
+            delay = -self._available / self.rate if self._available < 0 else 0.0
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class ScanCheckpoint:
+    """
+    Per-segment scan positions, persisted atomically after every save.
+    
+    A position is the segment's LastEvaluatedKey ('key'), a 'done' flag and
+    any counters the job keeps. The file also records the job's parameters,
+    so a checkpoint is never resumed by a job with a different layout.
+    """
+    
+    def __init__(self, path: str, job: Dict[str, Any], initial: Optional[Dict[str, Any]] = None):
+        """
+        Load the checkpoint, or start a new one.
+        
+        Args:
+            path: Checkpoint file
+            job: JSON-serializable job parameters, including the segment count
+            initial: Counters of a segment that has not started
+            
+        Raises:
+            ValueError: If the file belongs to a job with other parameters
+        """
+        self.path = path
+        self.initial = dict(initial or {}, key=None)
+        self._lock = threading.Lock()
+        self.state = {'job': job, 'positions': {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved['job'] != job:
+                raise ValueError(f"{path} belongs to a different job: {saved['job']}")
+            self.state = saved
+    
+    def position(self, segment: int) -> Dict[str, Any]:
+        """Saved position of a segment, or the start of the segment."""
+        with self._lock:
+            return dict(self.state['positions'].get(str(segment), self.initial))
+    
+    def save(self, segment: int, position: Dict[str, Any]):
+        """Record a segment's position once the work up to it is durable."""
+        with self._lock:
+            self.state['positions'][str(segment)] = dict(position)
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(self.state, f)
+            os.replace(temp_path, self.path)
+    
+    def total(self, counter: str) -> int:
+        """Sum of a counter over all segments."""
+        with self._lock:
+            return sum(position.get(counter, 0) for position in self.state['positions'].values())
+
+
+def scan_pages(
+    client,
+    params: Dict[str, Any],
+    segment: int,
+    start_key: Optional[Dict[str, Any]] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    Scan responses of one segment, page by page.
+    
+    Args:
+        client: DynamoDB client (thread-safe, unlike the Table resource)
+        params: Scan parameters, including TotalSegments
+        segment: Segment to scan
+        start_key: LastEvaluatedKey to resume after
+        
+    Yields:
+        Scan responses; the last one has no LastEvaluatedKey
+    """
+    params = dict(params, Segment=segment)
+    if start_key:
+        params['ExclusiveStartKey'] = start_key
+    while True:
+        response = client.scan(**params)
+        yield response
+        if not response.get('LastEvaluatedKey'):
+            return
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
@@ -0,0 +1,524 @@
+"""Pluggable object storage backends for images and thumbnails."""
+import os
+import base64
+import mimetypes
+from abc import ABC, abstractmethod
+from datetime import timedelta
+from threading import Lock
+from typing import Dict, Any, List, Iterable, Optional, Tuple
+from botocore.exceptions import ClientError
+from backend.models import AppConfig
+from backend.aws_clients import get_client
+
+
+class StorageError(Exception):
+    """Raised by backends for storage failures that are not a missing object."""
+
+
+# Exceptions callers should treat as a failed storage operation
+STORAGE_ERRORS = (ClientError, StorageError, OSError)
+
+
+class StorageBackend(ABC):
+    """Abstract base class for object storage backends."""
+    
+    scheme = ""
+    
+    def __init__(self, bucket: str):
+        self.bucket = bucket
+    
+    @abstractmethod
+    def put(self, key: str, data: bytes, content_type: str, metadata: Optional[Dict[str, str]] = None):
+        """
+        Store an object.
+        
+        Args:
+            key: Object key
+            data: Object bytes
+            content_type: MIME type
+            metadata: Optional user metadata
+        """
+        pass
+    
+    @abstractmethod
+    def get(self, key: str) -> bytes:
+        """
+        Read an object.
+        
+        Args:
+            key: Object key
+            
+        Returns:
+            Object bytes
+            
+        Raises:
+            FileNotFoundError: If the object does not exist
+        """
+        pass
+    
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        """Check whether an object exists."""
+        pass
+    
+    def touch(self, key: str) -> bool:
+        """
+        Restart an object's age, so age-based lifecycle rules count from now.
+        
+        Backends without lifecycle rules only check that the object exists.
+        
+        Args:
+            key: Object key
+            
+        Returns:
+            False if the object does not exist or cannot be copied (archived)
+        """
+        return self.exists(key)
+    
+    @abstractmethod
+    def delete_many(self, keys: Iterable[str]) -> int:
+        """
+        Delete objects.
+        
+        Args:
+            keys: Object keys
+            
+        Returns:
+            Number of objects deleted
+        """
+        pass
+    
+    @abstractmethod
+    def list_prefix(self, prefix: str, limit: Optional[int] = None) -> List[str]:
+        """
+        List object keys under a prefix, following pagination.
+        
+        Args:
+            prefix: Key prefix
+            limit: Maximum number of keys to return
+            
+        Returns:
+            List of keys
+        """
+        pass
+    
+    @abstractmethod
+    def presign(
+        self,
+        key: str,
+        expiry: int,
+        method: str = 'GET',
+        content_type: Optional[str] = None,
+        bucket: Optional[str] = None
+    ) -> str:
+        """
+        Create a time-limited URL for reading or writing an object.
+        
+        Args:
+            key: Object key
+            expiry: Expiry in seconds
+            method: 'GET' or 'PUT'
+            content_type: Content type a PUT must send
+            bucket: Bucket override for backends that support several buckets
+            
+        Returns:
+            URL string
+        """
+        pass
+    
+    def presign_post(
+        self,
+        key: str,
+        fields: Dict[str, str],
+        conditions: List[Any],
+        expiry: int
+    ) -> Dict[str, Any]:
+        """Create a browser POST policy. Only object stores with form uploads support this."""
+        raise NotImplementedError(f"{type(self).__name__} does not support POST uploads")
+    
+    def url_for(self, key: str) -> str:
+        """Build the storage URL recorded for an object."""
+        return f"{self.scheme}://{self.bucket}/{key}"
+    
+    def parse_url(self, url: str) -> Optional[Tuple[str, str]]:
+        """
+        Split a storage URL into bucket and key.
+        
+        Returns:
+            (bucket, key) tuple, or None if the URL belongs to another scheme
+        """
+        prefix = f"{self.scheme}://"
+        if not url.startswith(prefix):
+            return None
+        parts = url[len(prefix):].split('/', 1)
+        return parts[0], parts[1] if len(parts) > 1 else ''
+
+
+class S3Storage(StorageBackend):
+    """Amazon S3 storage backend."""
+    
+    scheme = "s3"
+    
+    def __init__(self, client, bucket: str):
+        super().__init__(bucket)
+        self.client = client
+    
+    def put(self, key: str, data: bytes, content_type: str, metadata: Optional[Dict[str, str]] = None):
+        """Store an object with server-side encryption."""
+        params = {
+            'Bucket': self.bucket,
+            'Key': key,
+            'Body': data,
+            'ContentType': content_type,
+            'ServerSideEncryption': 'AES256'
+        }
+        if metadata:
+            params['Metadata'] = metadata
+        self.client.put_object(**params)
+    
+    def get(self, key: str) -> bytes:
+        """Read an object."""
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(key)
+            raise
+        return response['Body'].read()
+    
+    def exists(self, key: str) -> bool:
+        """Check whether an object exists with a HEAD request."""
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+    
+    def touch(self, key: str) -> bool:
+        """Copy an object onto itself, which gives it a new last-modified time."""
+        try:
+            # An in-place copy is only accepted when it sets encryption (or metadata)
+            self.client.copy_object(
+                Bucket=self.bucket,
+                Key=key,
+                CopySource={'Bucket': self.bucket, 'Key': key},
+                MetadataDirective='COPY',
+                ServerSideEncryption='AES256'
+            )
+            return True
+        except ClientError as e:
+            # Objects transitioned to Glacier must be written again instead
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound', 'InvalidObjectState'):
+                return False
+            raise
+    
+    def delete_many(self, keys: Iterable[str]) -> int:
+        """Delete objects in batches of 1000 (the DeleteObjects maximum)."""
+        keys = list(keys)
+        deleted = 0
+        for start in range(0, len(keys), 1000):
+            chunk = keys[start:start + 1000]
+            response = self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': key} for key in chunk], 'Quiet': True}
+            )
+            errors = response.get('Errors', []) if isinstance(response, dict) else []
+            deleted += len(chunk) - len(errors)
+        return deleted
+    
+    def list_prefix(self, prefix: str, limit: Optional[int] = None) -> List[str]:
+        """List keys under a prefix, following continuation tokens."""
+        keys: List[str] = []
+        params = {'Bucket': self.bucket, 'Prefix': prefix}
+        if limit:
+            params['MaxKeys'] = min(limit, 1000)
+            
+        while True:
+            response = self.client.list_objects_v2(**params)
+            keys.extend(obj['Key'] for obj in response.get('Contents', []))
+            if (limit and len(keys) >= limit) or not response.get('IsTruncated'):
+                break
+            params['ContinuationToken'] = response['NextContinuationToken']
+            
+        return keys[:limit] if limit else keys
+    
+    def presign(
+        self,
+        key: str,
+        expiry: int,
+        method: str = 'GET',
+        content_type: Optional[str] = None,
+        bucket: Optional[str] = None
+    ) -> str:
+        """Create a presigned GET or PUT URL."""
+        params = {'Bucket': bucket or self.bucket, 'Key': key}
+        if method == 'PUT' and content_type:
+            params['ContentType'] = content_type
+        return self.client.generate_presigned_url(
+            'put_object' if method == 'PUT' else 'get_object',
+            Params=params,
+            ExpiresIn=expiry
+        )
+    
+    def presign_post(
+        self,
+        key: str,
+        fields: Dict[str, str],
+        conditions: List[Any],
+        expiry: int
+    ) -> Dict[str, Any]:
+        """Create a presigned POST policy."""
+        return self.client.generate_presigned_post(
+            Bucket=self.bucket,
+            Key=key,
+            Fields=fields,
+            Conditions=conditions,
+            ExpiresIn=expiry
+        )
+
+
+class GCSStorage(StorageBackend):
+    """Google Cloud Storage backend."""
+    
+    scheme = "gs"
+    
+    def __init__(self, bucket: str, credentials_path: Optional[str] = None, client=None):
+        super().__init__(bucket)
+        if client is None:
+            # Optional dependency, only needed when this backend is selected
+            from google.cloud import storage
+            if credentials_path:
+                client = storage.Client.from_service_account_json(credentials_path)
+            else:
+                client = storage.Client()
+        self.client = client
+        self._bucket = client.bucket(bucket)
+    
+    def put(self, key: str, data: bytes, content_type: str, metadata: Optional[Dict[str, str]] = None):
+        """Store an object."""
+        blob = self._bucket.blob(key)
+        if metadata:
+            blob.metadata = metadata
+        self._call(blob.upload_from_string, data, content_type=content_type)
+    
+    def get(self, key: str) -> bytes:
+        """Read an object."""
+        from google.api_core.exceptions import GoogleAPIError, NotFound
+        try:
+            return self._bucket.blob(key).download_as_bytes()
+        except NotFound:
+            raise FileNotFoundError(key)
+        except GoogleAPIError as e:
+            raise StorageError(str(e))
+    
+    def exists(self, key: str) -> bool:
+        """Check whether an object exists."""
+        return self._call(self._bucket.blob(key).exists)
+    
+    def touch(self, key: str) -> bool:
+        """Rewrite an object onto itself, which creates a generation with a new creation time."""
+        from google.api_core.exceptions import GoogleAPIError, NotFound
+        try:
+            self._bucket.copy_blob(self._bucket.blob(key), self._bucket, key)
+            return True
+        except NotFound:
+            return False
+        except GoogleAPIError as e:
+            raise StorageError(str(e))
+    
+    def delete_many(self, keys: Iterable[str]) -> int:
+        """Delete objects, skipping any that are already gone.
+        
+        Batched requests only report the last failure, so missing objects
+        could not be told apart from deleted ones; delete_blobs hands each
+        NotFound to on_error instead.
+        """
+        blobs = [self._bucket.blob(key) for key in keys]
+        missing = []
+        self._call(self._bucket.delete_blobs, blobs, on_error=missing.append)
+        return len(blobs) - len(missing)
+    
+    def list_prefix(self, prefix: str, limit: Optional[int] = None) -> List[str]:
+        """List keys under a prefix."""
+        blobs = self.client.list_blobs(self.bucket, prefix=prefix, max_results=limit)
+        return self._call(lambda: [blob.name for blob in blobs])
+    
+    def presign(
+        self,
+        key: str,
+        expiry: int,
+        method: str = 'GET',
+        content_type: Optional[str] = None,
+        bucket: Optional[str] = None
+    ) -> str:
+        """Create a V4 signed URL."""
+        target = self.client.bucket(bucket) if bucket else self._bucket
+        return self._call(
+            target.blob(key).generate_signed_url,
+            version="v4",
+            expiration=timedelta(seconds=expiry),
+            method=method,
+            headers={'Content-Type': content_type} if method == 'PUT' and content_type else None
+        )
+    
+    def _call(self, func, *args, **kwargs):
+        """Invoke a client call, translating Google API errors."""
+        from google.api_core.exceptions import GoogleAPIError
+        try:
+            return func(*args, **kwargs)
+        except GoogleAPIError as e:
+            raise StorageError(str(e))
+
+
+class LocalStorage(StorageBackend):
+    """Local filesystem backend for development, benchmarks and offline tests."""
+    
+    scheme = "local"
+    
+    def __init__(self, root: str, bucket: str = "local"):
+        super().__init__(bucket)
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+    
+    def put(self, key: str, data: bytes, content_type: str, metadata: Optional[Dict[str, str]] = None):
+        """Store an object as a file, writing atomically via a temp file."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    
+    def get(self, key: str) -> bytes:
+        """Read an object."""
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+    
+    def exists(self, key: str) -> bool:
+        """Check whether an object exists."""
+        return os.path.isfile(self._path(key))
+    
+    def delete_many(self, keys: Iterable[str]) -> int:
+        """Delete files."""
+        deleted = 0
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+                deleted += 1
+            except FileNotFoundError:
+                pass
+        return deleted
+    
+    def list_prefix(self, prefix: str, limit: Optional[int] = None) -> List[str]:
+        """List keys under a prefix in sorted order."""
+        keys = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, '/')
+                if key.startswith(prefix) and '.tmp-' not in filename:
+                    keys.append(key)
+        keys.sort()
+        return keys[:limit] if limit else keys
+    
+    def presign(
+        self,
+        key: str,
+        expiry: int,
+        method: str = 'GET',
+        content_type: Optional[str] = None,
+        bucket: Optional[str] = None
+    ) -> str:
+        """Local files need no signing; return the file path."""
+        return self._path(key)
+    
+    def _path(self, key: str) -> str:
+        """Resolve a key to a path inside the storage root."""
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise PermissionError(f"Key escapes storage root: {key}")
+        return path
+
+
+class MemoryStorage(StorageBackend):
+    """In-memory backend for unit tests and CPU-only benchmarks."""
+    
+    scheme = "memory"
+    
+    def __init__(self, bucket: str = "memory"):
+        super().__init__(bucket)
+        self.objects: Dict[str, Tuple[bytes, str]] = {}
+        self._lock = Lock()
+    
+    def put(self, key: str, data: bytes, content_type: str, metadata: Optional[Dict[str, str]] = None):
+        """Store an object."""
+        with self._lock:
+            self.objects[key] = (bytes(data), content_type)
+    
+    def get(self, key: str) -> bytes:
+        """Read an object."""
+        with self._lock:
+            if key not in self.objects:
+                raise FileNotFoundError(key)
+            return self.objects[key][0]
+    
+    def exists(self, key: str) -> bool:
+        """Check whether an object exists."""
+        with self._lock:
+            return key in self.objects
+    
+    def delete_many(self, keys: Iterable[str]) -> int:
+        """Delete objects."""
+        with self._lock:
+            return sum(1 for key in keys if self.objects.pop(key, None) is not None)
+    
+    def list_prefix(self, prefix: str, limit: Optional[int] = None) -> List[str]:
+        """List keys under a prefix in sorted order."""
+        with self._lock:
+            keys = sorted(key for key in self.objects if key.startswith(prefix))
+        return keys[:limit] if limit else keys
+    
+    def presign(
+        self,
+        key: str,
+        expiry: int,
+        method: str = 'GET',
+        content_type: Optional[str] = None,
+        bucket: Optional[str] = None
+    ) -> str:
+        """Return a data: URL with the object inlined."""
+        with self._lock:
+            data, stored_type = self.objects.get(key, (b'', content_type or 'application/octet-stream'))
+        return f"data:{stored_type};base64,{base64.b64encode(data).decode('ascii')}"
+
+
+def create_storage_backend(config: AppConfig, s3_client=None) -> StorageBackend:
+    """
+    Create the storage backend selected by configuration.
+    
+    Args:
+        config: Application configuration; s3_bucket names the bucket for S3 and GCS
+        s3_client: Optional preconfigured S3 client
+        
+    Returns:
+        StorageBackend instance
+    """
+    backend = config.storage_backend.lower()
+    
+    if backend == "s3":
+        client = s3_client or get_client('s3', config.aws_region)
+        return S3Storage(client, config.s3_bucket)
+    if backend == "gcs":
+        return GCSStorage(config.s3_bucket, credentials_path=config.gcs_credentials_path)
+    if backend == "local":
+        return LocalStorage(config.local_storage_path, bucket=config.s3_bucket or "local")
+    if backend == "memory":
+        return MemoryStorage(bucket=config.s3_bucket or "memory")
+        
+    raise ValueError(f"Unknown storage backend: {config.storage_backend}")
+
+
+def guess_content_type(key: str) -> str:
+    """Guess an object's MIME type from its key."""
+    return mimetypes.guess_type(key)[0] or 'application/octet-stream'
@@ -4,10 +4,10 @@ import secrets
 import re
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
-import boto3
 from botocore.exceptions import ClientError
 
 from backend.config import config_manager
+from backend.aws_clients import get_resource
 
 
 class UserAuthManager:
@@ -21,21 +21,15 @@ class UserAuthManager:
         import os
         self.is_local = os.getenv('ENVIRONMENT', 'local') == 'local'
         
-        # Initialize DynamoDB
+        # DynamoDB connection settings; see the dynamodb property
+        self._resource_kwargs = {}
         if self.is_local:
-            self.dynamodb = boto3.resource(
-                'dynamodb',
-                endpoint_url='http://localhost:4566',
-                region_name=self.config.aws_region,
-                aws_access_key_id='test',
-                aws_secret_access_key='test'
-            )
-        else:
-            self.dynamodb = boto3.resource(
-                'dynamodb',
-                region_name=self.config.aws_region
-            )
-        
+            self._resource_kwargs = {
+                'endpoint_url': 'http://localhost:4566',
+                'aws_access_key_id': 'test',
+                'aws_secret_access_key': 'test'
+            }
+            
         self.users_table_name = f"{self.config.dynamodb_table}-users"
         self.sessions_table_name = f"{self.config.dynamodb_table}-sessions"
         
@@ -43,6 +37,11 @@ class UserAuthManager:
         if self.is_local:
             self._create_tables_if_not_exist()
     
+    @property
+    def dynamodb(self):
+        """The calling thread's DynamoDB resource; resources are not thread-safe."""
+        return get_resource('dynamodb', self.config.aws_region, **self._resource_kwargs)
+    
     def _create_tables_if_not_exist(self):
         """Create DynamoDB tables for local testing."""
         try:
@@ -0,0 +1,166 @@
+"""Write-behind buffering of caption writes into DynamoDB batch writes."""
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from botocore.exceptions import BotoCoreError, ClientError
+from backend.models import CaptionResult
+
+# BatchWriteItem accepts at most 25 requests
+MAX_BATCH_SIZE = 25
+
+# (table item, file size, processing time) for each buffered caption
+PendingCaption = Tuple[Dict[str, Any], int, Optional[float]]
+
+
+class CaptionWriteBuffer:
+    """
+    Buffers captions and writes them with batch_writer by size or time.
+    
+    Items are flushed when a full batch is waiting or every flush_interval
+    seconds. A failed flush puts its items back to be retried by the next one.
+    """
+    
+    def __init__(
+        self,
+        db_manager,
+        flush_interval: float = 1.0,
+        max_pending: int = 1000,
+        count_usage: bool = True
+    ):
+        """
+        Initialize the buffer.
+        
+        Args:
+            db_manager: DynamoDBManager whose table receives the writes
+            flush_interval: Maximum seconds a caption waits before being written
+            max_pending: Buffered captions at which add() flushes synchronously
+            count_usage: Whether flushed captions update the usage counters;
+                disable for jobs that overwrite existing captions
+        """
+        self.db_manager = db_manager
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.count_usage = count_usage
+        self._pending: List[PendingCaption] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    def add(self, caption_result: CaptionResult, file_size: int = 0, processing_time: Optional[float] = None):
+        """
+        Buffer a caption for writing.
+        
+        Args:
+            caption_result: CaptionResult to save
+            file_size: Stored image size in bytes
+            processing_time: Caption generation time in seconds
+        """
+        item = self.db_manager._caption_item(caption_result, file_size)
+        with self._lock:
+            self._pending.append((item, file_size, processing_time))
+            pending = len(self._pending)
+            
+        if pending >= self.max_pending:
+            # Apply backpressure instead of growing without bound
+            self.flush()
+        elif pending >= MAX_BATCH_SIZE:
+            self._wakeup.set()
+        self.start()
+    
+    def has_pending(self, user_id: str) -> bool:
+        """Check whether captions for a user are waiting to be written."""
+        pk = f"USER#{user_id}"
+        with self._lock:
+            return any(item['PK'] == pk for item, _, _ in self._pending)
+    
+    def discard(self, user_id: str) -> int:
+        """
+        Drop a user's buffered captions, e.g. before erasing their data.
+        
+        Args:
+            user_id: User ID
+            
+        Returns:
+            Number of captions dropped
+        """
+        pk = f"USER#{user_id}"
+        with self._lock:
+            kept = [entry for entry in self._pending if entry[0]['PK'] != pk]
+            dropped = len(self._pending) - len(kept)
+            self._pending = kept
+            
+        # Wait for an in-flight flush that may still be writing them
+        with self._flush_lock:
+            return dropped
+    
+    def flush(self) -> int:
+        """
+        Write all buffered captions now.
+        
+        Returns:
+            Number of captions written
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+                
+            try:
+                # batch_writer groups puts into 25-item requests and resends UnprocessedItems
+                with self.db_manager.table.batch_writer(overwrite_by_pkeys=['PK', 'SK']) as writer:
+                    for item, _, _ in batch:
+                        writer.put_item(Item=item)
+            except (ClientError, BotoCoreError) as e:
+                print(f"Error flushing caption writes: {e}")
+                with self._lock:
+                    self._pending = batch + self._pending
+                return 0
+                
+            if self.count_usage:
+                self.db_manager._record_usage([
+                    (item['user_id'], item['provider'], file_size, processing_time)
+                    for item, file_size, processing_time in batch
+                ])
+            for user_id in {item['user_id'] for item, _, _ in batch}:
+                self.db_manager._invalidate_history(user_id)
+            # Like the usage counters, index entries treat every flushed caption as new
+            for item, _, _ in batch:
+                self.db_manager._update_indexes(None, item)
+            return len(batch)
+    
+    def start(self):
+        """Start the background flush thread if it is not running."""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='caption-write-behind', daemon=True)
+            self._thread.start()
+    
+    def stop(self, drain: bool = True, timeout: Optional[float] = 30):
+        """
+        Stop the flush thread, optionally writing everything still buffered.
+        
+        Args:
+            drain: Whether to flush buffered captions before returning
+            timeout: Maximum seconds to wait for the thread
+        """
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+        if drain:
+            self.flush()
+    
+    def _run(self):
+        """Flush periodically, or as soon as a full batch is waiting."""
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # Keep the flusher alive; unwritten captions stay buffered
+                print(f"Error in caption write-behind thread: {e}")
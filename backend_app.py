@@ -15,6 +15,7 @@ import json
 import logging
 from functools import wraps
 from dotenv import load_dotenv
+from auth_security import RateLimitConfig, RateLimitMiddleware
 
 # Load environment variables
 load_dotenv()
@@ -25,11 +26,15 @@ app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'your-secret-key-chan
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=1)
 
 # Enable CORS
-CORS(app, origins=["http://localhost:3000", "https://yourdomain.com"])
+CORS(app, origins=["http://localhost:3000", "https://yourdomain.com"],
+     expose_headers=['RateLimit-Limit', 'RateLimit-Remaining', 'RateLimit-Reset', 'Retry-After'])
 
 # Initialize JWT
 jwt = JWTManager(app)
 
+# Per-endpoint rate limits (auth_security.RateLimitConfig)
+rate_limits = RateLimitMiddleware(app)
+
 # Initialize Firebase Admin SDK
 def initialize_firebase():
     try:
@@ -135,6 +140,7 @@ def health_check():
     })
 
 @app.route('/auth/login', methods=['POST'])
+@rate_limits.limit('auth_login')
 def login():
     """Authenticate user with Firebase ID token and return JWT"""
     if not firebase_initialized:
@@ -175,6 +181,7 @@ def login():
 
 @app.route('/storage/upload-url', methods=['POST'])
 @verify_firebase_token
+@rate_limits.limit('upload_url')
 def get_upload_url():
     """Generate signed URL for uploading images"""
     try:
@@ -206,6 +213,7 @@ def get_upload_url():
 
 @app.route('/storage/download-url', methods=['POST'])
 @verify_firebase_token
+@rate_limits.limit('download_url')
 def get_download_url():
     """Generate signed URL for downloading images"""
     try:
@@ -235,6 +243,7 @@ def get_download_url():
 
 @app.route('/ai/generate-caption', methods=['POST'])
 @verify_firebase_token
+@rate_limits.limit('generate_caption')
 def generate_caption():
     """Generate AI caption for uploaded image"""
     if not processor or not model:
@@ -261,6 +270,11 @@ def generate_caption():
         image_bytes = blob.download_as_bytes()
         image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
         
+        # Large images cost more than the unit admitted; refuse them before running the model
+        rejected = rate_limits.charge(RateLimitConfig.image_cost(image.width, image.height) - 1)
+        if rejected:
+            return rejected
+            
         # Generate basic caption using BLIP
         inputs = processor(image, return_tensors="pt")
         out = model.generate(**inputs, max_length=50, num_beams=4)
@@ -0,0 +1,87 @@
+"""Benchmark the resource layer's TypeSerializer/TypeDeserializer vs backend.dynamo_codec.
+
+Usage:
+    python benchmarks/dynamo_codec.py --items 50000
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from backend.dynamo_codec import decode_item, encode_item
+
+
+def make_items(count):
+    """Plain caption items in the stored shape."""
+    start = datetime(2024, 1, 1)
+    items = []
+    for i in range(count):
+        timestamp = (start + timedelta(seconds=i)).isoformat()
+        items.append({
+            'PK': 'USER#bench', 'SK': f"IMAGE#{i:026d}", 'image_id': f"{i:026d}", 'user_id': 'bench',
+            'concise_caption': 'A dog running on a beach',
+            'creative_caption': 'A joyful dog races along the shoreline as waves roll in at sunset',
+            'labels': ['dog', 'beach', 'sea', 'animal'], 'model': 'anthropic.claude-3-sonnet',
+            'provider': 'bedrock', 'confidence': Decimal('0.93'), 'timestamp': timestamp,
+            's3_url': f"s3://bucket/images/bench/{i}/original.jpg",
+            'thumbnail_url': f"s3://bucket/images/bench/{i}/thumbnail.jpg",
+            'file_size': 123456, 'GSI1PK': f"IMAGE#{i:026d}", 'GSI1SK': timestamp
+        })
+    return items
+
+
+def resource_encode(items):
+    serializer = TypeSerializer()
+    return [{name: serializer.serialize(value) for name, value in item.items()} for item in items]
+
+
+def resource_decode(items):
+    deserializer = TypeDeserializer()
+    return [{name: deserializer.deserialize(value) for name, value in item.items()} for item in items]
+
+
+def codec_encode(items):
+    return [encode_item(item) for item in items]
+
+
+def codec_decode(items):
+    return [decode_item(item) for item in items]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    
+    items = make_items(args.items)
+    wire = resource_encode(items)
+    
+    # The codec must produce exactly what the resource layer sends and reads
+    assert codec_encode(items) == wire, "encoded items differ from TypeSerializer"
+    assert codec_decode(wire) == resource_decode(wire), "decoded items differ from TypeDeserializer"
+    
+    for name, run, source in [
+        ('resource encode', resource_encode, items),
+        ('codec encode', codec_encode, items),
+        ('resource decode', resource_decode, wire),
+        ('codec decode', codec_decode, wire),
+    ]:
+        best = min(_timed(run, source) for _ in range(args.repeat))
+        print(f"{name:16s} {args.items / best:12,.0f} items/s")
+
+
+def _timed(run, items):
+    start = time.perf_counter()
+    run(items)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Benchmark decoding history query items into UserHistory models vs slotted HistoryItems.
+
+Usage:
+    python benchmarks/history_decode.py --items 100000
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from backend.models import UserHistory, HistoryItem
+
+# Attributes kept by backend.db.HISTORY_PROJECTION
+PROJECTED_ATTRIBUTES = (
+    'image_id', 'user_id', 'concise_caption', 'creative_caption', 'thumbnail_url', 'labels', 'timestamp'
+)
+
+
+def make_items(count):
+    """Full items as returned by a query without a projection."""
+    start = datetime(2024, 1, 1)
+    items = []
+    for i in range(count):
+        timestamp = (start + timedelta(seconds=i)).isoformat()
+        items.append({
+            'PK': 'USER#bench', 'SK': f"IMAGE#{i:026d}", 'image_id': f"{i:026d}", 'user_id': 'bench',
+            'concise_caption': 'A dog running on a beach',
+            'creative_caption': 'A joyful dog races along the shoreline as waves roll in at sunset',
+            'labels': ['dog', 'beach', 'sea', 'animal'], 'model': 'anthropic.claude-3-sonnet',
+            'provider': 'bedrock', 'confidence': Decimal('0.93'), 'timestamp': timestamp,
+            's3_url': f"s3://bucket/images/bench/{i}/original.jpg",
+            'thumbnail_url': f"s3://bucket/images/bench/{i}/thumbnail.jpg",
+            'GSI1PK': f"IMAGE#{i:026d}", 'GSI1SK': timestamp
+        })
+    return items
+
+
+def decode_models(items):
+    return [UserHistory(
+        image_id=item['image_id'],
+        user_id=item['user_id'],
+        concise_caption=item['concise_caption'],
+        creative_caption=item['creative_caption'],
+        thumbnail_url=item['thumbnail_url'],
+        timestamp=datetime.fromisoformat(item['timestamp']),
+        labels=item.get('labels')
+    ) for item in items]
+
+
+def decode_compact(items):
+    return [HistoryItem.from_item(item) for item in items]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    
+    items = make_items(args.items)
+    projected = [{key: item[key] for key in PROJECTED_ATTRIBUTES} for item in items]
+    
+    for name, decode, source in [('UserHistory', decode_models, items), ('HistoryItem', decode_compact, projected)]:
+        best = min(_timed(decode, source) for _ in range(args.repeat))
+        print(f"{name:12s} {args.items / best:12,.0f} items/s")
+
+
+def _timed(decode, items):
+    start = time.perf_counter()
+    decode(items)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    main()
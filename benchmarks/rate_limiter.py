@@ -0,0 +1,109 @@
+"""Benchmark rate limit checks from many threads, single-lock dict buckets vs the striped store.
+
+Usage:
+    python benchmarks/rate_limiter.py --threads 8 --users 100000 --repeat 5
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from backend.rate_limiter import BucketStore, MemoryBucketStore, RateLimiter
+from backend.models import RateLimitConfig
+
+
+class DictBucketStore(BucketStore):
+    """The previous in-process store: a dict of dicts behind one lock, never evicted."""
+    
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+    
+    def take(self, key, count, capacity, refill_rate):
+        with self.lock:
+            now = time.time()
+            if key not in self.buckets:
+                self.buckets[key] = {'tokens': capacity, 'last_update': now}
+            bucket = self.buckets[key]
+            bucket['tokens'] = min(capacity, bucket['tokens'] + (now - bucket['last_update']) * refill_rate)
+            bucket['last_update'] = now
+            taken = min(count, int(bucket['tokens']))
+            bucket['tokens'] -= taken
+            return taken
+    
+    def peek(self, key, capacity, refill_rate):
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if not bucket:
+                return float(capacity)
+            return min(capacity, bucket['tokens'] + (time.time() - bucket['last_update']) * refill_rate)
+    
+    def reset(self, key):
+        with self.lock:
+            self.buckets.pop(key, None)
+    
+    def __len__(self):
+        return len(self.buckets)
+
+
+def bytes_per_user(make_store, users):
+    """Memory allocated per tracked user after one check each."""
+    limiter = RateLimiter(RateLimitConfig(), make_store())
+    keys = [f"user-{i}" for i in range(users)]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for key in keys:
+        limiter.is_allowed(key)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return allocated / len(limiter.store)
+
+
+def checks_per_second(make_store, threads, users, checks):
+    """Checks per second with each thread checking random users."""
+    limiter = RateLimiter(RateLimitConfig(bucket_size=60, refill_rate=1000.0), make_store())
+    keys = [f"user-{i}" for i in range(users)]
+    barrier = threading.Barrier(threads + 1)
+    
+    def worker(seed):
+        sample = random.Random(seed).choices(keys, k=checks)
+        barrier.wait()
+        for key in sample:
+            limiter.is_allowed(key)
+            
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    return threads * checks / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--checks', type=int, default=100000, help='checks per thread')
+    parser.add_argument('--repeat', type=int, default=5, help='interleaved runs per store, the best is reported')
+    args = parser.parse_args()
+    
+    stores = [('dict + lock', DictBucketStore), ('striped', MemoryBucketStore)]
+    rates = {name: 0.0 for name, _ in stores}
+    for _ in range(args.repeat):
+        for name, make_store in stores:
+            rates[name] = max(rates[name], checks_per_second(make_store, args.threads, args.users, args.checks))
+    for name, make_store in stores:
+        size = bytes_per_user(make_store, args.users)
+        print(f"{name:12s} {rates[name]:12,.0f} checks/s {size:8.0f} bytes/user")
+
+
+if __name__ == '__main__':
+    main()
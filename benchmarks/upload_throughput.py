@@ -0,0 +1,48 @@
+"""Benchmark S3Manager.upload_image CPU cost against an in-memory or local storage backend.
+
+Usage:
+    python benchmarks/upload_throughput.py --backend memory --uploads 200 --size 1600
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from PIL import Image
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=['memory', 'local'], default='memory')
+    parser.add_argument('--uploads', type=int, default=100)
+    parser.add_argument('--size', type=int, default=1600, help='Image edge length in pixels')
+    args = parser.parse_args()
+
+    # Configure before the backend modules read the environment
+    os.environ['STORAGE_BACKEND'] = args.backend
+    os.environ.setdefault('LOCAL_STORAGE_PATH', '.storage-bench')
+    from backend.s3_manager import S3Manager
+
+    image = Image.effect_noise((args.size, args.size), 64).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    data = buffer.getvalue()
+
+    manager = S3Manager()
+    start = time.perf_counter()
+    for i in range(args.uploads):
+        manager.upload_image(f"bench-user-{i % 10}", data, 'bench.jpg', 'image/jpeg')
+    elapsed = time.perf_counter() - start
+
+    for i in range(10):
+        manager.delete_user_images(f"bench-user-{i}")
+
+    print(f"backend={args.backend} uploads={args.uploads} image={args.size}px ({len(data) / 1024:.0f} KB)")
+    print(f"{args.uploads / elapsed:.1f} uploads/s, {elapsed / args.uploads * 1000:.2f} ms/upload")
+
+
+if __name__ == '__main__':
+    main()
@@ -46,6 +46,9 @@ resource "aws_s3_bucket_server_side_encryption_configuration" "images" {
 resource "aws_s3_bucket_lifecycle_configuration" "images" {
   bucket = aws_s3_bucket.images.id
 
+  # Content-addressed images (images/<user>/sha256/...) are copied in place
+  # when a duplicate upload reuses them, at most once a day, which restarts
+  # their age (see S3Manager._reuse_stored)
   rule {
     id     = "delete-old-images"
     status = "Enabled"
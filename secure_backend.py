@@ -22,7 +22,9 @@ import io
 from dotenv import load_dotenv
 
 # Import our custom modules
-from auth_security import AuthMiddleware, SecurityConfig, StorageSecurityUtils, ERROR_RESPONSES
+from auth_security import (
+    AuthMiddleware, SecurityConfig, StorageSecurityUtils, RateLimitConfig, RateLimitMiddleware, ERROR_RESPONSES
+)
 from storage_manager import CloudStorageManager, StorageQuotaManager
 
 # Load environment variables
@@ -44,11 +46,15 @@ app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=1)
 CORS(app, 
      origins=SecurityConfig.get_cors_origins(),
      methods=['GET', 'POST', 'PUT', 'DELETE'],
-     allow_headers=['Content-Type', 'Authorization'])
+     allow_headers=['Content-Type', 'Authorization'],
+     expose_headers=['RateLimit-Limit', 'RateLimit-Remaining', 'RateLimit-Reset', 'Retry-After'])
 
 # Initialize JWT
 jwt = JWTManager(app)
 
+# Per-endpoint rate limits (auth_security.RateLimitConfig)
+rate_limits = RateLimitMiddleware(app)
+
 # Global variables
 storage_manager = None
 quota_manager = None
@@ -86,6 +92,15 @@ def initialize_storage():
         
         storage_manager = CloudStorageManager(service_account_path, bucket_name)
         quota_manager = StorageQuotaManager(storage_manager)
+        
+        # Uploads expire through a bucket lifecycle rule, only when retention is configured explicitly
+        retention_days = int(os.getenv('RETENTION_DAYS', '0'))
+        if retention_days > 0:
+            try:
+                storage_manager.ensure_retention_policy(retention_days)
+            except Exception as e:
+                logger.warning(f"Could not apply storage retention policy: {e}")
+                
         logger.info("Storage manager initialized successfully")
         return True
     except Exception as e:
@@ -125,6 +140,7 @@ def health_check():
     })
 
 @app.route('/auth/login', methods=['POST'])
+@rate_limits.limit('auth_login')
 def login():
     """Authenticate user with Firebase ID token"""
     if not firebase_initialized:
@@ -180,6 +196,7 @@ def login():
 
 @app.route('/storage/upload-url', methods=['POST'])
 @AuthMiddleware.verify_firebase_token()
+@rate_limits.limit('upload_url')
 def get_upload_url():
     """Generate signed URL for file upload"""
     if not storage_initialized:
@@ -232,6 +249,7 @@ def get_upload_url():
 
 @app.route('/storage/download-url', methods=['POST'])
 @AuthMiddleware.verify_firebase_token()
+@rate_limits.limit('download_url')
 def get_download_url():
     """Generate signed URL for file download"""
     if not storage_initialized:
@@ -266,6 +284,7 @@ def get_download_url():
 
 @app.route('/ai/generate-caption', methods=['POST'])
 @AuthMiddleware.verify_firebase_token()
+@rate_limits.limit('generate_caption')
 def generate_caption():
     """Generate AI caption for uploaded image"""
     if not model_initialized:
@@ -286,6 +305,11 @@ def generate_caption():
         # Download and process image
         image = storage_manager.download_file_as_image(blob_name, user_id)
         
+        # Large images cost more than the unit admitted; refuse them before running the model
+        rejected = rate_limits.charge(RateLimitConfig.image_cost(image.width, image.height) - 1)
+        if rejected:
+            return rejected
+            
         # Generate caption using BLIP
         inputs = processor(image, return_tensors="pt")
         with torch.no_grad():
@@ -1,12 +1,15 @@
 import os
 import io
 import logging
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, timezone
 from google.cloud import storage
 from google.oauth2 import service_account
 from PIL import Image
 import uuid
 
+# Prefix of user uploads, the objects retention applies to
+UPLOADS_PREFIX = "uploads/"
+
 class CloudStorageManager:
     """Secure Cloud Storage operations manager"""
     
@@ -240,21 +243,57 @@ class CloudStorageManager:
         
         return filename
     
+    def ensure_retention_policy(self, days_old=90):
+        """Make the bucket delete uploads older than specified days by itself (admin function)
+        
+        Cloud Storage applies lifecycle rules in the background, so expired
+        uploads no longer need cleanup_expired_files. An uploads rule with a
+        different age is replaced, since the shortest of several would win.
+        Returns True if the rules had to be changed.
+        """
+        try:
+            bucket = self.client.get_bucket(self.bucket_name)
+            rules = list(bucket.lifecycle_rules)
+            uploads_rules = [
+                rule for rule in rules
+                if rule.get('action', {}).get('type') == 'Delete'
+                and rule.get('condition', {}).get('matchesPrefix') == [UPLOADS_PREFIX]
+            ]
+            if [rule['condition'].get('age') for rule in uploads_rules] == [days_old]:
+                return False
+                
+            bucket.lifecycle_rules = [rule for rule in rules if rule not in uploads_rules]
+            bucket.add_lifecycle_delete_rule(age=days_old, matches_prefix=[UPLOADS_PREFIX])
+            bucket.patch()
+            logging.info(f"Uploads in {self.bucket_name} now expire after {days_old} days")
+            return True
+            
+        except Exception as e:
+            logging.error(f"Error setting retention policy: {e}")
+            raise
+    
     def cleanup_expired_files(self, days_old=30):
-        """Clean up files older than specified days (admin function)"""
+        """Clean up files older than specified days (admin function)
+        
+        Objects already deleted by another cleanup or the lifecycle rule are
+        skipped and not counted; any other error stops the cleanup. Prefer
+        ensure_retention_policy, which needs no listing at all.
+        """
         try:
             bucket = self.client.bucket(self.bucket_name)
-            cutoff_date = datetime.utcnow() - timedelta(days=days_old)
+            cutoff_date = datetime.now(timezone.utc) - timedelta(days=days_old)
             
-            blobs = bucket.list_blobs(prefix="uploads/")
-            deleted_count = 0
+            expired = [
+                blob for blob in bucket.list_blobs(prefix=UPLOADS_PREFIX)
+                if blob.time_created and blob.time_created < cutoff_date
+            ]
             
-            for blob in blobs:
-                if blob.time_created and blob.time_created < cutoff_date:
-                    blob.delete()
-                    deleted_count += 1
-                    logging.info(f"Deleted expired file: {blob.name}")
+            # Batch requests only raise their last error, so missing objects could not be told from
+            # real failures; delete_blobs hands each NotFound to on_error and raises anything else
+            missing = []
+            bucket.delete_blobs(expired, on_error=missing.append)
             
+            deleted_count = len(expired) - len(missing)
             logging.info(f"Cleanup completed. Deleted {deleted_count} expired files.")
             return deleted_count
         
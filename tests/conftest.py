@@ -0,0 +1,12 @@
+"""Shared test fixtures."""
+import pytest
+
+from backend.aws_clients import clear_clients
+
+
+@pytest.fixture(autouse=True)
+def fresh_aws_clients():
+    """Keep cached AWS clients from leaking mocks between tests."""
+    clear_clients()
+    yield
+    clear_clients()
@@ -5,10 +5,25 @@ from moto import mock_s3, mock_dynamodb, mock_cognitoidp
 from PIL import Image
 import io
 import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from boto3.dynamodb.conditions import Key
 
 from backend.s3_manager import S3Manager
-from backend.db import DynamoDBManager
-from backend.models import CaptionResult, CaptionProvider
+from backend.storage import MemoryStorage
+from backend.erasure import erase_user_data
+from backend.db import DynamoDBManager, expiry_time, image_sort_key
+from backend.dynamo_codec import LowLevelTable
+from backend.models import CaptionResult, CaptionProvider, RateLimitConfig
+from backend.write_behind import CaptionWriteBuffer
+from backend.ids import new_ulid
+from backend.migrations import (
+    migrate_sort_keys, rebuild_usage_counters, rebuild_search_index, migrate_legacy_table, backfill_ttl
+)
+from backend.export import export_captions
+from backend.idempotency import IdempotencyStore, RequestInProgressError, request_key
+from backend.rate_limiter import DynamoDBBucketStore, RateLimiter
 
 
 @pytest.fixture
@@ -21,6 +36,36 @@ def aws_credentials():
     os.environ['AWS_REGION'] = 'us-east-1'
 
 
+@pytest.fixture
+def captions_table():
+    """Factory creating the single-table PK/SK captions table inside a test's moto mock."""
+    def create(table_name='test-captions', gsi=False):
+        definition = {
+            'TableName': table_name,
+            'KeySchema': [{'AttributeName': 'PK', 'KeyType': 'HASH'}, {'AttributeName': 'SK', 'KeyType': 'RANGE'}],
+            'AttributeDefinitions': [
+                {'AttributeName': 'PK', 'AttributeType': 'S'},
+                {'AttributeName': 'SK', 'AttributeType': 'S'}
+            ],
+            'BillingMode': 'PAY_PER_REQUEST'
+        }
+        if gsi:
+            definition['AttributeDefinitions'] += [
+                {'AttributeName': 'GSI1PK', 'AttributeType': 'S'},
+                {'AttributeName': 'GSI1SK', 'AttributeType': 'S'}
+            ]
+            definition['GlobalSecondaryIndexes'] = [{
+                'IndexName': 'GSI1',
+                'KeySchema': [
+                    {'AttributeName': 'GSI1PK', 'KeyType': 'HASH'},
+                    {'AttributeName': 'GSI1SK', 'KeyType': 'RANGE'}
+                ],
+                'Projection': {'ProjectionType': 'ALL'}
+            }]
+        return boto3.resource('dynamodb', region_name='us-east-1').create_table(**definition)
+    return create
+
+
 @mock_s3
 class TestS3Integration:
     """Integration tests for S3 operations."""
@@ -174,3 +219,802 @@ class TestDynamoDBIntegration:
         # Verify deletion
         history, _ = db.get_user_history('user456')
         assert len(history) == 0
+    
+    def test_shared_image_released_with_last_caption(self, aws_credentials, captions_table):
+        """Test a deduplicated image survives until the last caption using it is deleted."""
+        table = captions_table(gsi=True)
+        db = DynamoDBManager()
+        db.table = table
+        s3 = S3Manager()
+        s3.config = s3.config.model_copy(update={'content_addressed_storage': True})
+        s3.storage = MemoryStorage()
+        s3.refs_table = table
+        
+        buf = io.BytesIO()
+        Image.new('RGB', (100, 100), color='red').save(buf, format='JPEG')
+        captions = []
+        for filename in ('a.jpg', 'b.jpg'):
+            metadata = s3.upload_image('blob_user', buf.getvalue(), filename, 'image/jpeg')
+            caption = CaptionResult(
+                image_id=metadata.image_id,
+                user_id='blob_user',
+                concise_caption='A red square',
+                creative_caption='A picture',
+                model='test-model',
+                provider=CaptionProvider.BEDROCK,
+                s3_url=metadata.s3_url,
+                thumbnail_url=metadata.thumbnail_url,
+                content_hash=metadata.content_hash
+            )
+            db.save_caption(caption, sync=True)
+            captions.append(caption)
+            
+        original_key = s3.storage.parse_url(captions[0].s3_url)[1]
+        assert captions[0].s3_url == captions[1].s3_url
+        assert db.get_caption_by_image_id(captions[0].image_id).content_hash == captions[0].content_hash
+        
+        assert db.delete_caption('blob_user', captions[0].image_id, s3_manager=s3)
+        assert s3.storage.exists(original_key)
+        
+        assert db.delete_caption('blob_user', captions[1].image_id, s3_manager=s3)
+        assert not s3.storage.exists(original_key)
+        assert s3.storage.list_prefix('images/blob_user/') == []
+        
+        # A release racing a duplicate upload leaves the objects the upload referenced
+        first = s3.upload_image('blob_user', buf.getvalue(), 'c.jpg', 'image/jpeg')
+        exists = s3.storage.exists
+        racing = [first.content_hash]
+        
+        def release_during_check(key):
+            if racing:
+                assert not s3.release_image('blob_user', racing.pop())
+            return exists(key)
+            
+        s3.storage.exists = release_during_check
+        s3.upload_image('blob_user', buf.getvalue(), 'd.jpg', 'image/jpeg')
+        s3.storage.exists = exists
+        assert racing == []
+        assert s3.storage.exists(original_key)
+        
+        # Erasure drops the objects and their reference counters together
+        metadata = s3.upload_image('blob_user', buf.getvalue(), 'c.jpg', 'image/jpeg')
+        erase_user_data('blob_user', s3, db)
+        assert s3.storage.list_prefix('images/blob_user/') == []
+        assert 'Item' not in table.get_item(Key={'PK': 'USER#blob_user', 'SK': f"BLOB#{metadata.content_hash}"})
+    
+    def test_migrate_sort_keys(self, aws_credentials, captions_table):
+        """Test legacy UUID sort keys are re-keyed into chronological order."""
+        table = captions_table('test-migrate')
+        
+        # Legacy items keyed by random UUIDs, written out of order
+        timestamps = ['2024-01-03T00:00:00', '2024-01-01T00:00:00', '2024-01-02T00:00:00']
+        for timestamp in timestamps:
+            image_id = str(uuid.uuid4())
+            table.put_item(Item={
+                'PK': 'USER#user789',
+                'SK': f"IMAGE#{image_id}",
+                'image_id': image_id,
+                'user_id': 'user789',
+                'timestamp': timestamp
+            })
+            
+        stats = migrate_sort_keys(table=table)
+        assert stats['migrated'] == 3
+        
+        response = table.query(
+            KeyConditionExpression=Key('PK').eq('USER#user789'),
+            ScanIndexForward=False
+        )
+        assert [item['timestamp'] for item in response['Items']] == sorted(timestamps, reverse=True)
+        
+        # Re-running is a no-op
+        assert migrate_sort_keys(table=table)['skipped'] == 3
+    
+    def test_migrate_sort_keys_moves_indexes(self, aws_credentials, captions_table):
+        """Test re-keyed captions keep one set of search and facet entries."""
+        table = captions_table('test-migrate-indexes')
+        db = DynamoDBManager()
+        db.table = table
+        
+        def legacy_item(image_id, timestamp):
+            return {
+                'PK': 'USER#label_user',
+                'SK': f"IMAGE#{image_id}",
+                'image_id': image_id,
+                'user_id': 'label_user',
+                'timestamp': timestamp,
+                'concise_caption': 'A dog on the beach',
+                'creative_caption': 'Sandy paws',
+                'thumbnail_url': 's3://bucket/thumb',
+                'labels': ['Dog', 'Beach']
+            }
+            
+        moved = legacy_item(str(uuid.uuid4()), '2024-01-01T00:00:00')
+        duplicate = legacy_item(str(uuid.uuid4()), '2024-01-02T00:00:00')
+        table.put_item(Item=moved)
+        table.put_item(Item=duplicate)
+        rebuild_search_index(table)
+        
+        # An earlier run copied this caption but left the old item behind
+        duplicate_sk = image_sort_key(duplicate['image_id'], datetime.fromisoformat(duplicate['timestamp']))
+        table.put_item(Item={**duplicate, 'SK': duplicate_sk})
+        
+        stats = migrate_sort_keys(table=table)
+        assert (stats['migrated'], stats['duplicates']) == (1, 1)
+        
+        items, _ = db.get_user_history_by_label('label_user', 'Dog')
+        assert [item.image_id for item in items] == [duplicate['image_id'], moved['image_id']]
+        assert [item.image_id for item in db.search_history('label_user', 'dog')] == [item.image_id for item in items]
+        
+        response = table.query(KeyConditionExpression=Key('PK').eq('USER#label_user'))
+        sort_keys = [item['SK'] for item in response['Items']]
+        assert f"IMAGE#{moved['image_id']}" not in sort_keys
+        assert f"IMAGE#{duplicate['image_id']}" not in sort_keys
+        assert not any(sk.endswith(moved['image_id']) or sk.endswith(duplicate['image_id']) for sk in sort_keys)
+    
+    def test_usage_counters(self, aws_credentials, captions_table):
+        """Test usage metrics come from counters kept up to date by saves and deletes."""
+        table = captions_table('test-usage')
+        
+        db = DynamoDBManager()
+        db.table = table
+        
+        for user_id, image_id, provider in [('u1', 'a', CaptionProvider.BEDROCK), ('u1', 'b', CaptionProvider.HUGGINGFACE), ('u2', 'c', CaptionProvider.BEDROCK)]:
+            caption = CaptionResult(
+                image_id=image_id,
+                user_id=user_id,
+                concise_caption='A cat',
+                creative_caption='A sleepy cat',
+                model='test-model',
+                provider=provider,
+                s3_url='s3://bucket/image',
+                thumbnail_url='s3://bucket/thumb'
+            )
+            db.save_caption(caption, file_size=1000, processing_time=2.0)
+            
+        # Re-saving the same caption does not count twice
+        db.save_caption(caption, file_size=1000, processing_time=2.0)
+        
+        metrics = db.get_usage_metrics()
+        assert metrics.captions_generated == 3
+        assert metrics.total_users == 2
+        assert metrics.captions_by_provider == {'bedrock': 2, 'hf': 1}
+        assert metrics.avg_processing_time == 2.0
+        assert metrics.storage_used_gb == 3000 / 1024 ** 3
+        
+        db.delete_user_data('u1')
+        metrics = db.get_usage_metrics()
+        assert metrics.captions_generated == 1
+        assert metrics.total_users == 1
+        assert metrics.captions_by_provider == {'bedrock': 1, 'hf': 0}
+        
+        # Rebuilding from the caption items gives the same totals
+        totals = rebuild_usage_counters(table=table)
+        assert totals['captions'] == 1
+        assert db.get_usage_metrics().total_users == 1
+        
+        # TTL deletes bypass the counters; the rebuild drops captions past their TTL
+        caption_item = table.query(KeyConditionExpression=Key('PK').eq('USER#u2') & Key('SK').begins_with('IMAGE#'))['Items'][0]
+        table.update_item(Key={'PK': 'USER#u2', 'SK': caption_item['SK']}, UpdateExpression='SET #ttl = :past',
+                          ExpressionAttributeNames={'#ttl': 'ttl'}, ExpressionAttributeValues={':past': 1})
+        totals = rebuild_usage_counters(table=table)
+        assert (totals['captions'], totals['users']) == (0, 0)
+        assert table.get_item(Key={'PK': 'USER#u2', 'SK': 'STATS'})['Item']['captions'] == 0
+    
+    def test_erase_after_deleting_every_caption(self, aws_credentials, captions_table):
+        """Test erasing a user with no captions left does not uncount them twice."""
+        table = captions_table('test-usage-erase', gsi=True)
+        
+        db = DynamoDBManager()
+        db.table = table
+        
+        for user_id, image_id in [('u1', 'a'), ('u2', 'b')]:
+            db.save_caption(CaptionResult(
+                image_id=image_id,
+                user_id=user_id,
+                concise_caption='A cat',
+                creative_caption='A sleepy cat',
+                model='test-model',
+                provider=CaptionProvider.BEDROCK,
+                s3_url='s3://bucket/image',
+                thumbnail_url='s3://bucket/thumb'
+            ), file_size=1000)
+            
+        assert db.delete_caption('u1', 'a')
+        assert db.get_usage_metrics().total_users == 1
+        
+        # Only the STATS item is left, with captions=0
+        assert db.delete_user_data('u1') == 1
+        metrics = db.get_usage_metrics()
+        assert metrics.total_users == 1
+        assert metrics.captions_generated == 1
+    
+    def test_fast_codec_matches_resource_layer(self, aws_credentials, captions_table):
+        """Test the low-level codec path writes and reads the same items as the resource layer."""
+        table = captions_table('test-codec')
+        
+        db = DynamoDBManager()
+        db.table = table
+        db.history_cache = None
+        db.fast_table = LowLevelTable(boto3.client('dynamodb', region_name='us-east-1'), table.name)
+        
+        for i in range(5):
+            assert db.save_caption(CaptionResult(
+                image_id=new_ulid(),
+                user_id='codec_user',
+                concise_caption=f"Caption {i}",
+                creative_caption='A picture',
+                labels=['cat', 'sofa'] if i % 2 else None,
+                model='test-model',
+                provider=CaptionProvider.BEDROCK,
+                confidence=0.87 if i % 2 else None,
+                s3_url='s3://bucket/image',
+                thumbnail_url='s3://bucket/thumb'
+            ), file_size=1000 + i, sync=True)
+            
+        fast_items, fast_key = db.get_history_items('codec_user', limit=3)
+        fast_raw = db.fast_table.query(
+            KeyConditionExpression='PK = :pk',
+            ExpressionAttributeValues={':pk': 'USER#codec_user'}
+        )['Items']
+        
+        db.fast_table = None
+        items, key = db.get_history_items('codec_user', limit=3)
+        raw = table.query(KeyConditionExpression=Key('PK').eq('USER#codec_user'))['Items']
+        
+        assert [item.to_item() for item in fast_items] == [item.to_item() for item in items]
+        assert fast_key == key
+        assert fast_raw == raw
+        assert db.get_usage_metrics().captions_generated == 5
+    
+    def test_search_history(self, aws_credentials, captions_table):
+        """Test token index search with AND and prefix terms, updates and deletes."""
+        table = captions_table('test-search')
+        
+        db = DynamoDBManager()
+        db.table = table
+        
+        def caption(image_id, concise, labels=None, user_id='search_user'):
+            return CaptionResult(
+                image_id=image_id,
+                user_id=user_id,
+                concise_caption=concise,
+                creative_caption='A moment captured',
+                labels=labels,
+                model='test-model',
+                provider=CaptionProvider.BEDROCK,
+                s3_url='s3://bucket/image',
+                thumbnail_url='s3://bucket/thumb'
+            )
+            
+        ids = [new_ulid() for _ in range(4)]
+        db.save_caption(caption(ids[0], 'A dog on the beach', ['Dog', 'Sand']))
+        db.save_caption(caption(ids[1], 'Dogs playing in a park', ['Dog', 'Grass']))
+        db.save_caption(caption(ids[2], 'A cat on a sofa', ['Cat']))
+        db.save_caption(caption(ids[3], 'A dog on the beach', ['Dog'], user_id='other_user'))
+        
+        assert [item.image_id for item in db.search_history('search_user', 'dog')] == [ids[1], ids[0]]
+        assert [item.image_id for item in db.search_history('search_user', 'beach DOG')] == [ids[0]]
+        assert [item.image_id for item in db.search_history('search_user', 'dog*')] == [ids[1], ids[0]]
+        assert [item.image_id for item in db.search_history('search_user', 'pa*')] == [ids[1]]
+        assert db.search_history('search_user', 'dog cat') == []
+        assert db.search_history('search_user', 'the') == []
+        
+        # Editing a caption moves it between results; deleting removes its entries
+        db.save_caption(caption(ids[0], 'A horse in a field', ['Horse']))
+        assert [item.image_id for item in db.search_history('search_user', 'beach')] == []
+        assert [item.image_id for item in db.search_history('search_user', 'horse')] == [ids[0]]
+        
+        assert db.delete_caption('search_user', ids[2])
+        assert db.search_history('search_user', 'cat') == []
+        remaining = table.query(KeyConditionExpression=Key('PK').eq('USER#search_user') & Key('SK').begins_with('TOKEN#'))
+        assert all(not item['SK'].endswith(ids[2]) for item in remaining['Items'])
+        assert db._get_user_stats('search_user')['captions'] == 2
+        
+        # Captions saved before the index existed are picked up by the rebuild job
+        table.delete_item(Key={'PK': 'USER#search_user', 'SK': f"TOKEN#horse#{ids[0]}"})
+        assert db.search_history('search_user', 'horse') == []
+        assert rebuild_search_index(table)['captions'] == 3
+        assert [item.image_id for item in db.search_history('search_user', 'horse')] == [ids[0]]
+    
+    def test_failed_index_updates_are_retried_and_counted(self, aws_credentials, captions_table, monkeypatch):
+        """Test index writes are retried, and updates still failing are counted until a rebuild."""
+        from botocore.exceptions import EndpointConnectionError
+        import backend.db
+        
+        table = captions_table('test-index-failures')
+        monkeypatch.setattr(backend.db, 'INDEX_RETRY_DELAY', 0)
+        
+        db = DynamoDBManager()
+        db.table = table
+        batch_write = db._batch_write
+        outages = []
+        
+        def flaky_batch_write(client, requests):
+            if outages:
+                outages.pop()
+                raise EndpointConnectionError(endpoint_url='https://dynamodb.us-east-1.amazonaws.com')
+            return batch_write(client, requests)
+            
+        monkeypatch.setattr(db, '_batch_write', flaky_batch_write)
+        
+        def caption(image_id, concise):
+            return CaptionResult(
+                image_id=image_id,
+                user_id='index_user',
+                concise_caption=concise,
+                creative_caption='A moment captured',
+                model='test-model',
+                provider=CaptionProvider.BEDROCK,
+                s3_url='s3://bucket/image',
+                thumbnail_url='s3://bucket/thumb'
+            )
+            
+        # A transient error is retried
+        ids = [new_ulid() for _ in range(2)]
+        outages.extend([True] * 2)
+        db.save_caption(caption(ids[0], 'A dog on the beach'))
+        db._wait_for_index()
+        assert [item.image_id for item in db.search_history('index_user', 'dog')] == [ids[0]]
+        assert db.index_failures == 0
+        
+        # One that outlasts the retries is counted for the rebuild job
+        outages.extend([True] * 3)
+        db.save_caption(caption(ids[1], 'A cat on a sofa'))
+        db._wait_for_index()
+        assert db.search_history('index_user', 'cat') == []
+        assert db.index_failures == 1
+        assert db.get_usage_metrics().index_failures == 1
+        
+        rebuild_search_index(table)
+        assert [item.image_id for item in db.search_history('index_user', 'cat')] == [ids[1]]
+        assert db.get_usage_metrics().index_failures == 0
+    
+    def test_label_facets(self, aws_credentials, captions_table):
+        """Test label facet pages and counts follow saves, edits and deletes."""
+        table = captions_table('test-facets')
+        
+        db = DynamoDBManager()
+        db.table = table
+        
+        def caption(image_id, labels):
+            return CaptionResult(
+                image_id=image_id,
+                user_id='facet_user',
+                concise_caption=f"Caption {image_id}",
+                creative_caption='A picture',
+                labels=labels,
+                model='test-model',
+                provider=CaptionProvider.BEDROCK,
+                s3_url='s3://bucket/image',
+                thumbnail_url='s3://bucket/thumb'
+            )
+            
+        ids = [new_ulid() for _ in range(5)]
+        for image_id, labels in zip(ids, [['Dog'], ['Dog', 'Beach'], ['Cat'], ['Dog', 'Dog House'], ['Beach']]):
+            db.save_caption(caption(image_id, labels))
+            
+        assert db.get_label_counts('facet_user') == {'Dog': 3, 'Beach': 2, 'Cat': 1, 'Dog House': 1}
+        
+        items, next_key = db.get_user_history_by_label('facet_user', 'Dog')
+        assert [item.image_id for item in items] == [ids[3], ids[1], ids[0]]
+        assert items[2].concise_caption == f"Caption {ids[0]}"
+        assert next_key is None
+        
+        # Relabelling moves the caption between facets; deleting removes it
+        db.save_caption(caption(ids[0], ['Cat']))
+        db.delete_caption('facet_user', ids[4])
+        assert db.get_label_counts('facet_user') == {'Cat': 2, 'Dog': 2, 'Beach': 1, 'Dog House': 1}
+        assert [item.image_id for item in db.get_user_history_by_label('facet_user', 'Cat')[0]] == [ids[2], ids[0]]
+        assert [item.image_id for item in db.get_user_history_by_label('facet_user', 'Beach')[0]] == [ids[1]]
+    
+    def test_write_behind_batches_captions(self, aws_credentials, captions_table):
+        """Test buffered captions are written in batches and counted once."""
+        table = captions_table('test-write-behind')
+        
+        db = DynamoDBManager()
+        db.table = table
+        db.write_buffer = CaptionWriteBuffer(db, flush_interval=60)
+        
+        for i in range(30):
+            db.save_caption(CaptionResult(
+                image_id=f"img{i}",
+                user_id='bulk_user',
+                concise_caption='A cat',
+                creative_caption='A sleepy cat',
+                model='test-model',
+                provider=CaptionProvider.BEDROCK,
+                s3_url='s3://bucket/image',
+                thumbnail_url='s3://bucket/thumb'
+            ), file_size=100)
+            
+        # Reading the user's history writes their buffered captions first
+        history, _ = db.get_user_history('bulk_user', limit=50)
+        assert len(history) == 30
+        assert db.get_usage_metrics().captions_generated == 30
+        assert db.get_usage_metrics().total_users == 1
+        
+        # Synchronous mode bypasses the buffer
+        db.save_caption(CaptionResult(
+            image_id='img_sync',
+            user_id='bulk_user',
+            concise_caption='A dog',
+            creative_caption='A happy dog',
+            model='test-model',
+            provider=CaptionProvider.BEDROCK,
+            s3_url='s3://bucket/image',
+            thumbnail_url='s3://bucket/thumb'
+        ), sync=True)
+        assert not db.write_buffer.has_pending('bulk_user')
+        assert db.get_usage_metrics().captions_generated == 31
+        
+        db.write_buffer.stop()
+        # Index writes queued by the flushes must finish while the table is mocked
+        db._wait_for_index()
+    
+    def test_write_behind_keeps_captions_on_connection_error(self, aws_credentials, captions_table, monkeypatch):
+        """Test a transport error requeues the batch and leaves the flusher running."""
+        from botocore.exceptions import EndpointConnectionError
+        table = captions_table('test-write-behind-retry')
+        
+        db = DynamoDBManager()
+        db.table = table
+        db.write_buffer = CaptionWriteBuffer(db, flush_interval=0.05)
+        
+        def unreachable(**kwargs):
+            raise EndpointConnectionError(endpoint_url='https://dynamodb.us-east-1.amazonaws.com')
+        monkeypatch.setattr(table, 'batch_writer', unreachable)
+        
+        db.save_caption(CaptionResult(
+            image_id='img_retry',
+            user_id='retry_user',
+            concise_caption='A cat',
+            creative_caption='A sleepy cat',
+            model='test-model',
+            provider=CaptionProvider.BEDROCK,
+            s3_url='s3://bucket/image',
+            thumbnail_url='s3://bucket/thumb'
+        ), file_size=100)
+        
+        assert db.write_buffer.flush() == 0
+        assert db.write_buffer.has_pending('retry_user')
+        time.sleep(0.2)
+        assert db.write_buffer._thread.is_alive()
+        assert db.write_buffer.has_pending('retry_user')
+        
+        # Once the endpoint is reachable again the buffered caption is written
+        monkeypatch.undo()
+        assert db.write_buffer.flush() == 1
+        assert not db.write_buffer.has_pending('retry_user')
+        history, _ = db.get_user_history('retry_user')
+        assert [item.image_id for item in history] == ['img_retry']
+        
+        db.write_buffer.stop()
+        db._wait_for_index()
+    
+    def test_get_captions_by_image_ids(self, aws_credentials, captions_table):
+        """Test batch caption lookup by primary key and by GSI, in input order."""
+        table = captions_table('test-batch-get', gsi=True)
+        
+        db = DynamoDBManager()
+        db.table = table
+        
+        # 120 new ULID images plus one legacy UUID image
+        image_ids = [new_ulid() for _ in range(120)] + [str(uuid.uuid4())]
+        for image_id in image_ids:
+            db.save_caption(CaptionResult(
+                image_id=image_id,
+                user_id='gallery_user',
+                concise_caption=f"Caption {image_id}",
+                creative_caption='A picture',
+                model='test-model',
+                provider=CaptionProvider.BEDROCK,
+                s3_url='s3://bucket/image',
+                thumbnail_url='s3://bucket/thumb'
+            ), sync=True)
+            
+        requested = list(reversed(image_ids)) + ['missing']
+        captions = db.get_captions_by_image_ids(requested, user_id='gallery_user')
+        assert [c.image_id if c else None for c in captions] == list(reversed(image_ids)) + [None]
+        
+        # Without the user, every ID goes through the index
+        captions = db.get_captions_by_image_ids(image_ids[:3])
+        assert [c.concise_caption for c in captions] == [f"Caption {i}" for i in image_ids[:3]]
+        
+        # Images of other users are not returned for a given user
+        assert db.get_captions_by_image_ids(image_ids[:2], user_id='someone_else') == [None, None]
+        
+        # Captions past their TTL but not yet deleted are hidden on both paths
+        for image_id in (image_ids[0], image_ids[-1]):
+            sort_key = image_sort_key(image_id, db.get_caption_by_image_id(image_id).timestamp)
+            table.update_item(Key={'PK': 'USER#gallery_user', 'SK': sort_key}, UpdateExpression='SET #ttl = :past',
+                              ExpressionAttributeNames={'#ttl': 'ttl'}, ExpressionAttributeValues={':past': 1})
+        requested = [image_ids[0], image_ids[1], image_ids[-1]]
+        captions = db.get_captions_by_image_ids(requested, user_id='gallery_user')
+        assert [c.image_id if c else None for c in captions] == [None, image_ids[1], None]
+        assert db.get_captions_by_image_ids([image_ids[0]]) == [None]
+    
+    def test_latest_captions(self, aws_credentials, monkeypatch):
+        """Test the legacy table's recency feed across month buckets."""
+        import aws_utils
+        
+        monkeypatch.setattr(aws_utils, 'dynamodb', boto3.resource('dynamodb', region_name='eu-north-1'))
+        aws_utils.create_dynamodb_table_if_not_exists('legacy_captions')
+        table = aws_utils.dynamodb.Table('legacy_captions')
+        
+        # Two captions this month, one last month, none the month before and two before that
+        current = aws_utils.recent_bucket(datetime.utcnow().isoformat())
+        last = aws_utils._previous_month(current)
+        oldest = aws_utils._previous_month(aws_utils._previous_month(last))
+        timestamps = [f"{oldest}-02T10:00:00", f"{oldest}-03T10:00:00", f"{last}-05T10:00:00",
+                      f"{current}-01T00:00:00", f"{current}-01T00:00:01"]
+        for i, timestamp in enumerate(timestamps):
+            table.put_item(Item={'image_id': f"img-{i}", 'timestamp': timestamp, 'caption_text': f"Caption {i}"})
+        # The captions predate this test's table, so listing starts from a table made in their oldest month
+        assert aws_utils._first_month(table) == current
+        monkeypatch.setitem(aws_utils._first_months, 'legacy_captions', oldest)
+        
+        # Items saved before the index existed are picked up by the backfill
+        assert aws_utils.backfill_recent_index('legacy_captions') == 5
+        assert aws_utils.backfill_recent_index('legacy_captions') == 0
+        
+        items, cursor = aws_utils.get_latest_captions(3, table_name='legacy_captions')
+        assert [item['image_id'] for item in items] == ['img-4', 'img-3', 'img-2']
+        assert cursor
+        
+        items, cursor = aws_utils.get_latest_captions(3, cursor, table_name='legacy_captions')
+        assert [item['image_id'] for item in items] == ['img-1', 'img-0']
+        assert cursor is None
+        
+        with pytest.raises(ValueError, match='invalid cursor'):
+            aws_utils.get_latest_captions(3, 'not-a-cursor', table_name='legacy_captions')
+        with pytest.raises(ValueError, match='invalid cursor'):
+            aws_utils.get_latest_captions(3, 'eyJrZXkiOiBudWxsfQ==', table_name='legacy_captions')
+            
+        # New captions are stamped with their bucket when saved
+        aws_utils.save_caption_to_dynamodb('img-new', 'New caption', 'https://example.com/new.jpg', 'legacy_captions')
+        assert [item['image_id'] for item in aws_utils.get_all_captions('legacy_captions', limit=3)] == ['img-new', 'img-4', 'img-3']
+    
+    def test_export_resumes_from_checkpoint(self, aws_credentials, captions_table, tmp_path):
+        """Test that an interrupted export resumes without duplicating rows."""
+        import json
+        
+        table = captions_table()
+        
+        db = DynamoDBManager()
+        db.table = table
+        db.fast_table = LowLevelTable(boto3.client('dynamodb', region_name='us-east-1'), table.name)
+        for i in range(25):
+            db.save_caption(CaptionResult(
+                image_id=new_ulid(),
+                user_id=f"user_{i % 3}",
+                concise_caption=f"Caption {i}",
+                creative_caption='A picture',
+                labels=['dog'],
+                model='test-model',
+                provider=CaptionProvider.BEDROCK,
+                confidence=0.9,
+                s3_url='s3://bucket/image',
+                thumbnail_url='s3://bucket/thumb'
+            ), sync=True)
+            
+        # Fail the scan after two pages (moto ignores Segment, so one segment is used)
+        client = db.fast_table.client
+        real_scan = client.scan
+        calls = []
+        
+        def failing_scan(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 3:
+                raise RuntimeError("connection lost")
+            return real_scan(**kwargs)
+            
+        client.scan = failing_scan
+        with pytest.raises(RuntimeError):
+            export_captions(str(tmp_path), db, segments=1, page_size=4)
+        del client.scan
+        
+        stats = export_captions(str(tmp_path), db, segments=1, page_size=4)
+        rows = [json.loads(line) for line in open(tmp_path / 'captions-0000-of-0001.jsonl')]
+        assert stats['rows'] == len(rows)
+        assert sorted(row['concise_caption'] for row in rows) == sorted(f"Caption {i}" for i in range(25))
+        assert 'PK' not in rows[0] and rows[0]['confidence'] == 0.9
+        
+        # A finished export is not scanned again; a different layout or table is refused
+        assert export_captions(str(tmp_path), db, segments=1)['pages'] == 0
+        with pytest.raises(ValueError):
+            export_captions(str(tmp_path), db, segments=2)
+        db.table = captions_table('other-captions')
+        db.fast_table = None
+        with pytest.raises(ValueError):
+            export_captions(str(tmp_path), db, segments=1)
+    
+    def test_migrate_legacy_table(self, aws_credentials, captions_table, tmp_path):
+        """Test copying the legacy image_id table, with a dry-run diff and an incremental rerun."""
+        dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+        legacy = dynamodb.create_table(
+            TableName='legacy-captions',
+            KeySchema=[{'AttributeName': 'image_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'image_id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        table = captions_table()
+        image_ids = [str(uuid.uuid4()) for _ in range(11)]
+        start = datetime.utcnow() - timedelta(days=20)
+        for i, image_id in enumerate(image_ids):
+            legacy.put_item(Item={
+                'image_id': image_id,
+                'timestamp': (start + timedelta(days=i)).isoformat(),
+                'caption_text': f"a dog on a beach {i}",
+                'image_url': f"https://bucket.s3.amazonaws.com/uploads/{image_id}.jpg"
+            })
+        legacy.put_item(Item={'image_id': 'broken', 'image_url': 'https://example.com/broken.jpg'})
+        
+        db = DynamoDBManager()
+        db.table = table
+        db.dynamodb = dynamodb
+        
+        # moto ignores Segment, so a single segment is scanned
+        stats = migrate_legacy_table('legacy-captions', db, segments=1, dry_run=True)
+        assert (stats['scanned'], stats['new'], stats['invalid']) == (12, 11, 1)
+        assert table.scan()['Count'] == 0
+        
+        stats = migrate_legacy_table('legacy-captions', db, segments=1, checkpoint_path=str(tmp_path / 'first.json'))
+        assert (stats['new'], stats['changed'], stats['failed']) == (11, 0, 0)
+        history, _ = db.get_user_history('legacy', limit=20)
+        assert [h.image_id for h in history] == list(reversed(image_ids))
+        assert history[0].concise_caption == 'a dog on a beach 10'
+        assert len(db.search_history('legacy', 'beach')) == 11
+        
+        # An edited legacy row shows up in the diff and is the only one rewritten
+        legacy.update_item(
+            Key={'image_id': image_ids[0]},
+            UpdateExpression='SET caption_text = :caption',
+            ExpressionAttributeValues={':caption': 'a cat on a sofa'}
+        )
+        stats = migrate_legacy_table('legacy-captions', db, segments=1, dry_run=True)
+        assert stats['diffs'] == [{'image_id': image_ids[0], 'changed': ['concise_caption', 'creative_caption']}]
+        
+        stats = migrate_legacy_table('legacy-captions', db, segments=1, checkpoint_path=str(tmp_path / 'second.json'))
+        assert (stats['new'], stats['changed'], stats['unchanged']) == (0, 1, 10)
+        assert [h.image_id for h in db.search_history('legacy', 'sofa')] == [image_ids[0]]
+        
+        with pytest.raises(ValueError):
+            migrate_legacy_table('legacy-captions', db, segments=2, checkpoint_path=str(tmp_path / 'second.json'))
+    
+    def test_backfill_ttl(self, aws_credentials, captions_table):
+        """Test captions and their index entries carry a TTL, and the backfill stamps older items."""
+        dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+        table = captions_table()
+        
+        db = DynamoDBManager()
+        db.table = table
+        db.dynamodb = dynamodb
+        caption = CaptionResult(
+            image_id=new_ulid(),
+            user_id='ttl_user',
+            concise_caption='A dog on a beach',
+            creative_caption='A picture',
+            labels=['Dog'],
+            model='test-model',
+            provider=CaptionProvider.BEDROCK,
+            s3_url='s3://bucket/image',
+            thumbnail_url='s3://bucket/thumb'
+        )
+        db.save_caption(caption, sync=True)
+        db._wait_for_index()
+        
+        entries = table.query(KeyConditionExpression=Key('PK').eq('USER#ttl_user'))['Items']
+        stamped = [item for item in entries if item['SK'].split('#')[0] in ('IMAGE', 'TOKEN', 'LABEL')]
+        expected = expiry_time(caption.timestamp, db.config.retention_days)
+        assert len(stamped) == 5 and all(item['ttl'] == expected for item in stamped)
+        
+        # Items written before the TTL existed are stamped from their caption's creation time
+        for item in stamped:
+            table.update_item(Key={'PK': item['PK'], 'SK': item['SK']}, UpdateExpression='REMOVE #ttl',
+                              ExpressionAttributeNames={'#ttl': 'ttl'})
+        stats = backfill_ttl(db, retention_days=30, segments=1)
+        assert (stats['stamped'], stats['failed']) == (5, 0)
+        entries = table.query(KeyConditionExpression=Key('PK').eq('USER#ttl_user'))['Items']
+        caption_ttl = next(item['ttl'] for item in entries if item['SK'].startswith('IMAGE#'))
+        assert caption_ttl == expiry_time(caption.timestamp, 30)
+        token_ttl = next(item['ttl'] for item in entries if item['SK'].startswith('TOKEN#'))
+        assert abs(token_ttl - caption_ttl) <= 1
+        assert backfill_ttl(db, retention_days=30, segments=1)['stamped'] == 0
+        
+        # Captions past their retention are hidden before TTL deletes them
+        expired = caption.model_copy(update={'image_id': new_ulid(), 'timestamp': datetime.utcnow() - timedelta(days=400)})
+        db.save_caption(expired, sync=True)
+        history, _ = db.get_user_history('ttl_user')
+        assert [h.image_id for h in history] == [caption.image_id]
+    
+    def test_idempotent_requests(self, aws_credentials, captions_table):
+        """Test repeated requests replay the stored result and failed or abandoned ones run again."""
+        table = captions_table()
+        store = IdempotencyStore(table=table, ttl_seconds=3600)
+        calls = []
+        
+        def work():
+            calls.append(1)
+            return {'concise_caption': 'A dog', 'confidence': 0.9}
+            
+        key = request_key('idem_user', b'image-bytes', provider='bedrock')
+        assert key == request_key('idem_user', b'image-bytes', provider='bedrock')
+        assert key != request_key('idem_user', b'image-bytes', provider='sagemaker')
+        assert key != request_key('other_user', b'image-bytes', provider='bedrock')
+        
+        assert store.run_once('idem_user', key, work) == {'concise_caption': 'A dog', 'confidence': 0.9}
+        assert store.run_once('idem_user', key, work) == {'concise_caption': 'A dog', 'confidence': 0.9}
+        assert len(calls) == 1
+        
+        # A failed call releases its claim so a retry does the work
+        failing_key = request_key('idem_user', b'other-image')
+        with pytest.raises(RuntimeError):
+            store.run_once('idem_user', failing_key, lambda: (_ for _ in ()).throw(RuntimeError("model down")))
+        store.run_once('idem_user', failing_key, work)
+        assert len(calls) == 2
+        
+        # A call still running blocks duplicates until its lease runs out
+        running_key = request_key('idem_user', b'slow-image')
+        assert store.begin('idem_user', running_key) == (True, None)
+        with pytest.raises(RequestInProgressError):
+            store.run_once('idem_user', running_key, work)
+        table.update_item(
+            Key={'PK': 'USER#idem_user', 'SK': f"IDEMPOTENCY#{running_key}"},
+            UpdateExpression='SET lease_expires = :past',
+            ExpressionAttributeValues={':past': 0}
+        )
+        store.run_once('idem_user', running_key, work)
+        assert len(calls) == 3
+    
+    def test_deleted_caption_is_not_replayed(self, aws_credentials, captions_table):
+        """Test deleting a caption drops the record that would replay it."""
+        table = captions_table(gsi=True)
+        store = IdempotencyStore(table=table, ttl_seconds=3600)
+        db = DynamoDBManager()
+        db.table = table
+        key = request_key('idem_user', b'image-bytes', provider='bedrock')
+        saved = []
+        
+        def work():
+            caption = CaptionResult(
+                image_id=f"img{len(saved)}",
+                user_id='idem_user',
+                concise_caption='A dog',
+                creative_caption='A happy dog',
+                model='test-model',
+                provider=CaptionProvider.BEDROCK,
+                s3_url='s3://bucket/image',
+                thumbnail_url='s3://bucket/thumb',
+                request_key=key
+            )
+            saved.append(caption.image_id)
+            assert db.save_caption(caption)
+            return caption.model_dump(mode='json')
+            
+        assert store.run_once('idem_user', key, work)['image_id'] == 'img0'
+        assert store.run_once('idem_user', key, work)['image_id'] == 'img0'
+        
+        assert db.delete_caption('idem_user', 'img0')
+        assert store.run_once('idem_user', key, work)['image_id'] == 'img1'
+        assert saved == ['img0', 'img1']
+    
+    def test_shared_rate_limit(self, aws_credentials, captions_table):
+        """Test limiters of different tasks draw from one DynamoDB bucket."""
+        table = captions_table()
+        config = RateLimitConfig(requests_per_hour=10, bucket_size=10, refill_rate=0.0001)
+        task_a = RateLimiter(config, DynamoDBBucketStore(table), max_lease=4)
+        task_b = RateLimiter(config, DynamoDBBucketStore(table), max_lease=4)
+        
+        allowed = [task.is_allowed('busy_user') for _ in range(8) for task in (task_a, task_b)]
+        
+        assert allowed.count(True) == 10
+        assert not task_a.is_allowed('busy_user') and not task_b.is_allowed('busy_user')
+        assert task_a.is_allowed('other_user')
+        
+        bucket = table.get_item(Key={'PK': 'RATELIMIT#busy_user', 'SK': 'BUCKET'})['Item']
+        assert float(bucket['tokens']) < 1
+        assert 'ttl' in bucket
+        
+        task_a.reset('busy_user')
+        assert task_a.get_remaining('busy_user') == 10
@@ -2,19 +2,39 @@
 import pytest
 from unittest.mock import Mock, patch, MagicMock
 from PIL import Image
+from botocore.exceptions import ClientError
 import io
+import json
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
 
 from backend.models import AppConfig, CaptionProvider, CaptionResult
 from backend.s3_manager import S3Manager
-from backend.db import DynamoDBManager
+from backend.derivatives import DerivativeWorker
+from backend.storage import LocalStorage, MemoryStorage, StorageError
+from backend.image_validation import ImageValidationError, probe_image, validate_image, decode_image
+from backend.db import DynamoDBManager, image_sort_key
+from backend.ids import new_ulid
+from backend.cache import HistoryCache
+from backend.search import caption_tokens, parse_query, matches
+from backend.dynamo_codec import encode_item, decode_item
+from backend.segmented_scan import CapacityThrottle
+from backend.cursor import InvalidCursorError, decode_cursor
+from backend.erasure import erase_user_data
+from backend.aws_clients import (
+    get_client, get_resource, client_config, clear_clients, prewarm, MAX_POOL_CONNECTIONS, MAX_ATTEMPTS
+)
 from backend.caption_service import CaptionService
-from backend.rate_limiter import RateLimiter, RateLimitConfig
+from backend.rate_limiter import BucketStore, RateLimiter, RateLimitConfig, MemoryBucketStore, SlidingWindowCounter
 
 
 class TestS3Manager:
     """Test S3Manager functionality."""
     
-    @patch('backend.s3_manager.boto3.client')
+    @patch('backend.aws_clients.boto3.client')
     def test_upload_image(self, mock_boto):
         """Test image upload to S3."""
         # Setup
@@ -43,7 +63,7 @@ class TestS3Manager:
         assert 's3://' in result.s3_url
         assert mock_s3.put_object.called
     
-    @patch('backend.s3_manager.boto3.client')
+    @patch('backend.aws_clients.boto3.client')
     def test_get_presigned_url(self, mock_boto):
         """Test presigned URL generation."""
         mock_s3 = Mock()
@@ -56,12 +76,325 @@ class TestS3Manager:
         
         assert url == 'https://test-url.com'
         assert mock_s3.generate_presigned_url.called
+    
+    @patch('backend.aws_clients.get_resource')
+    @patch('backend.aws_clients.boto3.client')
+    def test_upload_image_content_addressed_skips_duplicates(self, mock_boto, mock_resource):
+        """Test duplicate uploads reuse the stored object."""
+        mock_s3 = Mock()
+        mock_boto.return_value = mock_s3
+        mock_table = Mock()
+        stale = int(time.time()) - 2 * 86400
+        mock_table.update_item.side_effect = [
+            {},  # New counter
+            {'Attributes': {'ref_count': 1, 'touched_at': stale}},
+            {},  # touched_at reset after the copy
+            {'Attributes': {'ref_count': 2, 'touched_at': int(time.time())}}
+        ]
+        mock_resource.return_value.Table.return_value = mock_table
+        
+        manager = S3Manager()
+        manager.config = manager.config.model_copy(update={'content_addressed_storage': True})
+        
+        img = Image.new('RGB', (100, 100), color='red')
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG')
+        image_data = buf.getvalue()
+        
+        first = manager.upload_image('test_user', image_data, 'a.jpg', 'image/jpeg')
+        assert mock_s3.put_object.call_count == 2  # Original + thumbnail
+        assert mock_s3.copy_object.call_count == 0
+        assert ':ttl' in mock_table.update_item.call_args.kwargs['ExpressionAttributeValues']
+        
+        # Second upload finds the object already stored
+        second = manager.upload_image('test_user', image_data, 'b.jpg', 'image/jpeg')
+        
+        assert mock_s3.put_object.call_count == 2
+        assert first.s3_url == second.s3_url
+        assert first.content_hash == second.content_hash
+        assert first.image_id != second.image_id
+        
+        # Its age was last restarted over a day ago, so the original and thumbnail are copied in place
+        assert [c.kwargs['Key'] for c in mock_s3.copy_object.call_args_list] == [
+            second.s3_url.split('/', 3)[-1], second.thumbnail_url.split('/', 3)[-1]
+        ]
+        assert mock_table.update_item.call_args.kwargs['UpdateExpression'] == 'SET touched_at = :now'
+        
+        # A recently restarted image is only checked for
+        manager.upload_image('test_user', image_data, 'c.jpg', 'image/jpeg')
+        assert mock_s3.copy_object.call_count == 2
+        assert mock_s3.head_object.call_count == 1
+        assert mock_table.update_item.call_count == 4
+        
+        # Without retention nothing expires, so nothing is copied
+        manager.config = manager.config.model_copy(update={'retention_days': 0})
+        mock_table.update_item.side_effect = [{'Attributes': {'ref_count': 3}}]
+        manager.upload_image('test_user', image_data, 'd.jpg', 'image/jpeg')
+        assert mock_s3.copy_object.call_count == 2
+        assert mock_s3.put_object.call_count == 2
+        assert 'SET' not in mock_table.update_item.call_args.kwargs['UpdateExpression']
+    
+    @patch('backend.aws_clients.boto3.client')
+    def test_create_upload_post(self, mock_boto):
+        """Test presigned POST policy carries size and type conditions."""
+        mock_s3 = Mock()
+        mock_s3.generate_presigned_post.return_value = {'url': 'https://bucket.s3', 'fields': {'key': 'k'}}
+        mock_boto.return_value = mock_s3
+        
+        manager = S3Manager()
+        
+        post = manager.create_upload_post('test_user', 'photo.png', 'image/png')
+        
+        kwargs = mock_s3.generate_presigned_post.call_args.kwargs
+        assert kwargs['Key'] == post['key']
+        assert post['key'].startswith('images/test_user/')
+        assert ['content-length-range', 1, manager.config.max_image_size_mb * 1024 * 1024] in kwargs['Conditions']
+        assert {'Content-Type': 'image/png'} in kwargs['Conditions']
+        
+        with pytest.raises(ValueError):
+            manager.create_upload_post('test_user', 'script.html', 'text/html')
+            
+        # Backends without POST policies fail with a storage error, so callers can proxy the upload
+        manager.storage = MemoryStorage()
+        with pytest.raises(StorageError):
+            manager.create_upload_post('test_user', 'photo.png', 'image/png')
+    
+    @patch('backend.aws_clients.boto3.client')
+    def test_complete_upload(self, mock_boto):
+        """Test finishing a direct upload creates the thumbnail from S3."""
+        img = Image.new('RGB', (400, 200), color='green')
+        buf = io.BytesIO()
+        img.save(buf, format='PNG')
+        
+        mock_s3 = Mock()
+        mock_s3.get_object.return_value = {'ContentType': 'image/png', 'Body': io.BytesIO(buf.getvalue())}
+        mock_boto.return_value = mock_s3
+        
+        manager = S3Manager()
+        
+        metadata, data = manager.complete_upload('test_user', 'images/test_user/abc/original.png', 'photo.png')
+        
+        assert metadata.image_id == 'abc'
+        assert metadata.thumbnail_url.endswith('images/test_user/abc/thumbnail.jpg')
+        assert data == buf.getvalue()
+        assert mock_s3.put_object.call_count == 1
+        
+        with pytest.raises(PermissionError):
+            manager.complete_upload('test_user', 'images/other_user/abc/original.png', 'photo.png')
+    
+    @patch('backend.aws_clients.boto3.client')
+    def test_upload_image_defers_thumbnail(self, mock_boto):
+        """Test thumbnails are generated in the background when enabled."""
+        img = Image.new('RGB', (800, 600), color='blue')
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG')
+        
+        mock_s3 = Mock()
+        mock_s3.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        mock_s3.list_objects_v2.return_value = {'Contents': [{'Key': 'images/test_user/x/original.jpg'}]}
+        mock_s3.get_object.side_effect = lambda **kwargs: {'Body': io.BytesIO(buf.getvalue())}
+        mock_boto.return_value = mock_s3
+        
+        manager = S3Manager()
+        manager.config = manager.config.model_copy(update={'async_thumbnails': True})
+        worker_started = threading.Event()
+        release_worker = threading.Event()
+        original_handler = manager._generate_thumbnail
+        
+        def blocking_handler(job):
+            worker_started.set()
+            release_worker.wait(5)
+            original_handler(job)
+            
+        manager._generate_thumbnail = blocking_handler
+        result = manager.upload_image('test_user', buf.getvalue(), 'test.jpg', 'image/jpeg')
+        
+        # Only the original is stored on the request path
+        assert worker_started.wait(5)
+        assert mock_s3.put_object.call_count == 1
+        
+        # Readers get a resized original while the thumbnail is pending
+        preview = manager.get_thumbnail_view(result.thumbnail_url)
+        assert isinstance(preview, bytes)
+        assert max(Image.open(io.BytesIO(preview)).size) <= manager.config.thumbnail_size
+        
+        release_worker.set()
+        manager.derivative_worker.drain(timeout=5)
+        assert mock_s3.put_object.call_count == 2
+        assert mock_s3.put_object.call_args.kwargs['Key'] == result.thumbnail_url.split('/', 3)[-1]
+    
+    @patch('backend.aws_clients.boto3.client')
+    def test_queued_thumbnail_built_by_another_task(self, mock_boto):
+        """Test SQS thumbnail jobs are not tracked locally, so the thumbnail is found once built."""
+        img = Image.new('RGB', (800, 600), color='blue')
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG')
+        
+        mock_client = Mock()
+        mock_client.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        mock_client.list_objects_v2.return_value = {'Contents': [{'Key': 'images/test_user/x/original.jpg'}]}
+        mock_client.get_object.side_effect = lambda **kwargs: {'Body': io.BytesIO(buf.getvalue())}
+        mock_client.generate_presigned_url.return_value = 'https://signed/thumbnail.jpg'
+        # Another task consumes the job
+        mock_client.receive_message.side_effect = lambda **kwargs: time.sleep(0.01) or {}
+        mock_boto.return_value = mock_client
+        
+        manager = S3Manager()
+        manager.config = manager.config.model_copy(update={
+            'async_thumbnails': True,
+            'derivative_queue_url': 'https://sqs.us-east-1.amazonaws.com/123/derivatives'
+        })
+        result = manager.upload_image('test_user', buf.getvalue(), 'test.jpg', 'image/jpeg')
+        thumbnail_key = result.thumbnail_url.split('/', 3)[-1]
+        
+        assert mock_client.send_message.call_count == 1
+        assert not manager.derivative_worker.is_pending(thumbnail_key)
+        assert isinstance(manager.get_thumbnail_view(result.thumbnail_url), bytes)
+        
+        # The other task stored the thumbnail; the next view finds it
+        mock_client.head_object.side_effect = None
+        mock_client.head_object.return_value = {}
+        assert manager.get_thumbnail_view(result.thumbnail_url) == 'https://signed/thumbnail.jpg'
+        manager.derivative_worker.stop()
+    
+    @patch('backend.aws_clients.boto3.client')
+    def test_derivative_worker_consumes_sqs_jobs(self, mock_boto):
+        """Test a queued job is handled and its message deleted."""
+        job = {'source_key': 'images/u1/a/original.jpg', 'target_key': 'images/u1/a/thumbnail.jpg'}
+        messages = [{'Messages': [{'Body': json.dumps(job), 'ReceiptHandle': 'r1'}]}]
+        mock_sqs = Mock()
+        mock_sqs.receive_message.side_effect = lambda **kwargs: messages.pop() if messages else time.sleep(0.01) or {}
+        mock_boto.return_value = mock_sqs
+        handled = threading.Event()
+        
+        worker = DerivativeWorker(lambda received: handled.set(), queue_url='https://sqs/derivatives')
+        worker.start()
+        
+        assert handled.wait(5)
+        worker.stop()
+        mock_sqs.delete_message.assert_called_once_with(QueueUrl='https://sqs/derivatives', ReceiptHandle='r1')
+        assert not worker.is_pending(job['target_key'])
+
+
+class TestStorageBackends:
+    """Test storage backend implementations."""
+    
+    @pytest.mark.parametrize('backend', ['memory', 'local'])
+    def test_put_get_list_delete(self, backend, tmp_path):
+        """Test the storage interface round trip."""
+        storage = MemoryStorage() if backend == 'memory' else LocalStorage(str(tmp_path))
+        
+        storage.put('images/u1/a/original.jpg', b'one', 'image/jpeg')
+        storage.put('images/u1/a/thumbnail.jpg', b'two', 'image/jpeg')
+        storage.put('images/u2/b/original.jpg', b'three', 'image/jpeg')
+        
+        assert storage.get('images/u1/a/original.jpg') == b'one'
+        assert storage.exists('images/u1/a/thumbnail.jpg')
+        assert storage.list_prefix('images/u1/') == ['images/u1/a/original.jpg', 'images/u1/a/thumbnail.jpg']
+        assert storage.parse_url(storage.url_for('images/u1/a/original.jpg'))[1] == 'images/u1/a/original.jpg'
+        
+        assert storage.delete_many(storage.list_prefix('images/u1/')) == 2
+        assert storage.list_prefix('images/') == ['images/u2/b/original.jpg']
+        with pytest.raises(FileNotFoundError):
+            storage.get('images/u1/a/original.jpg')
+    
+    def test_gcs_not_found_matches_other_backends(self):
+        """Test GCS NotFound errors map to the other backends' results."""
+        exceptions = pytest.importorskip('google.api_core.exceptions')
+        from backend.storage import GCSStorage
+        
+        client = MagicMock()
+        bucket = client.bucket.return_value
+        bucket.blob.return_value.download_as_bytes.side_effect = exceptions.NotFound('gone')
+        bucket.delete_blobs.side_effect = lambda blobs, on_error: on_error(blobs[0])
+        storage = GCSStorage('test-bucket', client=client)
+        
+        with pytest.raises(FileNotFoundError):
+            storage.get('images/u1/a/original.jpg')
+        assert storage.delete_many(['images/u1/a/original.jpg', 'images/u1/a/thumbnail.jpg']) == 1
+        
+        bucket.blob.return_value.download_as_bytes.side_effect = exceptions.Forbidden('denied')
+        with pytest.raises(StorageError):
+            storage.get('images/u1/a/original.jpg')
+    
+    def test_storage_backend_name_normalized(self, mock_config):
+        """Test the storage backend name is normalized by the model."""
+        assert AppConfig(**{**mock_config.dict(), 'storage_backend': ' GCS '}).storage_backend == 'gcs'
+    
+    @patch('backend.aws_clients.boto3.client')
+    def test_s3_manager_on_memory_backend(self, mock_boto):
+        """Test S3Manager works against the in-memory backend without network."""
+        manager = S3Manager()
+        manager.storage = MemoryStorage()
+        
+        img = Image.new('RGB', (100, 100), color='red')
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG')
+        
+        result = manager.upload_image('test_user', buf.getvalue(), 'test.jpg', 'image/jpeg')
+        
+        assert result.s3_url.startswith('memory://')
+        assert manager.get_presigned_url(result.thumbnail_url).startswith('data:image/jpeg;base64,')
+        assert manager.delete_user_images('test_user') == 2
+        assert not mock_boto.return_value.put_object.called
+
+
+class TestImageValidation:
+    """Test header-only image validation."""
+    
+    @pytest.mark.parametrize('image_format', ['JPEG', 'PNG', 'GIF', 'WEBP'])
+    def test_probe_image_reads_header(self, image_format):
+        """Test dimensions are read without decoding."""
+        img = Image.new('RGB', (320, 240), color='red')
+        buf = io.BytesIO()
+        img.save(buf, format=image_format)
+        
+        info = probe_image(buf.getvalue())
+        
+        assert (info.format, info.width, info.height, info.frames) == (image_format, 320, 240, 1)
+    
+    def test_probe_image_counts_frames(self):
+        """Test animated GIF frames are counted."""
+        frames = [Image.new('RGB', (50, 40), color=c) for c in ('red', 'green', 'blue')]
+        buf = io.BytesIO()
+        frames[0].save(buf, format='GIF', save_all=True, append_images=frames[1:])
+        
+        assert probe_image(buf.getvalue()).frames == 3
+        with pytest.raises(ImageValidationError):
+            validate_image(buf.getvalue(), max_frames=2)
+    
+    def test_validate_image_rejects_decompression_bomb(self):
+        """Test oversized dimensions are rejected before any pixel decode."""
+        img = Image.new('1', (8000, 8000))
+        buf = io.BytesIO()
+        img.save(buf, format='PNG')
+        
+        with patch('backend.image_validation.Image.open') as mock_open:
+            with pytest.raises(ImageValidationError):
+                decode_image(buf.getvalue())
+            assert not mock_open.called
+            
+        with pytest.raises(ImageValidationError):
+            validate_image(b'<html>not an image</html>')
+    
+    @patch('backend.aws_clients.boto3.client')
+    def test_upload_image_rejects_oversized(self, mock_boto):
+        """Test oversized uploads never reach storage."""
+        img = Image.new('1', (8000, 8000))
+        buf = io.BytesIO()
+        img.save(buf, format='PNG')
+        
+        manager = S3Manager()
+        
+        with pytest.raises(ImageValidationError):
+            manager.upload_image('test_user', buf.getvalue(), 'bomb.png', 'image/png')
+        assert not mock_boto.return_value.put_object.called
 
 
 class TestDynamoDBManager:
     """Test DynamoDB operations."""
     
-    @patch('backend.db.boto3.resource')
+    @patch('backend.db.get_resource')
     def test_save_caption(self, mock_boto):
         """Test saving caption to DynamoDB."""
         mock_table = Mock()
@@ -87,8 +420,293 @@ class TestDynamoDBManager:
         
         assert result == True
         assert mock_table.put_item.called
+    
+    @patch('backend.db.get_resource')
+    def test_save_caption_uses_time_ordered_sort_key(self, mock_boto):
+        """Test sort keys follow creation time for new and legacy image IDs."""
+        mock_table = Mock()
+        mock_boto.return_value.Table.return_value = mock_table
+        
+        db = DynamoDBManager()
+        
+        ids = [new_ulid() for _ in range(100)]
+        assert ids == sorted(ids)
+        
+        caption_result = CaptionResult(
+            image_id=ids[0],
+            user_id='user123',
+            concise_caption='A cat',
+            creative_caption='A cute cat sitting on a mat',
+            model='test-model',
+            provider=CaptionProvider.BEDROCK,
+            s3_url='s3://bucket/image',
+            thumbnail_url='s3://bucket/thumb'
+        )
+        db.save_caption(caption_result)
+        assert mock_table.put_item.call_args.kwargs['Item']['SK'] == f"IMAGE#{ids[0]}"
+        
+        # Legacy UUID IDs get a key derived from the caption timestamp
+        older = image_sort_key('0b5e2c1c-uuid', datetime(2024, 1, 1))
+        newer = image_sort_key('ffffffff-uuid', datetime(2024, 1, 2))
+        assert older < newer
+        assert older == image_sort_key('0b5e2c1c-uuid', datetime(2024, 1, 1))
+    
+    @patch('backend.db.get_resource')
+    def test_get_history_items_uses_projection(self, mock_boto):
+        """Test history reads fetch only rendered attributes into compact items."""
+        mock_table = Mock()
+        mock_table.query.return_value = {
+            'Items': [{
+                'image_id': 'img123',
+                'user_id': 'user123',
+                'concise_caption': 'A cat',
+                'creative_caption': 'A cute cat',
+                'thumbnail_url': 's3://bucket/thumb',
+                'timestamp': '2024-01-01T12:00:00',
+                'labels': ['cat']
+            }],
+            'LastEvaluatedKey': {'PK': 'USER#user123', 'SK': 'IMAGE#img123'}
+        }
+        mock_boto.return_value.Table.return_value = mock_table
+        
+        db = DynamoDBManager()
+        
+        items, next_key = db.get_history_items('user123', limit=20)
+        
+        kwargs = mock_table.query.call_args.kwargs
+        assert 's3_url' not in kwargs['ProjectionExpression']
+        assert kwargs['ExpressionAttributeNames'] == {'#ts': 'timestamp', '#ttl': 'ttl'}
+        assert not hasattr(items[0], '__dict__')
+        assert items[0].timestamp == datetime(2024, 1, 1, 12)
+        assert next_key == {'PK': 'USER#user123', 'SK': 'IMAGE#img123'}
+        
+        history, _ = db.get_user_history('user123')
+        assert history[0].concise_caption == 'A cat'
+    
+    @patch('backend.db.get_resource')
+    def test_filtered_pages_read_past_expired_items(self, mock_boto):
+        """Test history and label pages keep querying when the TTL filter drops evaluated items."""
+        def item(image_id):
+            return {'image_id': image_id, 'user_id': 'user123', 'concise_caption': 'A cat',
+                    'creative_caption': 'A cute cat', 'thumbnail_url': 's3://bucket/thumb',
+                    'timestamp': '2024-01-01T12:00:00'}
+                    
+        mock_table = Mock()
+        mock_boto.return_value.Table.return_value = mock_table
+        db = DynamoDBManager()
+        
+        for read in (db.get_history_items, lambda user_id, limit: db.get_user_history_by_label(user_id, 'Cat', limit)):
+            # Every item of the first response was expired and filtered out
+            mock_table.query.reset_mock()
+            mock_table.query.side_effect = [
+                {'Items': [], 'LastEvaluatedKey': {'SK': 'a'}},
+                {'Items': [item('img1')], 'LastEvaluatedKey': {'SK': 'b'}},
+                {'Items': [item('img2')], 'LastEvaluatedKey': {'SK': 'c'}}
+            ]
+            
+            items, next_key = read('user123', limit=2)
+            
+            assert [i.image_id for i in items] == ['img1', 'img2']
+            assert next_key == {'SK': 'c'}
+            calls = mock_table.query.call_args_list
+            assert [c.kwargs['Limit'] for c in calls] == [2, 2, 1]
+            assert 'ExclusiveStartKey' not in calls[0].kwargs
+            assert [c.kwargs['ExclusiveStartKey'] for c in calls[1:]] == [{'SK': 'a'}, {'SK': 'b'}]
+    
+    @patch('backend.db.get_resource')
+    def test_history_cache_read_through_and_invalidation(self, mock_boto):
+        """Test repeated history loads skip DynamoDB until the user's history changes."""
+        mock_table = Mock()
+        mock_table.query.return_value = {'Items': []}
+        mock_boto.return_value.Table.return_value = mock_table
+        
+        db = DynamoDBManager()
+        
+        db.get_history_items('user123', limit=20)
+        db.get_history_items('user123', limit=20)
+        assert mock_table.query.call_count == 1
+        
+        # A different page is cached separately
+        db.get_history_items('user123', limit=20, last_evaluated_key={'PK': 'USER#user123', 'SK': 'IMAGE#x'})
+        assert mock_table.query.call_count == 2
+        
+        db.save_caption(CaptionResult(
+            image_id='img123',
+            user_id='user123',
+            concise_caption='A cat',
+            creative_caption='A cute cat',
+            model='test-model',
+            provider=CaptionProvider.BEDROCK,
+            s3_url='s3://bucket/image',
+            thumbnail_url='s3://bucket/thumb'
+        ))
+        db.get_history_items('user123', limit=20)
+        assert mock_table.query.call_count == 3
+    
+    @patch('backend.db.get_resource')
+    def test_history_page_cursor_and_prefetch(self, mock_boto):
+        """Test history pages use signed cursors and the next page is prefetched."""
+        def row(image_id):
+            return {
+                'image_id': image_id,
+                'user_id': 'user123',
+                'concise_caption': 'A cat',
+                'creative_caption': 'A cute cat',
+                'thumbnail_url': 's3://bucket/thumb',
+                'timestamp': '2024-01-01T12:00:00'
+            }
+            
+        mock_table = Mock()
+        mock_table.name = 'test-table'
+        mock_table.query.return_value = {
+            'Items': [row('img2')],
+            'LastEvaluatedKey': {'PK': 'USER#user123', 'SK': 'IMAGE#img2'}
+        }
+        mock_client = mock_boto.return_value.meta.client
+        mock_client.query.return_value = {'Items': [row('img1')]}
+        mock_boto.return_value.Table.return_value = mock_table
+        
+        db = DynamoDBManager()
+        
+        items, cursor = db.get_history_page('user123', page_size=1)
+        assert items[0].image_id == 'img2'
+        assert 'IMAGE#img2' not in cursor
+        db._prefetch_executor.shutdown(wait=True)
+        assert mock_client.query.call_args.kwargs['ExclusiveStartKey'] == {'PK': 'USER#user123', 'SK': 'IMAGE#img2'}
+        
+        # The second page comes from the prefetched cache entry
+        items, next_cursor = db.get_history_page('user123', page_size=1, cursor=cursor)
+        assert items[0].image_id == 'img1'
+        assert next_cursor is None
+        assert mock_table.query.call_count == 1
+        
+        with pytest.raises(InvalidCursorError):
+            db.get_history_page('other-user', page_size=1, cursor=cursor)
+        with pytest.raises(InvalidCursorError):
+            db.get_history_page('user123', page_size=1, cursor='x' + cursor)
+        assert decode_cursor(cursor, 'user123') == {'PK': 'USER#user123', 'SK': 'IMAGE#img2'}
+    
+    @patch('backend.db.time.sleep')
+    @patch('backend.db.get_resource')
+    def test_delete_user_data_paginates_and_retries(self, mock_boto, mock_sleep):
+        """Test deletion follows every page and retries unprocessed items."""
+        mock_table = Mock()
+        mock_table.name = 'test-table'
+        mock_table.query.side_effect = [
+            {'Items': [{'PK': 'USER#u1', 'SK': f"IMAGE#{i}"} for i in range(30)], 'LastEvaluatedKey': {'PK': 'USER#u1', 'SK': 'IMAGE#29'}},
+            {'Items': [{'PK': 'USER#u1', 'SK': f"IMAGE#{i}"} for i in range(30, 40)]}
+        ]
+        mock_table.get_item.return_value = {}
+        mock_client = mock_boto.return_value.meta.client
+        responses = iter([{'UnprocessedItems': {'test-table': [{'DeleteRequest': {'Key': {'PK': 'USER#u1', 'SK': 'IMAGE#0'}}}]}}])
+        mock_client.batch_write_item.side_effect = lambda **kwargs: next(responses, {'UnprocessedItems': {}})
+        mock_boto.return_value.Table.return_value = mock_table
+        
+        db = DynamoDBManager()
+        
+        assert db.delete_user_data('u1') == 40
+        assert mock_table.query.call_args_list[1].kwargs['ExclusiveStartKey'] == {'PK': 'USER#u1', 'SK': 'IMAGE#29'}
+        assert mock_table.query.call_args.kwargs['ProjectionExpression'] == 'PK, SK'
+        # Three batches (25 + 5 + 10) plus one retry
+        assert mock_client.batch_write_item.call_count == 4
+        assert mock_sleep.called
+    
+    def test_erase_user_data(self):
+        """Test the erasure job deletes storage objects and items together."""
+        s3_manager = Mock()
+        s3_manager.delete_user_images.return_value = 4
+        db_manager = Mock()
+        db_manager.delete_user_data.return_value = 2
+        
+        counts = erase_user_data('u1', s3_manager, db_manager)
+        
+        assert counts == {'objects_deleted': 4, 'items_deleted': 2}
+        s3_manager.delete_user_images.assert_called_once_with('u1')
+        db_manager.delete_user_data.assert_called_once_with('u1')
+    
+    def test_history_cache_bounds(self):
+        """Test cache entries expire and the entry count stays bounded."""
+        cache = HistoryCache(ttl_seconds=60, max_entries=2)
+        
+        for user_id in ('a', 'b', 'c'):
+            cache.put(user_id, 20, None, [], None, cache.generation(user_id))
+            
+        assert cache.get('a', 20, None) is None
+        assert cache.get('c', 20, None) == ([], None)
+        
+        with patch('backend.cache.time.monotonic', return_value=time.monotonic() + 61):
+            assert cache.get('c', 20, None) is None
+    
+    def test_history_cache_skips_page_read_before_invalidation(self):
+        """Test a page read across an invalidation is not cached."""
+        cache = HistoryCache(ttl_seconds=60)
+        
+        generation = cache.generation('a')
+        # The user's history changes while the page is being queried
+        cache.invalidate_user('a')
+        cache.put('a', 20, None, [], None, generation)
+        
+        assert cache.get('a', 20, None) is None
+        cache.put('a', 20, None, [], None, cache.generation('a'))
+        assert cache.get('a', 20, None) == ([], None)
+
 
 
+class TestDynamoCodec:
+    """Test the low-level DynamoDB item codec."""
+    
+    def test_matches_type_serializer(self):
+        """Test encoding and decoding agree with boto3's resource layer."""
+        item = {
+            'PK': 'USER#u1',
+            'provider': CaptionProvider.BEDROCK,
+            'labels': ['cat', 'sofa'],
+            'confidence': Decimal('0.93'),
+            'file_size': 1024,
+            'missing': None,
+            'flag': True,
+            'meta': {'sizes': [1, Decimal('2.5')]},
+            'tags': {'a', 'b'},
+            'blob': b'\x00\x01'
+        }
+        serializer, deserializer = TypeSerializer(), TypeDeserializer()
+        wire = {name: serializer.serialize(value) for name, value in item.items()}
+        
+        assert encode_item(item) == wire
+        assert decode_item(wire) == {name: deserializer.deserialize(value) for name, value in wire.items()}
+        assert type(decode_item(wire)['file_size']) is int
+        
+        with pytest.raises(TypeError):
+            encode_item({'score': 0.5})
+
+
+class TestSearchTokens:
+    """Test caption tokenization and query parsing."""
+    
+    def test_tokens_and_queries(self):
+        """Test tokens are normalized and queries become AND-ed exact or prefix terms."""
+        item = {'labels': ['Golden Retriever'], 'concise_caption': 'A dog on the beach!', 'creative_caption': ''}
+        assert caption_tokens(item) == {'golden', 'retriever', 'dog', 'beach'}
+        
+        terms = parse_query('Beach dog* the golden-ret*')
+        assert terms == [('beach', False), ('dog', True), ('golden', False), ('ret', True)]
+        assert matches(caption_tokens(item), terms)
+        assert not matches(caption_tokens(item), parse_query('beach cat'))
+
+
+class TestCapacityThrottle:
+    """Test the segmented scans' consumed-capacity throttle."""
+    
+    @patch('backend.segmented_scan.time.sleep')
+    def test_sleeps_off_capacity_debt(self, mock_sleep):
+        """Test a one-second burst is free and further reads wait at the target rate."""
+        throttle = CapacityThrottle(100)
+        assert throttle.consume(60) == 0
+        
+        delay = throttle.consume(90)
+        assert delay == pytest.approx(0.5, abs=0.01)
+        mock_sleep.assert_called_once_with(delay)
+
 class TestRateLimiter:
     """Test rate limiter."""
     
@@ -115,12 +733,165 @@ class TestRateLimiter:
         
         # Next request should be blocked
         assert limiter.is_allowed('user1') == False
+    
+    def test_lease_batches_store_calls(self):
+        """Test hot users spend borrowed tokens locally without exceeding the bucket."""
+        config = RateLimitConfig(requests_per_hour=20, bucket_size=20, refill_rate=0.0001)
+        store = MemoryBucketStore()
+        store.take = Mock(wraps=store.take)
+        limiter = RateLimiter(config, store, max_lease=8)
+        
+        allowed = [limiter.is_allowed('user1') for _ in range(25)]
+        
+        assert allowed.count(True) == 20
+        assert allowed[20:] == [False] * 5
+        # Leases of 1, 2, 4, 8 and the rest, instead of one call per request
+        assert store.take.call_count < 12
+        assert limiter.get_remaining('user1') == 0
+    
+    def test_memory_store_is_bounded(self):
+        """Test the in-process store evicts full buckets and caps the users it tracks."""
+        store = MemoryBucketStore(max_users=64, stripes=4)
+        
+        for i in range(1000):
+            assert store.take(f"user{i}", 1, 5, 0.0001) == 1
+        assert len(store) <= 64
+        
+        # Buckets that refilled carry no state
+        fast = MemoryBucketStore(stripes=4)
+        for i in range(100):
+            fast.take(f"user{i}", 1, 5, 1e9)
+        assert len(fast) <= 4
+        
+        assert store.take('user999', 10, 5, 0.0001) == 4
+        assert store.peek('user999', 5, 0.0001) < 1
+        store.reset('user999')
+        assert store.peek('user999', 5, 0.0001) == 5
+    
+    def test_bucket_store_requires_full_interface(self):
+        """Test stores must implement take, peek and reset."""
+        class TakeOnlyStore(BucketStore):
+            def take(self, key, count, capacity, refill_rate):
+                return count
+                
+        with pytest.raises(TypeError):
+            TakeOnlyStore()
+    
+    @patch('backend.rate_limiter.time.monotonic')
+    def test_sliding_window_counter(self, mock_clock):
+        """Test weighted requests count against every key over a sliding window."""
+        mock_clock.return_value = 600.0
+        counter = SlidingWindowCounter(window_seconds=60)
+        limits = [('caption:user:u1', 5), ('caption:ip:10.0.0.1', 20)]
+        
+        assert counter.hit(limits) == (True, 0.0)
+        counter.add(limits, 3)
+        # The full limit is back once this window's 4 units have slid out, at the end of the next one
+        assert counter.status(limits) == (5, 1, 120)
+        assert counter.hit(limits)[0] == True
+        
+        allowed, retry_after = counter.hit(limits)
+        assert allowed == False
+        # The window's 5 units must slide out until 4 remain
+        assert retry_after == pytest.approx(60 + 12)
+        
+        # Halfway through the next window, half of the previous one still counts
+        mock_clock.return_value = 690.0
+        assert counter.status(limits) == (5, 2, 30)
+        # A request costing 3 units does not fit in the 2 remaining
+        allowed, retry_after = counter.hit(limits, 3)
+        assert allowed == False
+        assert retry_after == pytest.approx(6)
+        assert counter.status(limits)[1] == 2
+        assert counter.hit([('caption:user:u2', 5)]) == (True, 0.0)
+        
+        # Idle keys are forgotten after two windows
+        mock_clock.return_value = 800.0
+        assert counter.status(limits) == (5, 5, 0)
+    
+    def test_store_errors_let_requests_through(self):
+        """Test an unreachable store does not block users."""
+        store = Mock()
+        store.take.side_effect = ConnectionError("store down")
+        limiter = RateLimiter(RateLimitConfig(), store, max_lease=8)
+        
+        assert limiter.is_allowed('user1') == True
+        assert limiter.is_allowed('user1') == True
+
+
+@pytest.fixture
+def rate_limited_app():
+    """Flask app with a caption endpoint behind RateLimitMiddleware, and the costs it ran."""
+    flask = pytest.importorskip('flask')
+    pytest.importorskip('firebase_admin')
+    from auth_security import RateLimitMiddleware
+    
+    app = flask.Flask(__name__)
+    rate_limits = RateLimitMiddleware(app, SlidingWindowCounter(window_seconds=60))
+    ran = []
+    
+    @app.route('/caption', methods=['POST'])
+    @rate_limits.limit('generate_caption')
+    def caption():
+        cost = int(flask.request.args.get('cost', 1))
+        rejected = rate_limits.charge(cost - 1)
+        if rejected:
+            return rejected
+        ran.append(cost)
+        return flask.jsonify({'ok': True})
+        
+    return app, ran
+
+
+class TestRateLimitMiddleware:
+    """Test per-endpoint limits through a Flask test client."""
+    
+    @patch('backend.rate_limiter.time.monotonic', return_value=600.0)
+    def test_headers_and_rejection(self, mock_clock, rate_limited_app):
+        """Test quota headers follow the sliding window and exhausted clients get 429."""
+        app, ran = rate_limited_app
+        client = app.test_client()
+        
+        response = client.post('/caption')
+        assert response.status_code == 200
+        assert response.headers['RateLimit-Limit'] == '5'
+        assert response.headers['RateLimit-Remaining'] == '4'
+        # The unit slides out of the window by the end of the next one
+        assert response.headers['RateLimit-Reset'] == '120'
+        
+        assert client.post('/caption?cost=4').status_code == 200
+        response = client.post('/caption')
+        assert response.status_code == 429
+        assert response.headers['RateLimit-Remaining'] == '0'
+        assert int(response.headers['Retry-After']) > 0
+        assert ran == [1, 4]
+        
+        # Half a window later, half of the used quota is back; the full limit
+        # returns once this request's unit has slid out, at the end of the next window
+        mock_clock.return_value = 690.0
+        response = client.post('/caption')
+        assert response.status_code == 200
+        assert response.headers['RateLimit-Remaining'] == '1'
+        assert response.headers['RateLimit-Reset'] == '90'
+    
+    @patch('backend.rate_limiter.time.monotonic', return_value=600.0)
+    def test_cost_checked_before_work(self, mock_clock, rate_limited_app):
+        """Test a request costing more than the remaining quota is refused before the work runs."""
+        app, ran = rate_limited_app
+        client = app.test_client()
+        
+        assert client.post('/caption?cost=3').status_code == 200
+        response = client.post('/caption?cost=3')
+        assert response.status_code == 429
+        assert 'Retry-After' in response.headers
+        assert ran == [3]
+        assert client.post('/caption').status_code == 200
 
 
 class TestCaptionService:
     """Test caption service."""
     
-    @patch('backend.caption_service.boto3.client')
+    @patch('backend.aws_clients.boto3.client')
     def test_detect_labels(self, mock_boto):
         """Test Rekognition label detection."""
         mock_rekognition = Mock()
@@ -152,6 +923,73 @@ class TestCaptionService:
         assert processed.mode == 'RGB'
 
 
+
+class TestAwsClients:
+    """Test the shared AWS client factory."""
+    
+    @patch('backend.aws_clients.boto3.client')
+    def test_clients_are_shared_and_tuned(self, mock_boto):
+        """Test one tuned client is built per service, region and options."""
+        mock_boto.side_effect = lambda *args, **kwargs: Mock()
+        
+        s3 = get_client('s3', 'us-east-1')
+        assert get_client('s3', 'us-east-1') is s3
+        assert get_client('s3', 'eu-west-1') is not s3
+        assert get_client('s3', 'us-east-1', endpoint_url='http://localhost:4566') is not s3
+        
+        config = mock_boto.call_args_list[0].kwargs['config']
+        assert config.max_pool_connections == MAX_POOL_CONNECTIONS
+        assert config.retries == {'max_attempts': MAX_ATTEMPTS, 'mode': 'adaptive'}
+        assert client_config('bedrock-runtime').read_timeout > config.read_timeout
+    
+    @patch('backend.aws_clients.boto3.client')
+    def test_concurrent_lazy_init_creates_one_client(self, mock_boto):
+        """Test racing callers all receive the same client."""
+        def slow_client(*args, **kwargs):
+            time.sleep(0.01)
+            return Mock()
+        mock_boto.side_effect = slow_client
+        
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(get_client('rekognition', 'us-east-1'))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+            
+        assert mock_boto.call_count == 1
+        assert all(client is results[0] for client in results)
+    
+    def test_resources_are_per_thread_on_one_client(self):
+        """Test each thread gets its own resource, all sharing the pooled client."""
+        main = get_resource('dynamodb', 'us-east-1')
+        assert get_resource('dynamodb', 'us-east-1') is main
+        
+        others = []
+        thread = threading.Thread(target=lambda: others.append(get_resource('dynamodb', 'us-east-1')))
+        thread.start()
+        thread.join()
+        
+        assert others[0] is not main
+        assert others[0].meta.client is main.meta.client is get_client('dynamodb', 'us-east-1')
+    
+    @patch('backend.aws_clients.boto3.client')
+    def test_prewarm_opens_connections(self, mock_boto):
+        """Test prewarm makes a cheap call per service and tolerates refused ones."""
+        clients = {}
+        mock_boto.side_effect = lambda service_name, **kwargs: clients.setdefault(service_name, Mock())
+        
+        prewarm('us-east-1', services=('dynamodb', 'bedrock-runtime', 'sagemaker-runtime'))
+        clients['bedrock-runtime'].list_async_invokes.side_effect = ClientError(
+            {'Error': {'Code': 'AccessDeniedException'}}, 'ListAsyncInvokes'
+        )
+        clear_clients()
+        prewarm('us-east-1', services=('bedrock-runtime',))
+        
+        assert clients['dynamodb'].describe_endpoints.call_count == 1
+        assert clients['bedrock-runtime'].list_async_invokes.call_args.kwargs == {'maxResults': 1}
+        assert set(clients) == {'dynamodb', 'bedrock-runtime', 'sagemaker-runtime'}
+
 @pytest.fixture
 def mock_config():
     """Mock configuration."""
@@ -1,36 +1,32 @@
 """Simple Streamlit app to view DynamoDB captions."""
 import streamlit as st
-import boto3
 from datetime import datetime
+from aws_utils import get_latest_captions
 
-st.set_page_config(page_title="Caption Gallery", page_icon="📊", layout="wide")
-
-# Initialize DynamoDB
-@st.cache_resource
-def init_dynamodb():
-    return boto3.resource('dynamodb', region_name='eu-north-1')
+# Captions loaded per page
+PAGE_SIZE = 20
 
-dynamodb = init_dynamodb()
-table = dynamodb.Table('image_captions')
+st.set_page_config(page_title="Caption Gallery", page_icon="📊", layout="wide")
 
 # Page header
 st.title("📊 Image Caption Gallery")
 st.markdown("View all captions stored in DynamoDB")
 st.markdown("---")
 
-# Get data
-with st.spinner("Loading data from DynamoDB..."):
-    response = table.scan()
-    items = response.get('Items', [])
+# Get data: newest captions from the recency index, one page at a time
+if 'gallery_items' not in st.session_state:
+    with st.spinner("Loading data from DynamoDB..."):
+        page, cursor = get_latest_captions(PAGE_SIZE)
+    st.session_state.gallery_items = page
+    st.session_state.gallery_cursor = cursor
+
+items = st.session_state.gallery_items
 
 if len(items) == 0:
     st.warning("⚠️ No captions found in DynamoDB")
     st.info("💡 Upload images and save captions using the main app to see them here!")
 else:
-    st.success(f"✅ Found {len(items)} captions")
-    
-    # Sort by timestamp (newest first)
-    items.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
+    st.success(f"✅ Showing {len(items)} captions (newest first)")
     
     # Display in columns
     cols = st.columns(2)
@@ -59,6 +55,13 @@ else:
                 st.markdown(f"**🔗 URL:** [{image_url}]({image_url})")
             
             st.markdown("---")
+            
+    if st.session_state.gallery_cursor and st.button("⬇️ Load more"):
+        with st.spinner("Loading data from DynamoDB..."):
+            page, cursor = get_latest_captions(PAGE_SIZE, st.session_state.gallery_cursor)
+        st.session_state.gallery_items = items + page
+        st.session_state.gallery_cursor = cursor
+        st.rerun()
 
 # Footer
 st.markdown("---")
@@ -66,5 +69,5 @@ st.markdown("🌐 **View in AWS Console:** [DynamoDB Table](https://eu-north-1.c
 
 # Refresh button
 if st.button("🔄 Refresh Data"):
-    st.cache_resource.clear()
+    st.session_state.pop('gallery_items', None)
     st.rerun()